@@ -0,0 +1,65 @@
+from aiogram import types
+from typing import Callable, Dict, List
+import asyncio
+import logging
+
+
+# Telegram albums hold at most this many items
+MAX_ALBUM_SIZE = 10
+
+
+# Buffers the parts of a media group (album) until the whole album has arrived:
+class AlbumAggregator:
+    """
+    Telegram delivers every item of an album as a separate update sharing a
+    `media_group_id`. The aggregator collects those items and hands the whole
+    album to `on_album` once no new item arrived for `window` seconds, or as
+    soon as the album is full.
+
+    Parameters:
+      on_album: Called with the album's messages, sorted by message ID.
+      window: Quiet period after the last item before the album is flushed.
+    """
+
+    def __init__(self, on_album: Callable[[List[types.Message]], None], window: float = 1.0) -> None:
+        self.on_album = on_album
+        self.window = window
+        self._parts: Dict[str, List[types.Message]] = {}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+
+    def add(self, message: types.Message) -> None:
+        """
+        Adds one album item; the album is flushed later.
+        """
+        group_id = message.media_group_id
+        parts = self._parts.setdefault(group_id, [])
+        parts.append(message)
+
+        timer = self._timers.pop(group_id, None)
+        if timer is not None:
+            timer.cancel()
+        if len(parts) >= MAX_ALBUM_SIZE:
+            self.flush(group_id)
+        else:
+            self._timers[group_id] = asyncio.get_running_loop().call_later(self.window, self.flush, group_id)
+
+    def flush(self, group_id: str) -> None:
+        timer = self._timers.pop(group_id, None)
+        if timer is not None:
+            timer.cancel()
+        parts = self._parts.pop(group_id, None)
+        if not parts:
+            return
+        parts.sort(key=lambda message: message.message_id)
+        logging.info(f"Album {group_id} complete with {len(parts)} items")
+        try:
+            self.on_album(parts)
+        except Exception as e:
+            logging.error(f"Error handling album {group_id}: {e}")
+
+    def flush_all(self) -> None:
+        """
+        Flushes every buffered album immediately, e.g. on shutdown.
+        """
+        for group_id in list(self._parts):
+            self.flush(group_id)
@@ -0,0 +1,222 @@
+"""
+Broadcast throughput benchmark.
+
+Drives the real handlers and delivery workers with a synthetic stream of
+updates (text, photos, stickers, voice messages, albums and forwards) and
+delivers them through a local fake Bot API server, so no Telegram access is
+needed. For every subscriber count it reports API sends per second, p50/p99
+time from receiving a message to its last recipient, and peak memory.
+
+Usage:
+  python benchmarks/bench_broadcast.py --subscribers 1000 10000 100000 --messages 20 --latency 0.02
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram import Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+import fanout
+from albums import AlbumAggregator
+from benchmarks.fake_api import FakeBotAPI
+from bot import register_handlers
+from delivery import enqueue_messages, process_job
+from delivery_queue import DeliveryWorkers, open_queue
+from metrics import MetricsMiddleware
+from registry import open_registry
+
+
+CHANNEL_ID = -1001000000000
+SENDER_ID = 1
+CONTENT_MIX = ["text", "photo", "sticker", "voice", "album", "forwarded"]
+
+
+def make_updates(kind: str, message_id: int, update_id: int) -> List[Dict[str, Any]]:
+    """
+    Returns the update JSON for one synthetic message (several updates for an album).
+    """
+    base = {
+        "date": int(time.time()),
+        "chat": {"id": SENDER_ID, "type": "private"},
+        "from": {"id": SENDER_ID, "is_bot": False, "first_name": "Bench"}
+    }
+    photo = [{"file_id": f"photo-{message_id}", "file_unique_id": f"p{message_id}", "width": 1, "height": 1}]
+    if kind == "text":
+        messages = [dict(base, message_id=message_id, text=f"Benchmark message {message_id}")]
+    elif kind == "photo":
+        messages = [dict(base, message_id=message_id, photo=photo, caption="photo")]
+    elif kind == "sticker":
+        messages = [dict(base, message_id=message_id, sticker={
+            "file_id": "sticker", "file_unique_id": "s", "type": "regular",
+            "width": 512, "height": 512, "is_animated": False, "is_video": False
+        })]
+    elif kind == "voice":
+        messages = [dict(base, message_id=message_id, voice={"file_id": "voice", "file_unique_id": "v", "duration": 1})]
+    elif kind == "album":
+        messages = [
+            dict(base, message_id=message_id + index, media_group_id=f"album-{message_id}", photo=photo)
+            for index in range(3)
+        ]
+    else:
+        messages = [dict(
+            base,
+            message_id=message_id,
+            text="forwarded",
+            forward_from={"id": 99, "is_bot": False, "first_name": "Origin"},
+            forward_date=int(time.time())
+        )]
+    return [{"update_id": update_id + index, "message": message} for index, message in enumerate(messages)]
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def run_scenario(subscribers: int, args: argparse.Namespace) -> Dict[str, Any]:
+    """
+    Runs one benchmark with `subscribers` registered users.
+    """
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    os.environ["DATA_DIR"] = os.path.join(workdir, "data")
+    os.environ["USERS_FILE"] = os.path.join(workdir, "users.json")
+    os.environ["USER_STORAGE"] = "sqlite"
+    os.environ["BROADCAST_CONCURRENCY"] = str(args.concurrency)
+    os.environ["GLOBAL_RATE_LIMIT"] = str(args.global_rate)
+    os.environ["PER_CHAT_RATE_LIMIT"] = str(args.per_chat_rate)
+    with open(os.environ["USERS_FILE"], "w") as file:
+        json.dump(list(range(1, subscribers + 1)), file)
+
+    blocked = set(random.sample(range(2, subscribers + 1), int((subscribers - 1) * args.blocked_rate)))
+    api = FakeBotAPI(
+        latency=args.latency,
+        retry_after_rate=args.retry_after_rate,
+        retry_after=args.retry_after,
+        blocked_users=blocked
+    )
+    base_url = await api.start()
+    bot = Bot(token="123456:BENCHMARK", session=AiohttpSession(api=TelegramAPIServer.from_base(base_url)))
+
+    # A fresh engine per scenario so rate-limit state does not carry over
+    fanout._engine = None
+    registry = open_registry()
+    fanout.get_engine().add_observer(registry.record_delivery)
+    queue = open_queue()
+    albums = AlbumAggregator(lambda messages: enqueue_messages(queue, messages), window=0.05)
+
+    dp = Dispatcher()
+    dp.message.middleware(MetricsMiddleware())
+    dp["registry"] = registry
+    dp["queue"] = queue
+    dp["albums"] = albums
+    register_handlers(dp, bot)
+    workers = DeliveryWorkers(
+        queue,
+        lambda job_id, payload, progress: process_job(bot, registry, CHANNEL_ID, job_id, payload, progress),
+        count=args.workers,
+        poll_interval=0.05
+    )
+    workers.start()
+
+    received: Dict[int, float] = {}
+    started = time.monotonic()
+    message_id = 1000
+    update_id = 1
+    for index in range(args.messages):
+        kind = CONTENT_MIX[index % len(CONTENT_MIX)]
+        updates = make_updates(kind, message_id, update_id)
+        received[message_id] = time.monotonic()
+        for update in updates:
+            await dp.feed_update(bot, types.Update.model_validate(update, context={"bot": bot}))
+        message_id += len(updates)
+        update_id += len(updates)
+        if args.rate:
+            await asyncio.sleep(1 / args.rate)
+
+    # Wait for buffered albums and the queue to drain
+    await asyncio.sleep(0.1)
+    deadline = time.monotonic() + args.timeout
+    while time.monotonic() < deadline:
+        stats = queue.stats()
+        if not stats["pending"] and not stats["running"]:
+            break
+        await asyncio.sleep(0.05)
+    finished = time.monotonic()
+
+    await workers.stop()
+    registry.close()
+    queue.close()
+    await bot.session.close()
+    await api.stop()
+
+    latencies = [api.last_delivery[source] - at for source, at in received.items() if source in api.last_delivery]
+    sends = sum(api.deliveries.values())
+    return {
+        "subscribers": subscribers,
+        "messages": args.messages,
+        "sends": sends,
+        "api_calls": sum(api.calls.values()),
+        "elapsed": finished - started,
+        "sends_per_second": sends / (finished - started),
+        "p50_last_recipient": percentile(latencies, 0.5),
+        "p99_last_recipient": percentile(latencies, 0.99),
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "calls_by_method": api.calls,
+        "incomplete": len(received) - len(latencies)
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark broadcast throughput against a fake Bot API")
+    parser.add_argument("--subscribers", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--messages", type=int, default=12, help="Messages per scenario (content types rotate)")
+    parser.add_argument("--rate", type=float, default=0, help="Incoming messages per second (0 = as fast as possible)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Fake API latency per request, seconds")
+    parser.add_argument("--retry-after-rate", type=float, default=0.0, help="Fraction of sends answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--blocked-rate", type=float, default=0.01, help="Fraction of users that blocked the bot")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--global-rate", type=float, default=1e9, help="GLOBAL_RATE_LIMIT (unlimited by default)")
+    parser.add_argument("--per-chat-rate", type=float, default=1e9, help="PER_CHAT_RATE_LIMIT (unlimited by default)")
+    parser.add_argument("--timeout", type=float, default=3600)
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    parser.add_argument("--verbose", action="store_true", help="Show the bot's warning and error logs")
+    args = parser.parse_args()
+
+    # Per-recipient error lines (blocked users) would dominate the run
+    logging.basicConfig(level=logging.WARNING)
+    if not args.verbose:
+        logging.disable(logging.ERROR)
+
+    results = []
+    for subscribers in args.subscribers:
+        results.append(await run_scenario(subscribers, args))
+        if not args.json:
+            result = results[-1]
+            print(
+                f"{result['subscribers']:>8} subscribers: {result['sends']:>9} sends in {result['elapsed']:7.2f}s "
+                f"({result['sends_per_second']:8.0f}/s), last recipient p50 {result['p50_last_recipient']:.2f}s "
+                f"p99 {result['p99_last_recipient']:.2f}s, max RSS {result['max_rss_mb']:.0f} MB"
+                + (f", {result['incomplete']} incomplete" if result["incomplete"] else "")
+            )
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,112 @@
+from aiohttp import web
+from typing import Dict, Optional, Set
+import asyncio
+import json
+import random
+import time
+
+
+# Local stand-in for the Telegram Bot API:
+class FakeBotAPI:
+    """
+    A minimal Bot API server for benchmarks. It answers the methods the bot
+    uses, records every call and can inject latency, 429 (RetryAfter)
+    responses and 'bot was blocked' errors.
+
+    Parameters:
+      latency: Seconds every request takes.
+      retry_after_rate: Fraction of sends answered with 429.
+      retry_after: The retry_after value of injected 429 responses.
+      blocked_users: Chat IDs answered with 403 Forbidden.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        retry_after_rate: float = 0.0,
+        retry_after: int = 1,
+        blocked_users: Optional[Set[int]] = None
+    ) -> None:
+        self.latency = latency
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.blocked_users = blocked_users or set()
+        self.calls: Dict[str, int] = {}
+        # Source message ID -> number of final (non-429) delivery responses
+        self.deliveries: Dict[int, int] = {}
+        # Source message ID -> time of the last delivery response
+        self.last_delivery: Dict[int, float] = {}
+        self._next_message_id = 1
+        self._runner = None
+
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """
+        Starts the server and returns its base URL.
+        """
+        self._runner = web.AppRunner(self.build_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        return f"http://{host}:{port}"
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def _message(self, chat_id: int) -> Dict:
+        message_id = self._next_message_id
+        self._next_message_id += 1
+        return {"message_id": message_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}}
+
+    def _record_delivery(self, params: Dict) -> None:
+        if "message_ids" in params:
+            source = json.loads(params["message_ids"])[0]
+        elif "message_id" in params:
+            source = int(params["message_id"])
+        else:
+            # sendMessage (forwarded comments) is keyed by its text
+            source = hash(params.get("text"))
+        self.deliveries[source] = self.deliveries.get(source, 0) + 1
+        self.last_delivery[source] = time.monotonic()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        chat_id = int(params["chat_id"]) if "chat_id" in params else 0
+        is_send = method in ("copyMessage", "copyMessages", "forwardMessage", "forwardMessages", "sendMessage")
+        if is_send and self.retry_after_rate and random.random() < self.retry_after_rate:
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after}
+            }, status=429)
+        if is_send:
+            self._record_delivery(params)
+        if is_send and chat_id in self.blocked_users:
+            return web.json_response({
+                "ok": False,
+                "error_code": 403,
+                "description": "Forbidden: bot was blocked by the user"
+            }, status=403)
+
+        if method == "copyMessage":
+            result = {"message_id": self._message(chat_id)["message_id"]}
+        elif method in ("copyMessages", "forwardMessages"):
+            count = len(json.loads(params["message_ids"]))
+            result = [{"message_id": self._message(chat_id)["message_id"]} for _ in range(count)]
+        elif method in ("forwardMessage", "sendMessage"):
+            result = self._message(chat_id)
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
@@ -0,0 +1,241 @@
+"""
+Replays recorded traffic against the bot.
+
+Feeds the updates of a recording made with RECORD_UPDATES=<file> through the
+real dispatcher, middlewares and handlers, and delivers the resulting jobs
+through a local fake Bot API server, so no Telegram access is needed. The
+updates are played back at their recorded pace, N times faster, or as fast
+as possible. Reports the handler latency distribution, event-loop lag and
+the API calls made by method.
+
+Usage:
+  python benchmarks/replay.py updates.jsonl.gz --speed 1
+  python benchmarks/replay.py updates.jsonl.gz --speed 10 --subscribers 10000 --latency 0.02
+  python benchmarks/replay.py updates.jsonl.gz --speed 0
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Set
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram import Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+import fanout
+from albums import AlbumAggregator
+from benchmarks.bench_broadcast import CHANNEL_ID, percentile
+from benchmarks.fake_api import FakeBotAPI
+from bot import enqueue_album, register_handlers
+from dedup import duplicate_filter_from_env
+from delivery import process_job
+from delivery_queue import DeliveryWorkers, open_queue
+from flood import flood_control_from_env
+from lifecycle import BackgroundTasks
+from metrics import MetricsMiddleware
+from recording import read_recording
+from registry import open_registry
+
+
+# Measures how late the event loop runs a timer:
+class LoopLagMonitor:
+    """
+    Sleeps for `interval` seconds in a loop and records how much later than
+    requested each wake-up came, which is how long the loop was blocked.
+    """
+
+    def __init__(self, interval: float = 0.01) -> None:
+        self.interval = interval
+        self.lags: List[float] = []
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, time.perf_counter() - started - self.interval))
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+
+def distribution(values: List[float]) -> Dict[str, float]:
+    return {
+        "p50": percentile(values, 0.5),
+        "p90": percentile(values, 0.9),
+        "p99": percentile(values, 0.99),
+        "max": max(values, default=0.0)
+    }
+
+
+async def replay(args: argparse.Namespace) -> Dict[str, Any]:
+    workdir = tempfile.mkdtemp(prefix="replay-")
+    os.environ["DATA_DIR"] = os.path.join(workdir, "data")
+    os.environ["USERS_FILE"] = os.path.join(workdir, "users.json")
+    os.environ["USER_STORAGE"] = "sqlite"
+    os.environ["BROADCAST_CONCURRENCY"] = str(args.concurrency)
+    os.environ["GLOBAL_RATE_LIMIT"] = str(args.global_rate)
+    os.environ["PER_CHAT_RATE_LIMIT"] = str(args.per_chat_rate)
+    # Subscribers besides the recorded users, who register with /start as they did live
+    with open(os.environ["USERS_FILE"], "w") as file:
+        json.dump(list(range(1, args.subscribers + 1)), file)
+
+    api = FakeBotAPI(latency=args.latency)
+    base_url = await api.start()
+    bot = Bot(token="123456:REPLAY", session=AiohttpSession(api=TelegramAPIServer.from_base(base_url)))
+
+    fanout._engine = None
+    registry = open_registry()
+    fanout.get_engine().add_observer(registry.record_delivery)
+    queue = open_queue()
+    duplicates = duplicate_filter_from_env()
+    background = BackgroundTasks()
+    albums = AlbumAggregator(
+        lambda messages: enqueue_album(queue, duplicates, background, messages),
+        window=float(os.getenv("ALBUM_WINDOW", "1.0"))
+    )
+
+    # The same middlewares and handlers as bot.main
+    dp = Dispatcher()
+    dp.message.middleware(MetricsMiddleware())
+    flood_control = flood_control_from_env()
+    if flood_control is not None:
+        dp.message.middleware(flood_control)
+    dp["registry"] = registry
+    dp["queue"] = queue
+    dp["duplicates"] = duplicates
+    dp["albums"] = albums
+    register_handlers(dp, bot)
+    workers = DeliveryWorkers(
+        queue,
+        lambda job_id, payload, progress: process_job(bot, registry, CHANNEL_ID, job_id, payload, progress),
+        count=args.workers,
+        poll_interval=0.05
+    )
+    workers.start()
+    monitor = LoopLagMonitor()
+    monitor.start()
+
+    latencies: List[float] = []
+    errors = 0
+
+    async def handle(update: types.Update) -> None:
+        nonlocal errors
+        started = time.perf_counter()
+        try:
+            await dp.feed_update(bot, update)
+        except Exception:
+            errors += 1
+        latencies.append(time.perf_counter() - started)
+
+    # Each update is handled in its own task, as polling does
+    tasks: Set[asyncio.Task] = set()
+    count = 0
+    started = time.monotonic()
+    for offset, data in read_recording(args.recording):
+        if args.limit and count >= args.limit:
+            break
+        if args.speed:
+            delay = started + offset / args.speed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        update = types.Update.model_validate(data, context={"bot": bot})
+        task = asyncio.create_task(handle(update))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        count += 1
+        if not args.speed:
+            # Let the handlers run between updates rather than queueing them all at once
+            await asyncio.sleep(0)
+    await asyncio.gather(*tasks)
+    fed = time.monotonic()
+
+    # Queue buffered albums and wait for the deliveries to finish
+    albums.flush_all()
+    deadline = time.monotonic() + args.timeout
+    while time.monotonic() < deadline:
+        stats = queue.stats()
+        if not stats["pending"] and not stats["running"]:
+            break
+        await asyncio.sleep(0.05)
+    finished = time.monotonic()
+
+    await monitor.stop()
+    await workers.stop()
+    await background.cancel()
+    registry.close()
+    queue.close()
+    await bot.session.close()
+    await api.stop()
+
+    return {
+        "updates": count,
+        "handler_errors": errors,
+        "speed": args.speed or "max",
+        "feed_seconds": fed - started,
+        "drain_seconds": finished - fed,
+        "updates_per_second": count / max(fed - started, 1e-9),
+        "handler_latency": distribution(latencies),
+        "loop_lag": distribution(monitor.lags),
+        "api_calls": sum(api.calls.values()),
+        "calls_by_method": dict(sorted(api.calls.items(), key=lambda item: -item[1]))
+    }
+
+
+def print_report(result: Dict[str, Any]) -> None:
+    def ms(values: Dict[str, float]) -> str:
+        return ", ".join(f"{name} {value * 1000:.1f} ms" for name, value in values.items())
+
+    print(
+        f"Replayed {result['updates']} updates at speed {result['speed']} in {result['feed_seconds']:.2f}s "
+        f"({result['updates_per_second']:.0f}/s), deliveries drained {result['drain_seconds']:.2f}s later"
+    )
+    if result["handler_errors"]:
+        print(f"Handler errors:  {result['handler_errors']}")
+    print(f"Handler latency: {ms(result['handler_latency'])}")
+    print(f"Event-loop lag:  {ms(result['loop_lag'])}")
+    print(f"API calls:       {result['api_calls']}")
+    for method, calls in result["calls_by_method"].items():
+        print(f"  {method:<20} {calls:>9}")
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay recorded updates against a fake Bot API")
+    parser.add_argument("recording", help="File written with RECORD_UPDATES")
+    parser.add_argument("--speed", type=float, default=1.0, help="Playback speed (1 = as recorded, 0 = as fast as possible)")
+    parser.add_argument("--limit", type=int, default=0, help="Replay at most this many updates")
+    parser.add_argument("--subscribers", type=int, default=1000, help="Subscribers registered before the replay")
+    parser.add_argument("--latency", type=float, default=0.0, help="Fake API latency per request, seconds")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--global-rate", type=float, default=1e9, help="GLOBAL_RATE_LIMIT (unlimited by default)")
+    parser.add_argument("--per-chat-rate", type=float, default=1e9, help="PER_CHAT_RATE_LIMIT (unlimited by default)")
+    parser.add_argument("--timeout", type=float, default=3600, help="How long to wait for deliveries to drain")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    parser.add_argument("--verbose", action="store_true", help="Show the bot's warning and error logs")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    if not args.verbose:
+        logging.disable(logging.ERROR)
+
+    result = await replay(args)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,36 +1,57 @@
+# Taken before the other imports so the startup timings include them
+import time
+STARTED_AT = time.perf_counter()
+
 from aiogram import Bot, Dispatcher, types
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 from aiogram.types import ContentType, BotCommand, BotCommandScopeDefault
+from typing import List, Optional
 import asyncio
 import logging
 import os
 from dotenv import load_dotenv
+from fanout import get_engine
+from delivery_queue import DeliveryQueue, DeliveryWorkers, open_queue
+from registry import SubscriberRegistry, open_registry
+from albums import AlbumAggregator
+from dedup import DuplicateFilter, duplicate_filter_from_env
+from webhook import run_webhook
+from cluster import ClusterSupervisor
+from copies import CopyIndex, open_copy_index
+from digest import DigestStore, open_digest
+from delivery import (
+    MEDIA_CONTENT_TYPES,
+    announce_status,
+    enqueue_announce,
+    enqueue_edit,
+    enqueue_messages,
+    enqueue_retract,
+    process_job,
+    schedule_digests
+)
+from flood import flood_control_from_env
+from lifecycle import BackgroundTasks, InFlightUpdates, StartupTimer, install_stop_handlers, wait_for_stop
+from logging_setup import setup_logging, stop_logging
+from loop_watchdog import LoopWatchdog, SlowHandlerMiddleware, SlowRequestMiddleware, watchdog_from_env
+from metrics import MetricsMiddleware, start_metrics_server, watch_queue
+from recording import recorder_from_env
 from utils import (
-    send_to_channel, 
-    broadcast_message, 
-    load_users, 
-    register_user,
-    send_photo_to_channel,
-    broadcast_photo,
-    broadcast_forwarded_message,
-    send_sticker_to_channel,
-    broadcast_sticker,
-    send_video_note_to_channel,
-    broadcast_video_note
+    COPYABLE_CONTENT_TYPES,
+    resolve_channel_id,
+    is_admin
 )
 
 
 # Handler for the /start command:
-async def start_handler(message: types.Message) -> None:
+async def start_handler(message: types.Message, registry: SubscriberRegistry) -> None:
     """
     Handles the /start command:
-    - Registers the user.
+    - Registers the user and records their activity.
     - Sends a welcome message.
     """
     if message.from_user:
-        user_id = message.from_user.id
-        users = load_users()
-        users = register_user(users, user_id)
+        registry.register(message.from_user.id)
+        registry.touch(message.from_user.id)
         
         await message.answer(
             "👋 <b>Добро пожаловать в Анонимный Чат-бот!</b>\n\n"
@@ -89,243 +110,234 @@ async def test_channel_handler(message: types.Message, bot: Bot) -> None:
     except Exception as e:
         await message.answer(f"Channel test failed: {str(e)}")
 
+DUPLICATE_REPLY = "This was already sent recently, so it was not delivered again."
+
+# Queues an album collected by the aggregator:
+def enqueue_album(
+    queue: DeliveryQueue,
+    duplicates: Optional[DuplicateFilter],
+    background: BackgroundTasks,
+    messages: List[types.Message]
+) -> None:
+    # Called from a timer, so the reply runs as a background task
+    if enqueue_messages(queue, messages, duplicates) is None:
+        background.run("duplicate_reply", messages[0].answer(DUPLICATE_REPLY))
+
 # Handler for regular messages:
-async def message_handler(message: types.Message, bot: Bot) -> None:
+async def message_handler(
+    message: types.Message,
+    bot: Bot,
+    queue: DeliveryQueue,
+    registry: SubscriberRegistry,
+    albums: AlbumAggregator,
+    duplicates: Optional[DuplicateFilter] = None
+) -> None:
     """
     Handles incoming messages:
-    - Ensures the user is registered.
-    - Forwards the message to the channel.
-    - Broadcasts the message to all active users (excluding the sender).
+    - Ensures the user is registered and records their activity.
+    - Rejects content types that cannot be copied.
+    - Collects the items of an album so it is delivered as a whole.
+    - Drops content that was already sent recently.
+    - Enqueues a delivery job; the channel post and the broadcast to all
+      active users (excluding the sender) are done by the delivery workers.
     """
     try:
         # Log the message content type
         content_type = message.content_type if hasattr(message, 'content_type') else "unknown"
-        logging.info(f"Received message with content_type: {content_type}")
-        
-        # Check if it's a forwarded message
-        is_forwarded = bool(message.forward_from or message.forward_from_chat)
-        logging.info(f"Is forwarded message: {is_forwarded}")
-        
-        # Check message properties
-        has_photo = bool(message.photo)
-        has_text = bool(message.text)
-        logging.info(f"Message properties - has_photo: {has_photo}, has_text: {has_text}")
+        logging.debug(f"Received message with content_type: {content_type}")
         
         if not message.from_user:
             await message.answer("Error: Could not identify user. Please try again.")
             return
             
         user_id = message.from_user.id
-        users = load_users()
-        users = register_user(users, user_id)
-        
-        channel_id = os.getenv("CHANNEL_ID")
-        if not channel_id:
-            logging.error("CHANNEL_ID not found in environment variables")
-            return
-        
-        # Convert channel_id to int
-        try:
-            channel_id_int = int(channel_id)
-        except ValueError:
-            logging.error(f"Invalid channel ID: {channel_id}")
-            return
-        
-        # Handle forwarded messages
-        if is_forwarded:
-            logging.info("Processing forwarded message")
-            user_comment = ""
-            comment_entities = None
-            
-            # If there's additional caption/text from the user, extract it
-            if message.caption and not message.forward_from_chat:
-                user_comment = message.caption
-                comment_entities = message.caption_entities
-                logging.info(f"Forwarded message has caption with {len(comment_entities) if comment_entities else 0} formatting entities")
-            elif message.text and not message.forward_from_chat and content_type == 'text':
-                # For text messages, we can't easily separate user comments from forwarded text
-                # The whole text is considered part of the forwarded message
-                pass
-            
-            # First, send the user's comment anonymously (if any)
-            if user_comment:
-                try:
-                    logging.info(f"Sending user comment to channel: {user_comment}")
-                    await send_to_channel(bot, channel_id_int, user_comment, entities=comment_entities)
-                    await broadcast_message(bot, users, user_id, user_comment, entities=comment_entities)
-                except Exception as e:
-                    logging.error(f"Failed to send user comment: {e}")
-            
-            # Forward original message to channel with attribution preserved
-            try:
-                logging.info(f"Forwarding message to channel {channel_id_int}")
-                await bot.forward_message(
-                    chat_id=channel_id_int,
-                    from_chat_id=message.chat.id,
-                    message_id=message.message_id
-                )
-            except Exception as e:
-                logging.error(f"Failed to forward message to channel: {e}")
-            
-            # Broadcast to other users
-            try:
-                logging.info(f"Broadcasting forwarded message to other users")
-                await broadcast_forwarded_message(
-                    bot, 
-                    users, 
-                    user_id, 
-                    message.chat.id, 
-                    message.message_id
-                )
-            except Exception as e:
-                logging.error(f"Failed to broadcast forwarded message: {e}")
-            
-            return
-            
-        # Handle photo messages - use content_type check as primary
-        elif content_type == 'photo' or message.photo:
-            logging.info("Processing photo message")
-            # Check if photo is not empty
-            if not message.photo:
-                logging.error("Photo is empty despite content_type being 'photo'")
-                return
-                
-            # Get the largest photo available (best quality)
-            photo = message.photo[-1]
-            photo_file_id = photo.file_id
-            caption = message.caption or ""
-            caption_entities = message.caption_entities  # Extract caption entities for formatting
-            logging.info(f"Received photo from user {user_id} with file_id: {photo_file_id}, caption: {caption}")
-            logging.info(f"Caption has {len(caption_entities) if caption_entities else 0} formatting entities")
-            
-            # Forward to channel
-            try:
-                logging.info(f"Sending photo to channel {channel_id_int}")
-                await send_photo_to_channel(
-                    bot, 
-                    channel_id_int, 
-                    photo_file_id, 
-                    caption=caption,
-                    caption_entities=caption_entities
-                )
-                logging.info("Photo sent to channel successfully")
-            except Exception as e:
-                logging.error(f"Failed to send photo to channel: {e}")
-            
-            # Broadcast to other users
-            try:
-                logging.info(f"Broadcasting photo to {len(users)} users")
-                await broadcast_photo(
-                    bot, 
-                    users, 
-                    user_id, 
-                    photo_file_id, 
-                    caption=caption,
-                    caption_entities=caption_entities
-                )
-                logging.info("Photo broadcast to users successfully")
-            except Exception as e:
-                logging.error(f"Failed to broadcast photo: {e}")
-            
-            return
-        
-        # Handle text messages
-        elif content_type == 'text' or message.text:
-            logging.info("Processing text message")
-            # Ensure text is not None
-            if not message.text:
-                logging.error("Text is empty despite content_type being 'text'")
-                return
-                
-            text = message.text
-            entities = message.entities  # Extract message entities for formatting
-            logging.info(f"Message has {len(entities) if entities else 0} formatting entities")
-            
-            # Forward to channel
-            try:
-                logging.info(f"Forwarding message to channel {channel_id}")
-                await send_to_channel(bot, channel_id_int, text, entities=entities)
-            except Exception as e:
-                logging.error(f"Failed to send message to channel: {e}")
-            
-            # Broadcast to other users
-            await broadcast_message(bot, users, user_id, text, entities=entities)
-            
-            return
+        registry.register(user_id)
+        # Recent posters are delivered to first
+        registry.touch(user_id)
         
-        # Handle sticker messages
-        elif content_type == 'sticker' or message.sticker:
-            logging.info("Processing sticker message")
-            
-            # Check if sticker is not empty
-            if not message.sticker:
-                logging.error("Sticker is empty despite content_type being 'sticker'")
-                return
-            
-            # Get sticker file_id
-            sticker_file_id = message.sticker.file_id
-            logging.info(f"Received sticker from user {user_id} with file_id: {sticker_file_id}")
-            
-            # Forward to channel
-            try:
-                logging.info(f"Sending sticker to channel {channel_id_int}")
-                await send_sticker_to_channel(bot, channel_id_int, sticker_file_id)
-                logging.info("Sticker sent to channel successfully")
-            except Exception as e:
-                logging.error(f"Failed to send sticker to channel: {e}")
-            
-            # Broadcast to other users
-            try:
-                logging.info(f"Broadcasting sticker to {len(users)} users")
-                await broadcast_sticker(bot, users, user_id, sticker_file_id)
-                logging.info("Sticker broadcast to users successfully")
-            except Exception as e:
-                logging.error(f"Failed to broadcast sticker: {e}")
-            
+        is_forwarded = bool(message.forward_from or message.forward_from_chat)
+        if not is_forwarded and content_type not in COPYABLE_CONTENT_TYPES:
+            logging.info(f"Unsupported message type received: {content_type}")
+            await message.answer("Sorry, this type of message cannot be forwarded.")
             return
         
-        # Handle video notes (circle messages)
-        elif content_type == 'video_note' or hasattr(message, 'video_note') and message.video_note:
-            logging.info("Processing video note (circle message)")
-            
-            # Check if video note is not empty
-            if not message.video_note:
-                logging.error("Video note is empty despite content_type being 'video_note'")
-                return
-            
-            # Get video note file_id
-            video_note_file_id = message.video_note.file_id
-            logging.info(f"Received video note from user {user_id} with file_id: {video_note_file_id}")
-            
-            # Forward to channel
-            try:
-                logging.info(f"Sending video note to channel {channel_id_int}")
-                await send_video_note_to_channel(bot, channel_id_int, video_note_file_id)
-                logging.info("Video note sent to channel successfully")
-            except Exception as e:
-                logging.error(f"Failed to send video note to channel: {e}")
-            
-            # Broadcast to other users
-            try:
-                logging.info(f"Broadcasting video note to {len(users)} users")
-                await broadcast_video_note(bot, users, user_id, video_note_file_id)
-                logging.info("Video note broadcast to users successfully")
-            except Exception as e:
-                logging.error(f"Failed to broadcast video note: {e}")
-            
+        # Album items are collected and queued together as one job
+        if message.media_group_id:
+            albums.add(message)
             return
         
-        # Handle other message types (not supported)
-        else:
-            logging.info(f"Unsupported message type received: {content_type}")
-            await message.answer("Sorry, I can only forward text, photos, stickers, video notes, and forwarded messages at this time.")
+        if enqueue_messages(queue, [message], duplicates) is None:
+            await message.answer(DUPLICATE_REPLY)
     
     except Exception as e:
-        logging.error(f"Error processing message: {e}")
-        import traceback
-        traceback.print_exc()
+        logging.exception(f"Error processing message: {e}", extra={"event": "handler_failed"})
         await message.answer("An error occurred while processing your message. Please try again later.")
 
+# Handler for edited messages:
+async def edited_message_handler(
+    message: types.Message,
+    queue: DeliveryQueue,
+    copies: Optional[CopyIndex] = None,
+    digest: Optional[DigestStore] = None
+) -> None:
+    """
+    Queues the new text or caption of an edited message for every copy
+    already delivered, and updates the text post if it is waiting for the
+    next digest. Messages not delivered yet need nothing: their copies are
+    made from the current version.
+    """
+    if not message.from_user:
+        return
+    if digest is not None and message.text is not None:
+        digest.update(
+            message.chat.id, message.message_id, message.text,
+            [entity.model_dump(mode="json", exclude_none=True) for entity in message.entities or []]
+        )
+    if copies is None:
+        return
+    # Live location updates also arrive as edits; only text and captions are propagated
+    if message.text is None and message.content_type not in MEDIA_CONTENT_TYPES:
+        return
+    if not copies.has_copies(message.chat.id, message.message_id):
+        return
+    enqueue_edit(queue, message)
+
+# Handler for the /retract command:
+async def retract_handler(
+    message: types.Message,
+    queue: DeliveryQueue,
+    copies: Optional[CopyIndex] = None,
+    duplicates: Optional[DuplicateFilter] = None
+) -> None:
+    """
+    Deletes the replied-to message of the user's (or its whole album) from
+    the channel and from every recipient, and cancels its deliveries that
+    have not started yet. The message no longer counts as recent content,
+    so it can be sent again.
+    """
+    original = message.reply_to_message
+    if not message.from_user or original is None or original.from_user is None or original.from_user.id != message.from_user.id:
+        await message.answer("Reply with /retract to one of your own messages to delete it everywhere.")
+        return
+    if copies is None:
+        await message.answer("Retracting messages is not available.")
+        return
+    
+    enqueue_retract(queue, message.from_user.id, message.chat.id, original.message_id)
+    if duplicates is not None:
+        duplicates.forget([original])
+    await message.answer("Your message will be deleted from the channel and from all recipients.")
+
+# Handler for the /digest command:
+async def digest_handler(message: types.Message, registry: SubscriberRegistry, digest: Optional[DigestStore] = None) -> None:
+    """
+    Switches the user between a message per post and a periodic digest of
+    the posts.
+    """
+    if not message.from_user:
+        return
+    if digest is None:
+        await message.answer("Digests are not available.")
+        return
+    registry.register(message.from_user.id)
+    if digest.toggle(message.from_user.id):
+        minutes = float(os.getenv("DIGEST_INTERVAL_MINUTES", "60"))
+        await message.answer(
+            f"You will get a digest of new posts every {minutes:g} minutes instead of each post. "
+            "Send /digest again to switch back."
+        )
+    else:
+        await message.answer("You will get every post as it is sent again.")
+
+# Handler for the /announce command:
+async def announce_handler(
+    message: types.Message,
+    command: CommandObject,
+    queue: DeliveryQueue,
+    registry: SubscriberRegistry
+) -> None:
+    """
+    Sends the replied-to message to every subscriber, with a status message
+    that is kept up to date with the progress (admin only).
+    `/announce pause`, `/announce resume` and `/announce cancel` control the
+    announcements in progress.
+    """
+    if not message.from_user or not is_admin(message.from_user.id):
+        await message.answer("This command is only available to admins.")
+        return
+    
+    action = (command.args or "").strip().lower()
+    if action:
+        if action not in ("pause", "resume", "cancel"):
+            await message.answer("Usage: reply to a message with /announce, or /announce pause|resume|cancel.")
+            return
+        count = queue.control_announcements(action)
+        await message.answer(f"Announcements affected by {action}: {count}")
+        return
+    
+    original = message.reply_to_message
+    if original is None:
+        await message.answer("Reply with /announce to the message to send to every subscriber.")
+        return
+    total = len(registry) - (message.from_user.id in registry)
+    status = await message.answer(announce_status("queued", 0, 0, total))
+    enqueue_announce(queue, message.from_user.id, original, status)
+
+# Handler for the /queue command:
+async def queue_handler(message: types.Message, queue: DeliveryQueue) -> None:
+    """
+    Shows the outbound delivery queue depth and lag (admin only).
+    """
+    if not message.from_user or not is_admin(message.from_user.id):
+        await message.answer("This command is only available to admins.")
+        return
+    
+    stats = queue.stats()
+    await message.answer(
+        f"Pending jobs: {stats['pending']}\n"
+        f"Running jobs: {stats['running']}\n"
+        f"Lag: {stats['lag']:.1f}s"
+    )
+
+# Handler for the /broadcasts command:
+async def broadcasts_handler(message: types.Message, queue: DeliveryQueue) -> None:
+    """
+    Shows the progress of broadcasts in flight, as of their last checkpoint
+    (admin only).
+    """
+    if not message.from_user or not is_admin(message.from_user.id):
+        await message.answer("This command is only available to admins.")
+        return
+    
+    broadcasts = queue.broadcasts()
+    if not broadcasts:
+        await message.answer("No broadcasts in progress.")
+        return
+    
+    lines = []
+    for broadcast in broadcasts:
+        percent = 100 * broadcast["position"] / broadcast["total"] if broadcast["total"] else 100
+        lines.append(
+            f"Job {broadcast['job_id']} ({broadcast['step']}): {percent:.0f}% "
+            f"({broadcast['position']}/{broadcast['total']}), "
+            f"sent {broadcast['sent']}, failed {broadcast['failed']}"
+        )
+    await message.answer("\n".join(lines))
+
+# Handler for the /watchdog command:
+async def watchdog_handler(message: types.Message, watchdog: Optional[LoopWatchdog] = None) -> None:
+    """
+    Shows event-loop stalls and the slowest handlers and API calls (admin only).
+    """
+    if not message.from_user or not is_admin(message.from_user.id):
+        await message.answer("This command is only available to admins.")
+        return
+    
+    if watchdog is None:
+        await message.answer("The watchdog is disabled (WATCHDOG_STALL_THRESHOLD=0).")
+        return
+    await message.answer(watchdog.report())
+
 # Set bot commands and description
 async def set_bot_commands(bot: Bot) -> None:
     """
@@ -333,7 +345,13 @@ async def set_bot_commands(bot: Bot) -> None:
     """
     commands = [
         BotCommand(command="start", description="Register with the bot and see welcome message"),
-        BotCommand(command="testchannel", description="Test the connection to the channel (admin only)")
+        BotCommand(command="retract", description="Reply to your message to delete it everywhere"),
+        BotCommand(command="digest", description="Get a periodic digest instead of every post"),
+        BotCommand(command="announce", description="Reply to a message to send it to everyone (admin only)"),
+        BotCommand(command="testchannel", description="Test the connection to the channel (admin only)"),
+        BotCommand(command="queue", description="Show delivery queue depth and lag (admin only)"),
+        BotCommand(command="broadcasts", description="Show progress of broadcasts in flight (admin only)"),
+        BotCommand(command="watchdog", description="Show event-loop stalls and slow calls (admin only)")
     ]
     
     await bot.set_my_commands(commands, scope=BotCommandScopeDefault())
@@ -342,22 +360,37 @@ async def set_bot_commands(bot: Bot) -> None:
 # Function to register all handlers with the Dispatcher:
 def register_handlers(dp: Dispatcher, bot: Bot) -> None:
     """
-    Registers the message handlers (start and message) with the Dispatcher.
+    Registers the message handlers (start, message and edited message) with the Dispatcher.
     """
     # Register commands
     dp.message(Command("start"))(start_handler)
+    dp.message(Command("retract"))(retract_handler)
+    dp.message(Command("digest"))(digest_handler)
     
     # Fix: Create a wrapper function for testchannel that properly awaits
     @dp.message(Command("testchannel"))
     async def testchannel_wrapper(message: types.Message):
         await test_channel_handler(message, bot)
     
+    dp.message(Command("announce"))(announce_handler)
+    dp.message(Command("queue"))(queue_handler)
+    dp.message(Command("broadcasts"))(broadcasts_handler)
+    dp.message(Command("watchdog"))(watchdog_handler)
+    
     # Fix: Create separate wrappers for different message types
     # This ensures message types are correctly identified
     @dp.message()
-    async def message_wrapper(message: types.Message):
-        logging.info(f"Received message in wrapper with content_type: {message.content_type}")
-        await message_handler(message, bot)
+    async def message_wrapper(
+        message: types.Message,
+        queue: DeliveryQueue,
+        registry: SubscriberRegistry,
+        albums: AlbumAggregator,
+        duplicates: Optional[DuplicateFilter] = None
+    ):
+        logging.debug(f"Received message in wrapper with content_type: {message.content_type}")
+        await message_handler(message, bot, queue, registry, albums, duplicates)
+    
+    dp.edited_message()(edited_message_handler)
 
 # Main function as the entry point:
 async def main() -> None:
@@ -366,23 +399,22 @@ async def main() -> None:
     - Initializes logging.
     - Instantiates the Bot and Dispatcher.
     - Registers handlers.
-    - Starts the polling loop.
+    - Starts the delivery workers and the metrics endpoint.
+    - Starts the polling loop, or the webhook server if BOT_MODE=webhook,
+      while the registry loads and the bot commands are set in the
+      background; the time taken by each startup phase is logged.
+    - On SIGTERM or SIGINT, stops taking updates, drains the delivery
+      workers for up to SHUTDOWN_TIMEOUT seconds and closes everything.
     """
+    timer = StartupTimer(STARTED_AT)
+    timer.record("imports", time.perf_counter() - STARTED_AT)
+    
     # Load environment variables
     load_dotenv()
     
-    # Ensure logs directory exists
-    os.makedirs("/logs", exist_ok=True)
-    
-    # Configure logging to both console and file
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-        handlers=[
-            logging.StreamHandler(),  # Console handler
-            logging.FileHandler("/logs/bot.log")  # File handler with absolute path
-        ]
-    )
+    # Configure logging to both console and file (written by a background thread)
+    with timer.phase("logging"):
+        setup_logging()
     
     logging.info("Starting Telegram Anonymous Bot...")
     
@@ -392,19 +424,157 @@ async def main() -> None:
         logging.error("BOT_TOKEN not found in environment variables")
         return
     
+    # Resolve the channel ID once; deliveries use the normalised value
+    try:
+        channel_id = resolve_channel_id(os.getenv("CHANNEL_ID", ""))
+    except ValueError:
+        logging.error(f"CHANNEL_ID is missing or invalid: {os.getenv('CHANNEL_ID')}")
+        return
+    
     # Initialize bot and dispatcher with parse_mode to handle all message types
     bot = Bot(token=bot_token)
     dp = Dispatcher()
+    in_flight = InFlightUpdates(on_update=timer.first_update)
+    dp.update.outer_middleware(in_flight)
+    recorder = recorder_from_env()
+    if recorder is not None:
+        dp.update.outer_middleware(recorder)
+    dp.message.middleware(MetricsMiddleware())
+    flood_control = flood_control_from_env()
+    if flood_control is not None:
+        dp.message.middleware(flood_control)
+        # Each edit is fanned out to every copy, so edits count too
+        dp.edited_message.middleware(flood_control)
+    # Flags loop stalls and slow handlers and API calls
+    watchdog = watchdog_from_env()
+    if watchdog is not None:
+        watchdog.start()
+        dp.message.middleware(SlowHandlerMiddleware(watchdog))
+        bot.session.middleware(SlowRequestMiddleware(watchdog))
+    dp["watchdog"] = watchdog
     
-    # Set bot commands
-    await set_bot_commands(bot)
+    # One-off setup calls run alongside polling rather than before it
+    background = BackgroundTasks()
+    background.run("set_bot_commands", set_bot_commands(bot))
+    
+    # Open the subscriber registry and the outbound delivery queue, and make
+    # both available to handlers. The users are loaded in the background so
+    # updates are taken right away; deliveries wait until the load is done
+    with timer.phase("registry"):
+        registry = open_registry(load=False)
+    background.run("registry_load", registry.load_async())
+    get_engine().add_observer(registry.record_delivery)
+    cluster_workers = int(os.getenv("CLUSTER_WORKERS", "0"))
+    if cluster_workers > 1 and os.getenv("USER_STORAGE", "sqlite") != "sqlite":
+        logging.error("CLUSTER_WORKERS requires USER_STORAGE=sqlite")
+        return
+    with timer.phase("queue"):
+        queue = open_queue(partitions=max(1, cluster_workers))
+    watch_queue(queue)
+    # Finished jobs are kept a while for inspection, then deleted
+    background.run("queue_prune", queue.prune_every(float(os.getenv("QUEUE_RETENTION_HOURS", "24")) * 3600))
+    dp["registry"] = registry
+    dp["queue"] = queue
+    duplicates = duplicate_filter_from_env()
+    dp["duplicates"] = duplicates
+    albums = AlbumAggregator(
+        lambda messages: enqueue_album(queue, duplicates, background, messages),
+        window=float(os.getenv("ALBUM_WINDOW", "1.0"))
+    )
+    dp["albums"] = albums
+    # Where every message was delivered, so edits can follow it
+    copies = open_copy_index()
+    dp["copies"] = copies
+    # Digest subscriptions, and the posts waiting for the next digest
+    digest = open_digest()
+    dp["digest"] = digest
+    background.run("digests", schedule_digests(queue, digest, float(os.getenv("DIGEST_INTERVAL_MINUTES", "60")) * 60))
     
     # Register handlers
     register_handlers(dp, bot)
     
-    # Start polling with allowed updates to ensure all message types are received
+    # Start the workers that drain the delivery queue: in this process, or
+    # in one process per subscriber partition when CLUSTER_WORKERS > 1
+    if cluster_workers > 1:
+        with timer.phase("recover"):
+            queue.recover()
+        workers = ClusterSupervisor(cluster_workers)
+        # Users deactivated by the delivery processes must be seen here, or
+        # they could not register again by writing to the bot
+        background.run("registry_refresh", registry.refresh_every(float(os.getenv("REGISTRY_REFRESH_INTERVAL", "5"))))
+    else:
+        workers = DeliveryWorkers(
+            queue,
+            lambda job_id, payload, progress: process_job(bot, registry, channel_id, job_id, payload, progress, copies, digest),
+            count=int(os.getenv("DELIVERY_WORKERS", "4")),
+            checkpoint_every=int(os.getenv("BROADCAST_CHECKPOINT_EVERY", "100")),
+            per_sender=int(os.getenv("DELIVERY_JOBS_PER_SENDER", "1"))
+        )
+    with timer.phase("workers"):
+        workers.start()
+    
+    # Receive updates with allowed updates to ensure all message types are received
+    allowed_updates = ["message", "edited_message", "channel_post", "edited_channel_post"]
+    # In webhook mode /metrics is served by the webhook server itself
+    bot_mode = os.getenv("BOT_MODE", "polling")
+    metrics_port = os.getenv("METRICS_PORT")
+    metrics_runner = None
+    if metrics_port and bot_mode != "webhook":
+        metrics_runner = await start_metrics_server(int(metrics_port))
+    
+    # SIGTERM/SIGINT start a graceful shutdown instead of killing the process
+    stop = asyncio.Event()
+    install_stop_handlers(stop)
+    shutdown_timeout = float(os.getenv("SHUTDOWN_TIMEOUT", "30"))
+    
     logging.info("Bot is running. Press Ctrl+C to stop.")
-    await dp.start_polling(bot, allowed_updates=["message", "edited_message", "channel_post", "edited_channel_post"])
+    serving = None
+    try:
+        if bot_mode == "webhook":
+            serving = asyncio.create_task(run_webhook(dp, bot, allowed_updates))
+        else:
+            # A webhook left over from webhook mode would make polling fail,
+            # so this call stays ahead of it
+            with timer.phase("delete_webhook"):
+                await bot.delete_webhook()
+            # Signals are handled above, and the session is still needed
+            # to drain deliveries after polling stops
+            serving = asyncio.create_task(dp.start_polling(
+                bot, allowed_updates=allowed_updates, handle_signals=False, close_bot_session=False
+            ))
+        timer.report()
+        await wait_for_stop(stop, serving)
+    finally:
+        # Stop taking updates and let the ones being handled finish
+        if serving is not None and not serving.done():
+            if bot_mode == "webhook":
+                serving.cancel()
+            else:
+                await dp.stop_polling()
+            await asyncio.gather(serving, return_exceptions=True)
+        await in_flight.wait_idle(timeout=min(5.0, shutdown_timeout))
+        
+        # Queue buffered albums, then drain the outbound work; jobs that do
+        # not finish in time are checkpointed and resumed on the next start
+        albums.flush_all()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        if cluster_workers > 1:
+            await workers.stop(timeout=shutdown_timeout + 5.0)
+        else:
+            await workers.stop(timeout=shutdown_timeout)
+        await background.cancel()
+        if watchdog is not None:
+            await watchdog.stop()
+        if recorder is not None:
+            recorder.close()
+        queue.close()
+        copies.close()
+        digest.close()
+        registry.close()
+        await bot.session.close()
+        logging.info("Shutdown complete")
+        stop_logging()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,63 @@
+from collections import OrderedDict
+from typing import Any, Generic, Hashable, Optional, Tuple, TypeVar
+import time
+
+
+V = TypeVar("V")
+
+
+# Size-bounded cache whose entries expire:
+class TTLCache(Generic[V]):
+    """
+    A dict-like cache that keeps at most `maxsize` entries, each for `ttl`
+    seconds after it was last set.
+
+    Entries are kept in the order they were last set, which with a single
+    TTL is also the order they expire in, so expired and surplus entries are
+    dropped from the front in O(1) as new ones are added. Memory therefore
+    stays bounded however many distinct keys are seen.
+
+    Parameters:
+      maxsize: Maximum number of entries; the least recently set are
+        dropped first.
+      ttl: Lifetime of an entry in seconds.
+    """
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self.maxsize = max(1, maxsize)
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, Tuple[float, V]]" = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Optional[V]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        expires, value = entry
+        if expires <= time.monotonic():
+            del self._entries[key]
+            return default
+        return value
+
+    def set(self, key: Hashable, value: V) -> None:
+        now = time.monotonic()
+        self._entries.pop(key, None)
+        self._entries[key] = (now + self.ttl, value)
+        self._prune(now)
+
+    def pop(self, key: Hashable, default: Any = None) -> Optional[V]:
+        entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def _prune(self, now: float) -> None:
+        entries = self._entries
+        while entries:
+            expires, _ = next(iter(entries.values()))
+            if expires > now and len(entries) <= self.maxsize:
+                break
+            entries.popitem(last=False)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,151 @@
+from aiogram import Bot
+from dotenv import load_dotenv
+from typing import Any, Dict, List
+import asyncio
+import logging
+import multiprocessing
+import os
+
+from copies import open_copy_index
+from digest import open_digest
+from delivery import process_job
+from delivery_queue import DeliveryWorkers, JobProgress, open_queue
+from fanout import get_engine
+from lifecycle import install_stop_handlers
+from loop_watchdog import SlowRequestMiddleware, watchdog_from_env
+from metrics import start_metrics_server
+from registry import open_registry
+from logging_setup import setup_logging
+from utils import resolve_channel_id
+
+
+# Entry point of a delivery worker process:
+def worker_main(partition: int, partitions: int) -> None:
+    """
+    Runs the delivery workers for one subscriber partition. Started in a
+    separate process by ClusterSupervisor.
+    """
+    load_dotenv()
+    # Every process writes its own file; rotating a shared file is not process-safe
+    setup_logging(f"worker-{partition}")
+    try:
+        asyncio.run(run_worker(partition, partitions))
+    except KeyboardInterrupt:
+        pass
+
+async def run_worker(partition: int, partitions: int) -> None:
+    """
+    Drains the jobs of `partition` from the shared delivery queue.
+
+    Each process has its own Bot session, registry view and fan-out engine.
+    The registry is refreshed from the shared storage before every job so
+    users registered by the ingest process are included.
+    """
+    bot = Bot(token=os.getenv("BOT_TOKEN"))
+    channel_id = resolve_channel_id(os.getenv("CHANNEL_ID", ""))
+    registry = open_registry()
+    engine = get_engine()
+    engine.add_observer(registry.record_delivery)
+    # Telegram's global limit applies to the bot token, so the processes split it
+    engine.set_global_rate(float(os.getenv("GLOBAL_RATE_LIMIT", "25")) / partitions)
+    queue = open_queue()
+    copies = open_copy_index()
+    digest = open_digest()
+    watchdog = watchdog_from_env()
+    if watchdog is not None:
+        watchdog.start()
+        bot.session.middleware(SlowRequestMiddleware(watchdog))
+
+    async def process(job_id: int, payload: Dict[str, Any], progress: JobProgress) -> None:
+        registry.refresh()
+        await process_job(bot, registry, channel_id, job_id, payload, progress, copies, digest)
+
+    workers = DeliveryWorkers(
+        queue,
+        process,
+        count=int(os.getenv("DELIVERY_WORKERS", "4")),
+        checkpoint_every=int(os.getenv("BROADCAST_CHECKPOINT_EVERY", "100")),
+        per_sender=int(os.getenv("DELIVERY_JOBS_PER_SENDER", "1")),
+        poll_interval=float(os.getenv("CLUSTER_POLL_INTERVAL", "0.2")),
+        partition=partition
+    )
+    workers.start()
+    logging.info(f"Delivery worker for partition {partition + 1} of {partitions} started")
+    # Each process keeps its own send metrics, served on the ports after METRICS_PORT
+    metrics_runner = None
+    if os.getenv("METRICS_PORT"):
+        metrics_runner = await start_metrics_server(int(os.getenv("METRICS_PORT")) + 1 + partition)
+    # ClusterSupervisor.stop() sends SIGTERM; jobs in progress are drained
+    # for up to SHUTDOWN_TIMEOUT seconds, then checkpointed
+    stop = asyncio.Event()
+    install_stop_handlers(stop)
+    try:
+        await stop.wait()
+    finally:
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await workers.stop(timeout=float(os.getenv("SHUTDOWN_TIMEOUT", "30")))
+        queue.close()
+        copies.close()
+        digest.close()
+        registry.close()
+        if watchdog is not None:
+            await watchdog.stop()
+        await bot.session.close()
+
+
+# Starts and watches the delivery worker processes:
+class ClusterSupervisor:
+    """
+    Runs one delivery worker process per subscriber partition and restarts
+    any process that exits unexpectedly.
+
+    Parameters:
+      partitions: Number of worker processes (and subscriber partitions).
+      check_interval: How often processes are checked, in seconds.
+    """
+
+    def __init__(self, partitions: int, check_interval: float = 5.0) -> None:
+        self.partitions = partitions
+        self.check_interval = check_interval
+        self._context = multiprocessing.get_context("spawn")
+        self._processes: List[multiprocessing.Process] = []
+        self._watcher = None
+
+    def _spawn(self, partition: int) -> multiprocessing.Process:
+        process = self._context.Process(
+            target=worker_main,
+            args=(partition, self.partitions),
+            name=f"delivery-worker-{partition}",
+            daemon=True
+        )
+        process.start()
+        return process
+
+    def start(self) -> None:
+        self._processes = [self._spawn(partition) for partition in range(self.partitions)]
+        self._watcher = asyncio.create_task(self._watch())
+        logging.info(f"Started {self.partitions} delivery worker processes")
+
+    async def _watch(self) -> None:
+        while True:
+            await asyncio.sleep(self.check_interval)
+            for partition, process in enumerate(self._processes):
+                if not process.is_alive():
+                    logging.error(f"Delivery worker {partition} exited with code {process.exitcode}, restarting")
+                    self._processes[partition] = self._spawn(partition)
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """
+        Asks every worker process to shut down (SIGTERM) and waits up to
+        `timeout` seconds for each to exit.
+        """
+        if self._watcher is not None:
+            self._watcher.cancel()
+        for process in self._processes:
+            if process.is_alive():
+                process.terminate()
+        loop = asyncio.get_running_loop()
+        for process in self._processes:
+            await loop.run_in_executor(None, process.join, timeout)
+        self._processes = []
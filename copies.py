@@ -0,0 +1,219 @@
+from array import array
+from typing import Any, Iterable, List, Optional, Sequence, Tuple
+import logging
+import os
+import sqlite3
+import time
+
+
+# Kinds of delivered copies
+COPY = "copy"          # copy_message/copy_messages; editable
+FORWARD = "forward"    # forward_message/forward_messages
+COMMENT = "comment"    # the caption of a forward, sent as its own message
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS copies (
+    source_chat_id INTEGER NOT NULL,
+    source_message_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    pairs BLOB NOT NULL,
+    album_id INTEGER
+);
+CREATE INDEX IF NOT EXISTS copies_source ON copies (source_chat_id, source_message_id);
+CREATE INDEX IF NOT EXISTS copies_created ON copies (created_at);
+CREATE INDEX IF NOT EXISTS copies_album ON copies (source_chat_id, album_id);
+"""
+
+
+def pack_pairs(chat_ids: Sequence[int], message_ids: Sequence[int]) -> bytes:
+    """
+    Packs (chat_id, message_id) pairs into 12 bytes each: all chat IDs as
+    int64, then all message IDs as int32.
+    """
+    return array("q", chat_ids).tobytes() + array("i", message_ids).tobytes()
+
+
+def unpack_pairs(blob: bytes) -> List[Tuple[int, int]]:
+    count = len(blob) // 12
+    chat_ids = array("q")
+    chat_ids.frombytes(blob[:8 * count])
+    message_ids = array("i")
+    message_ids.frombytes(blob[8 * count:])
+    return list(zip(chat_ids, message_ids))
+
+
+def copied_ids(result: Any) -> List[int]:
+    """
+    Returns the message IDs from the result of a send: a list of IDs (copy
+    and forward helpers) or a Message.
+    """
+    if isinstance(result, list):
+        return result
+    message_id = getattr(result, "message_id", None)
+    return [message_id] if message_id is not None else []
+
+
+# Index from original messages to their delivered copies:
+class CopyIndex:
+    """
+    Remembers where every message was delivered, so edits and retractions
+    of the original can reach all of its copies.
+
+    Copies are stored in SQLite as packed blobs of (chat_id, message_id)
+    pairs, one row per batch of recipients of one original message, so a
+    broadcast to N users costs about 12 * N bytes on disk and nothing in
+    memory once written. Rows older than `retention` seconds are deleted
+    (Telegram only lets bots delete messages for 48 hours anyway).
+
+    Parameters:
+      path: Path to the SQLite database file.
+      retention: How long copies are remembered, in seconds.
+    """
+
+    def __init__(self, path: str, retention: float = 48 * 3600) -> None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.retention = retention
+        self.conn = sqlite3.connect(path, isolation_level=None, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self._pruned_at = 0.0
+
+    def recorder(self, source_chat_id: int, message_ids: List[int], kind: str) -> "CopyRecorder":
+        return CopyRecorder(self, source_chat_id, message_ids, kind)
+
+    def add(
+        self,
+        source_chat_id: int,
+        source_message_id: int,
+        kind: str,
+        pairs: List[Tuple[int, int]],
+        album_id: Optional[int] = None
+    ) -> None:
+        """
+        Stores a batch of copies of one original message. `album_id` (the
+        first message of the album, by default the message itself) groups
+        the items of an album.
+        """
+        if not pairs:
+            return
+        chat_ids, message_ids = zip(*pairs)
+        now = time.time()
+        self.conn.execute(
+            "INSERT INTO copies (source_chat_id, source_message_id, kind, created_at, pairs, album_id) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                source_chat_id, source_message_id, kind, now, pack_pairs(chat_ids, message_ids),
+                source_message_id if album_id is None else album_id
+            )
+        )
+        # Expired rows are deleted at most once an hour
+        if now - self._pruned_at > 3600:
+            self.prune()
+
+    def lookup(
+        self,
+        source_chat_id: int,
+        source_message_id: int,
+        kinds: Optional[Iterable[str]] = None
+    ) -> List[Tuple[int, int]]:
+        """
+        Returns the (chat_id, message_id) of every recorded copy of a message.
+        """
+        query = "SELECT kind, pairs FROM copies WHERE source_chat_id = ? AND source_message_id = ? AND created_at >= ?"
+        rows = self.conn.execute(query, (source_chat_id, source_message_id, time.time() - self.retention))
+        kinds = set(kinds) if kinds is not None else None
+        pairs: List[Tuple[int, int]] = []
+        for kind, blob in rows:
+            if kinds is None or kind in kinds:
+                pairs.extend(unpack_pairs(blob))
+        return pairs
+
+    def lookup_album(self, source_chat_id: int, source_message_id: int) -> List[Tuple[int, int]]:
+        """
+        Returns the (chat_id, message_id) of every copy of any kind of the
+        message and, if it is part of an album, of the rest of the album.
+        """
+        rows = self.conn.execute(
+            "SELECT pairs FROM copies WHERE source_chat_id = ? AND created_at >= ? AND album_id IN "
+            "(SELECT album_id FROM copies WHERE source_chat_id = ? AND source_message_id = ?)",
+            (source_chat_id, time.time() - self.retention, source_chat_id, source_message_id)
+        )
+        pairs: List[Tuple[int, int]] = []
+        for (blob,) in rows:
+            pairs.extend(unpack_pairs(blob))
+        return pairs
+
+    def forget_album(self, source_chat_id: int, source_message_id: int) -> None:
+        """
+        Drops the copies of the message and of the rest of its album.
+        """
+        self.conn.execute(
+            "DELETE FROM copies WHERE source_chat_id = ? AND album_id IN "
+            "(SELECT album_id FROM copies WHERE source_chat_id = ? AND source_message_id = ?)",
+            (source_chat_id, source_chat_id, source_message_id)
+        )
+
+    def has_copies(self, source_chat_id: int, source_message_id: int) -> bool:
+        return self.conn.execute(
+            "SELECT 1 FROM copies WHERE source_chat_id = ? AND source_message_id = ? AND created_at >= ? LIMIT 1",
+            (source_chat_id, source_message_id, time.time() - self.retention)
+        ).fetchone() is not None
+
+    def prune(self) -> None:
+        """
+        Deletes copies older than the retention period.
+        """
+        self._pruned_at = time.time()
+        deleted = self.conn.execute(
+            "DELETE FROM copies WHERE created_at < ?", (self._pruned_at - self.retention,)
+        ).rowcount
+        if deleted:
+            logging.info(f"Pruned {deleted} expired copy index rows")
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+# Collects the copies made by one delivery step:
+class CopyRecorder:
+    """
+    Buffers the copies of an original message or album as they are sent and
+    writes them to the index every `batch_size` recipients. Album items are
+    matched to their copies by position.
+    """
+
+    def __init__(self, index: CopyIndex, source_chat_id: int, message_ids: List[int], kind: str, batch_size: int = 1000) -> None:
+        self.index = index
+        self.source_chat_id = source_chat_id
+        self.message_ids = message_ids
+        self.kind = kind
+        self.batch_size = batch_size
+        self._pairs: List[List[Tuple[int, int]]] = [[] for _ in message_ids]
+
+    def add(self, chat_id: int, result: Any) -> None:
+        for pairs, copy_id in zip(self._pairs, copied_ids(result)):
+            pairs.append((chat_id, copy_id))
+        if len(self._pairs[0]) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        for message_id, pairs in zip(self.message_ids, self._pairs):
+            try:
+                self.index.add(self.source_chat_id, message_id, self.kind, pairs, album_id=self.message_ids[0])
+            except Exception as e:
+                logging.error(f"Error saving copies of message {message_id}: {e}")
+            pairs.clear()
+
+
+def open_copy_index() -> CopyIndex:
+    """
+    Opens the copy index in DATA_DIR, keeping copies for COPY_RETENTION_HOURS.
+    """
+    return CopyIndex(
+        os.path.join(os.getenv("DATA_DIR", "data"), "copies.db"),
+        retention=float(os.getenv("COPY_RETENTION_HOURS", "48")) * 3600
+    )
@@ -0,0 +1,108 @@
+from aiogram import types
+from typing import List, Optional
+import hashlib
+import os
+import re
+import unicodedata
+
+from cache import TTLCache
+
+
+_WHITESPACE = re.compile(r"\s+")
+# Zero-width characters often used to make copies look different
+_INVISIBLE = dict.fromkeys(map(ord, "\u200b\u200c\u200d\u2060\ufeff"))
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalises text so that copies differing only in case, spacing or
+    invisible characters compare equal.
+    """
+    text = unicodedata.normalize("NFKC", text).translate(_INVISIBLE)
+    return _WHITESPACE.sub(" ", text).strip().casefold()
+
+
+def _media_id(message: types.Message) -> Optional[str]:
+    media = (
+        message.sticker or message.animation or message.audio or message.document
+        or message.video or message.video_note or message.voice
+    )
+    if media is not None:
+        return media.file_unique_id
+    if message.photo:
+        return message.photo[-1].file_unique_id
+    return None
+
+
+def fingerprint(messages: List[types.Message]) -> Optional[str]:
+    """
+    Returns a fingerprint of a message or album: the file_unique_id of each
+    media item, or a hash of the normalised text. Returns None for content
+    that is not deduplicated (polls, dice, locations, ...).
+    """
+    parts = []
+    for message in messages:
+        media_id = _media_id(message)
+        if media_id is not None:
+            parts.append("m:" + media_id)
+        elif message.text:
+            parts.append("t:" + normalize_text(message.text))
+        else:
+            return None
+    return hashlib.blake2b("\n".join(parts).encode(), digest_size=16).hexdigest()
+
+
+# Remembers recently delivered content:
+class DuplicateFilter:
+    """
+    Recognises content that was already sent by anyone within the last
+    `window` seconds, so repeats are not fanned out again.
+
+    Fingerprints are kept in a TTLCache of at most `max_entries` entries
+    (16-byte digests, so memory stays small), along with the fingerprint of
+    each remembered message so a retracted message can be forgotten.
+
+    Parameters:
+      window: How long content counts as recent, in seconds.
+      max_entries: Maximum number of fingerprints remembered.
+    """
+
+    def __init__(self, window: float, max_entries: int = 50000) -> None:
+        self._seen: TTLCache[bool] = TTLCache(max_entries, ttl=window)
+        self._keys: TTLCache[str] = TTLCache(max_entries, ttl=window)
+
+    def check(self, messages: List[types.Message]) -> bool:
+        """
+        Returns True if the content is a recent duplicate; otherwise
+        remembers it and returns False.
+        """
+        key = fingerprint(messages)
+        if key is None:
+            return False
+        if key in self._seen:
+            return True
+        self._seen.set(key, True)
+        for message in messages:
+            self._keys.set((message.chat.id, message.message_id), key)
+        return False
+
+    def forget(self, messages: List[types.Message]) -> None:
+        """
+        Forgets the content of messages remembered by `check` (a single item
+        forgets its whole album), so it can be sent again.
+        """
+        for message in messages:
+            key = self._keys.pop((message.chat.id, message.message_id))
+            if key is not None:
+                self._seen.pop(key)
+
+
+def duplicate_filter_from_env() -> Optional[DuplicateFilter]:
+    """
+    Builds the filter from DEDUP_WINDOW and DEDUP_MAX_ENTRIES, or returns
+    None if DEDUP_WINDOW is 0.
+    """
+    window = float(os.getenv("DEDUP_WINDOW", "600"))
+    if window <= 0:
+        return None
+    return DuplicateFilter(window, max_entries=int(os.getenv("DEDUP_MAX_ENTRIES", "50000")))
@@ -0,0 +1,661 @@
+from aiogram import Bot, types
+from aiogram.types import ContentType
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Union
+import asyncio
+import logging
+import os
+import time
+from copies import COMMENT, COPY, FORWARD, CopyIndex, CopyRecorder, copied_ids
+from dedup import DuplicateFilter
+from digest import DigestStore, build_digest
+from delivery_queue import DeliveryQueue, ExcludingView, JobParked, JobProgress, PartitionView, RecipientList, partition_of
+from fanout import PRIORITY_HIGH, PRIORITY_IDLE, PRIORITY_LOW, PRIORITY_NORMAL, get_engine
+from metrics import CHANNEL_SEND_LATENCY
+from registry import SubscriberRegistry
+from utils import (
+    send_to_channel,
+    broadcast_message,
+    copy_to_channel,
+    forward_content,
+    broadcast_copy,
+    broadcast_forwarded_message
+)
+
+
+# Content types whose broadcasts are scheduled after small messages
+MEDIA_CONTENT_TYPES = {
+    ContentType.ANIMATION,
+    ContentType.AUDIO,
+    ContentType.DOCUMENT,
+    ContentType.PHOTO,
+    ContentType.VIDEO,
+    ContentType.VIDEO_NOTE,
+    ContentType.VOICE,
+}
+
+# Most messages delete_messages accepts in one call
+DELETE_BATCH_SIZE = 100
+
+# Builds the delivery job for a message or the items of one album:
+def build_job(messages: List[types.Message]) -> Dict[str, Any]:
+    first = messages[0]
+    is_forwarded = bool(first.forward_from or first.forward_from_chat)
+    job = {
+        "sender_id": first.from_user.id,
+        "from_chat_id": first.chat.id,
+        "message_ids": [message.message_id for message in messages],
+        "forwarded": is_forwarded,
+        # Small messages are delivered ahead of media and albums
+        "priority": PRIORITY_LOW if len(messages) > 1 or first.content_type in MEDIA_CONTENT_TYPES else PRIORITY_NORMAL
+    }
+    # Text posts are merged into digests as text; anything else is linked
+    if not is_forwarded and first.text is not None:
+        job["text"] = first.text
+        job["entities"] = [entity.model_dump(mode="json", exclude_none=True) for entity in first.entities or []]
+    
+    # If there's additional caption from the user on a forwarded message,
+    # it is sent anonymously before the forward
+    if is_forwarded and not first.forward_from_chat:
+        for message in messages:
+            if message.caption:
+                job["comment"] = message.caption
+                job["comment_entities"] = [
+                    entity.model_dump(mode="json", exclude_none=True) for entity in message.caption_entities or []
+                ]
+                break
+    return job
+
+# Queues one delivery job for a message or an album:
+def enqueue_messages(
+    queue: DeliveryQueue,
+    messages: List[types.Message],
+    duplicates: Optional[DuplicateFilter] = None
+) -> Optional[int]:
+    """
+    Queues the delivery of a message or album.
+
+    Returns:
+      The job ID, or None if `duplicates` recognised the content as a
+      recent repeat and it was dropped.
+    """
+    if duplicates is not None and duplicates.check(messages):
+        message_ids = [message.message_id for message in messages]
+        logging.info(f"Dropped repeat of recent content: messages {message_ids} from user {messages[0].from_user.id}")
+        return None
+    job = build_job(messages)
+    try:
+        job_id = queue.enqueue(job)
+    except Exception:
+        # Not delivered, so a retry must not count as a repeat
+        if duplicates is not None:
+            duplicates.forget(messages)
+        raise
+    logging.info(f"Queued delivery job {job_id} for messages {job['message_ids']} from user {job['sender_id']}")
+    return job_id
+
+# Queues the propagation of an edit to every copy of the message:
+def enqueue_edit(queue: DeliveryQueue, message: types.Message) -> int:
+    """
+    Queues a job that applies the new text or caption of an edited message
+    to all of its delivered copies.
+
+    Returns:
+      The job ID.
+    """
+    entities = message.entities if message.text is not None else message.caption_entities
+    job = {
+        "kind": "edit",
+        "sender_id": message.from_user.id,
+        "from_chat_id": message.chat.id,
+        "message_id": message.message_id,
+        "is_text": message.text is not None,
+        "text": message.text if message.text is not None else message.caption,
+        "entities": [entity.model_dump(mode="json", exclude_none=True) for entity in entities or []],
+        "priority": PRIORITY_NORMAL
+    }
+    job_id = queue.enqueue(job)
+    logging.info(f"Queued edit job {job_id} for message {message.message_id} from user {job['sender_id']}")
+    return job_id
+
+# Queues the deletion of every copy of a message:
+def enqueue_retract(queue: DeliveryQueue, sender_id: int, chat_id: int, message_id: int) -> int:
+    """
+    Cancels the message's pending deliveries and edits, and queues a job
+    deleting the copies already delivered. The job runs after a delivery of
+    the sender's that is still in progress (see DeliveryWorkers.per_sender),
+    so copies it is still making are deleted too.
+
+    Returns:
+      The job ID.
+    """
+    cancelled = queue.cancel(sender_id, message_id)
+    job_id = queue.enqueue({
+        "kind": "retract",
+        "sender_id": sender_id,
+        "from_chat_id": chat_id,
+        "message_id": message_id,
+        "priority": PRIORITY_HIGH
+    })
+    logging.info(
+        f"Queued retract job {job_id} for message {message_id} from user {sender_id} "
+        f"({cancelled} pending jobs cancelled)"
+    )
+    return job_id
+
+# Queues an admin announcement:
+def enqueue_announce(queue: DeliveryQueue, admin_id: int, message: types.Message, status: types.Message) -> int:
+    """
+    Queues the broadcast of `message` to every subscriber but the admin as
+    an announcement, reporting its progress by editing `status`.
+
+    Returns:
+      The job ID.
+    """
+    job_id = queue.enqueue({
+        "kind": "announce",
+        # Not a sender_id: the admin's own messages must not wait behind the announcement
+        "admin_id": admin_id,
+        "from_chat_id": message.chat.id,
+        "message_ids": [message.message_id],
+        "status_chat_id": status.chat.id,
+        "status_message_id": status.message_id,
+        # Chat traffic keeps going ahead of a large announcement
+        "priority": PRIORITY_LOW
+    })
+    logging.info(f"Queued announcement job {job_id} for message {message.message_id} from admin {admin_id}")
+    return job_id
+
+# Queues a digest job for every batch of posts, forever:
+async def schedule_digests(queue: DeliveryQueue, digest: DigestStore, interval: float) -> None:
+    """
+    Every `interval` seconds, queues a job that sends the posts added since
+    the last digest to every digest subscriber.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        batch = digest.take_batch()
+        if batch is None:
+            continue
+        after_id, up_to_id = batch
+        job_id = queue.enqueue({
+            "kind": "digest",
+            "sender_id": 0,
+            "after_id": after_id,
+            "up_to_id": up_to_id,
+            "priority": PRIORITY_LOW
+        })
+        logging.info(f"Queued digest job {job_id} for {up_to_id - after_id} posts")
+
+# Posts to the channel through the fan-out engine, ahead of queued broadcast sends:
+def channel_post(channel_id: int, sender_id: int, send: Callable[[int], Awaitable[Any]]) -> Awaitable[Any]:
+    return get_engine().send(channel_id, send, key=sender_id, priority=PRIORITY_HIGH)
+
+# Runs a one-off delivery step (e.g. a channel post) unless a previous attempt finished it:
+async def run_step(progress: JobProgress, step: str, action: Callable[[], Awaitable[Any]]) -> Any:
+    if progress.is_done(step):
+        return None
+    started = time.monotonic()
+    try:
+        result = await action()
+    finally:
+        CHANNEL_SEND_LATENCY.observe(time.monotonic() - started, step=step)
+    # Only a step that produced a message is finished; anything else is retried on resume
+    if result is not None:
+        progress.mark_done(step)
+    return result
+
+# Runs a channel step and records the post in the copy index:
+async def channel_step(
+    progress: JobProgress,
+    step: str,
+    channel_id: int,
+    recorder: Optional[CopyRecorder],
+    action: Callable[[], Awaitable[Any]]
+) -> Any:
+    result = await run_step(progress, step, action)
+    if recorder is not None and result is not None:
+        recorder.add(channel_id, result)
+        recorder.flush()
+    return result
+
+# Runs a broadcast step, resuming from its last checkpoint:
+async def broadcast_step(
+    progress: JobProgress,
+    step: str,
+    users: Union[SubscriberRegistry, PartitionView],
+    exclude_user_id: int,
+    broadcast: Callable[..., Awaitable[Any]],
+    recorder: Optional[CopyRecorder] = None
+) -> None:
+    """
+    Runs `broadcast` (one of the utils broadcast helpers with everything but
+    the recipients and callbacks bound) over the recipients the step has not
+    reached yet, recording the copies with `recorder` if given.
+    """
+    if progress.is_done(step):
+        return
+    cursor = progress.cursor(step, users)
+
+    def on_sent(user_id: int, result: Any) -> None:
+        cursor.complete(user_id, True)
+        if recorder is not None:
+            recorder.add(user_id, result)
+
+    try:
+        await broadcast(
+            cursor.pending(exclude_user_id),
+            on_sent=on_sent,
+            on_failed=lambda user_id, _: cursor.complete(user_id, False)
+        )
+    finally:
+        if recorder is not None:
+            recorder.flush()
+    progress.mark_done(step)
+
+# Runs a broadcast step over the recently active users first:
+async def tiered_step(
+    progress: JobProgress,
+    step: str,
+    registry: SubscriberRegistry,
+    users: Union[SubscriberRegistry, PartitionView],
+    exclude_user_id: int,
+    broadcast: Callable[..., Awaitable[Any]],
+    priority: int,
+    recorder: Optional[CopyRecorder] = None
+) -> None:
+    """
+    Runs `broadcast` (as for broadcast_step, with the priority left
+    unbound) in two tiers:
+    - The users who posted within the registry's hot window, most recently
+      active first, at `priority`. The list is saved with the job (step
+      `<step>_hot`), so a resumed job goes through the same users even if
+      their activity changed meanwhile.
+    - Everyone else in registration order (step `<step>`), at
+      PRIORITY_IDLE, so these sends only use capacity nothing else needs.
+    Without activity tracking this is a plain broadcast step.
+    """
+    def at(tier_priority: int) -> Callable[..., Awaitable[Any]]:
+        return lambda pending, **callbacks: broadcast(pending, priority=tier_priority, **callbacks)
+    
+    if registry.hot_window <= 0:
+        await broadcast_step(progress, step, users, exclude_user_id, at(priority), recorder)
+        return
+    hot = progress.recipients(f"{step}_hot", lambda: [user_id for user_id in registry.recent() if user_id in users])
+    await broadcast_step(progress, f"{step}_hot", RecipientList(users, hot), exclude_user_id, at(priority), recorder)
+    await broadcast_step(progress, step, ExcludingView(users, set(hot)), exclude_user_id, at(PRIORITY_IDLE), recorder)
+
+# Delivery of a queued message:
+async def deliver_message(
+    bot: Bot,
+    job: Dict[str, Any],
+    progress: JobProgress,
+    users: Union[SubscriberRegistry, PartitionView],
+    channel_id: int,
+    copies: Optional[CopyIndex] = None,
+    digest: Optional[DigestStore] = None
+) -> None:
+    """
+    Delivers a queued message:
+    - Copies the message to the channel (forwarded messages are forwarded
+      so the attribution is preserved).
+    - Broadcasts the message to all active users (excluding the sender and
+      digest subscribers), the recently active ones first.
+    - Adds the message to the next digest, if `digest` is given.
+    - Records every copy in `copies`, if given, so later edits can follow.
+    """
+    sender_id = job["sender_id"]
+    from_chat_id = job["from_chat_id"]
+    message_ids = job["message_ids"]
+    priority = job.get("priority", PRIORITY_NORMAL)
+    
+    # With several worker processes each job covers one partition of the
+    # subscribers, and only partition 0 posts to the channel
+    partition = job.get("partition", 0)
+    partitions = job.get("partitions", 1)
+    owns_channel = partition == 0
+    registry = users
+    if partitions > 1:
+        users = PartitionView(users, partition, partitions)
+    if digest is not None:
+        users = ExcludingView(users, digest.subscribers())
+    
+    def recorder(kind: str, source_ids: List[int]) -> Optional[CopyRecorder]:
+        return copies.recorder(from_chat_id, source_ids, kind) if copies is not None else None
+    
+    def add_to_digest(posted: Any) -> None:
+        if digest is None or progress.is_done("digest"):
+            return
+        channel_message_ids = copied_ids(posted)
+        if not channel_message_ids and copies is not None:
+            # The channel step finished in an earlier attempt
+            channel_message_ids = [
+                message_id for chat_id, message_id in copies.lookup(from_chat_id, message_ids[0], kinds=(COPY, FORWARD))
+                if chat_id == channel_id
+            ]
+        digest.add(
+            sender_id, from_chat_id, message_ids, job.get("text"), job.get("entities", []),
+            channel_message_ids[0] if channel_message_ids else None
+        )
+        progress.mark_done("digest")
+    
+    # Handle forwarded messages
+    if job.get("forwarded"):
+        logging.info("Processing forwarded message")
+        
+        # First, send the user's comment anonymously (if any)
+        comment = job.get("comment")
+        if comment:
+            comment_entities = [types.MessageEntity.model_validate(entity) for entity in job.get("comment_entities", [])]
+            if owns_channel:
+                try:
+                    await channel_step(progress, "comment_channel", channel_id, recorder(COMMENT, message_ids[:1]), lambda: channel_post(
+                        channel_id, sender_id, lambda chat_id: send_to_channel(bot, chat_id, comment, entities=comment_entities or None)
+                    ))
+                except Exception as e:
+                    logging.error(f"Failed to send user comment to channel: {e}")
+            try:
+                await tiered_step(progress, "comment_users", registry, users, sender_id, lambda pending, **kwargs: broadcast_message(
+                    bot, pending, sender_id, comment, entities=comment_entities or None, **kwargs
+                ), priority, recorder(COMMENT, message_ids[:1]))
+            except Exception as e:
+                logging.error(f"Failed to send user comment: {e}")
+        
+        # Forward original message to channel with attribution preserved
+        if owns_channel:
+            try:
+                logging.info(f"Forwarding message to channel {channel_id}")
+                posted = await channel_step(progress, "channel", channel_id, recorder(FORWARD, message_ids), lambda: channel_post(
+                    channel_id, sender_id, lambda chat_id: forward_content(bot, chat_id, from_chat_id, message_ids)
+                ))
+                add_to_digest(posted)
+            except Exception as e:
+                logging.error(f"Failed to forward message to channel: {e}")
+        
+        # Broadcast to other users
+        try:
+            await tiered_step(progress, "users", registry, users, sender_id, lambda pending, **kwargs: broadcast_forwarded_message(
+                bot, pending, sender_id, from_chat_id, message_ids, **kwargs
+            ), priority, recorder(FORWARD, message_ids))
+        except Exception as e:
+            logging.error(f"Failed to broadcast forwarded message: {e}")
+        
+        return
+    
+    # Any other content is copied: one API call per recipient whatever the type
+    if owns_channel:
+        try:
+            posted = await channel_step(progress, "channel", channel_id, recorder(COPY, message_ids), lambda: channel_post(
+                channel_id, sender_id, lambda chat_id: copy_to_channel(bot, chat_id, from_chat_id, message_ids)
+            ))
+            add_to_digest(posted)
+        except Exception as e:
+            logging.error(f"Failed to copy message to channel: {e}")
+    
+    try:
+        logging.info(f"Broadcasting message to users (partition {partition + 1} of {partitions})")
+        await tiered_step(progress, "users", registry, users, sender_id, lambda pending, **kwargs: broadcast_copy(
+            bot, pending, sender_id, from_chat_id, message_ids, **kwargs
+        ), priority, recorder(COPY, message_ids))
+    except Exception as e:
+        logging.error(f"Failed to broadcast message: {e}")
+
+# Propagation of an edit to the delivered copies:
+async def deliver_edit(bot: Bot, job: Dict[str, Any], copies: CopyIndex, channel_id: int) -> None:
+    """
+    Edits every recorded copy of the message (the channel post and the
+    copies sent to users) with the same concurrent fan-out as a broadcast.
+    Forwards cannot be edited and are left alone.
+    """
+    partition = job.get("partition", 0)
+    partitions = job.get("partitions", 1)
+    targets = {
+        chat_id: message_id
+        for chat_id, message_id in copies.lookup(job["from_chat_id"], job["message_id"], kinds=(COPY,))
+        # Each worker process edits the copies in its own partition
+        if (partition == 0 if chat_id == channel_id else partition_of(chat_id, partitions) == partition)
+    }
+    if not targets:
+        return
+    entities = [types.MessageEntity.model_validate(entity) for entity in job.get("entities", [])] or None
+    
+    def edit(chat_id: int) -> Awaitable[Any]:
+        if job["is_text"]:
+            return bot.edit_message_text(
+                chat_id=chat_id, message_id=targets[chat_id], text=job["text"], entities=entities
+            )
+        return bot.edit_message_caption(
+            chat_id=chat_id, message_id=targets[chat_id], caption=job["text"], caption_entities=entities
+        )
+    
+    await get_engine().broadcast(
+        targets, edit, label="edit", key=job["sender_id"], priority=job.get("priority", PRIORITY_NORMAL)
+    )
+
+# Deletion of the delivered copies:
+async def deliver_retract(
+    bot: Bot,
+    job: Dict[str, Any],
+    copies: CopyIndex,
+    channel_id: int,
+    digest: Optional[DigestStore] = None
+) -> None:
+    """
+    Deletes every recorded copy of the message (and of the rest of its
+    album, including comments sent with forwards) from the channel and from
+    all recipients, and drops it from the next digest. The copies in one chat are deleted with one
+    delete_messages call per 100 messages, and the chats are processed with
+    the same concurrent, rate-limited fan-out as a broadcast.
+    """
+    partition = job.get("partition", 0)
+    partitions = job.get("partitions", 1)
+    if digest is not None and partition == 0:
+        digest.forget(job["from_chat_id"], job["message_id"])
+    by_chat: Dict[int, List[int]] = {}
+    for chat_id, message_id in copies.lookup_album(job["from_chat_id"], job["message_id"]):
+        if partition == 0 if chat_id == channel_id else partition_of(chat_id, partitions) == partition:
+            by_chat.setdefault(chat_id, []).append(message_id)
+    
+    async def delete(chat_id: int) -> None:
+        message_ids = sorted(by_chat[chat_id])
+        for start in range(0, len(message_ids), DELETE_BATCH_SIZE):
+            await bot.delete_messages(chat_id=chat_id, message_ids=message_ids[start:start + DELETE_BATCH_SIZE])
+    
+    if by_chat:
+        await get_engine().broadcast(
+            by_chat, delete, label="retraction", key=job["sender_id"], priority=job.get("priority", PRIORITY_HIGH)
+        )
+    # Later edits of the original must not reach the deleted copies. With
+    # several worker processes the others may not have read the copies yet,
+    # so they are left to expire (edits of deleted copies just fail)
+    if partitions == 1:
+        copies.forget_album(job["from_chat_id"], job["message_id"])
+
+# Text of the live progress message of an announcement:
+def announce_status(state: str, sent: int, failed: int, total: int, rate: float = 0.0) -> str:
+    done = sent + failed
+    lines = [
+        f"Announcement: {state}",
+        f"Sent: {sent}, failed: {failed}, of {total}"
+    ]
+    if state == "sending" and rate > 0 and total > done:
+        lines.append(f"ETA: {(total - done) / rate:.0f}s")
+    return "\n".join(lines)
+
+# Delivery of an admin announcement:
+async def deliver_announce(
+    bot: Bot,
+    job: Dict[str, Any],
+    progress: JobProgress,
+    users: Union[SubscriberRegistry, PartitionView],
+    copies: Optional[CopyIndex] = None
+) -> None:
+    """
+    Copies the announcement to every active user (not to the channel), the
+    recently active ones first, and edits the admin's status message with
+    the sent and failed counts and an ETA every ANNOUNCE_PROGRESS_INTERVAL
+    seconds.
+
+    Recipients are taken lazily from the registry through the broadcast
+    cursor, and the sends share the fan-out engine's rate limits with the
+    rest of the traffic. Between progress updates the job's control request
+    is checked: a paused announcement is checkpointed and parked until it
+    is resumed, a cancelled one is dropped (see DeliveryQueue.control_announcements).
+    """
+    queue = progress.queue
+    sender_id = job["admin_id"]
+    from_chat_id = job["from_chat_id"]
+    message_ids = job["message_ids"]
+    interval = float(os.getenv("ANNOUNCE_PROGRESS_INTERVAL", "5"))
+    
+    # As with messages, each worker process covers one partition; partition 0 reports progress
+    partition = job.get("partition", 0)
+    partitions = job.get("partitions", 1)
+    reports = partition == 0
+    total = len(users) - (sender_id in users)
+    registry = users
+    if partitions > 1:
+        users = PartitionView(users, partition, partitions)
+    
+    recorder = copies.recorder(from_chat_id, message_ids, COPY) if copies is not None else None
+    sending = asyncio.create_task(tiered_step(progress, "users", registry, users, sender_id, lambda pending, **kwargs: broadcast_copy(
+        bot, pending, sender_id, from_chat_id, message_ids, **kwargs
+    ), job.get("priority", PRIORITY_LOW), recorder))
+    
+    async def report(state: str, rate: float = 0.0, flush: bool = True) -> None:
+        if flush:
+            progress.flush()
+        counts = queue.announcement_progress(job["status_chat_id"], job["status_message_id"])
+        try:
+            await bot.edit_message_text(
+                chat_id=job["status_chat_id"], message_id=job["status_message_id"],
+                text=announce_status(state, counts["sent"], counts["failed"], total, rate)
+            )
+        except Exception as e:
+            # Typically "message is not modified" when nothing was sent since the last update
+            logging.debug(f"Could not update announcement status: {e}")
+    
+    def done() -> int:
+        counts = queue.announcement_progress(job["status_chat_id"], job["status_message_id"])
+        return counts["sent"] + counts["failed"]
+    
+    progress.flush()
+    started = time.monotonic()
+    done_at_start = done()
+    try:
+        while not sending.done():
+            await asyncio.wait([sending], timeout=interval)
+            control = queue.control(progress.job_id)
+            if control in ("pause", "cancel"):
+                sending.cancel()
+                await asyncio.gather(sending, return_exceptions=True)
+                progress.flush()
+                state = "paused" if control == "pause" else "cancelled"
+                queue.park(progress.job_id, state)
+                logging.info(f"Announcement job {progress.job_id} {state}")
+                # Parking dropped or saved the progress; flushing again would recreate it
+                await report(state, flush=False)
+                raise JobParked()
+            if reports and not sending.done():
+                progress.flush()
+                await report("sending", (done() - done_at_start) / (time.monotonic() - started))
+    finally:
+        if not sending.done():
+            # The worker is being stopped; it checkpoints the cursor
+            sending.cancel()
+            await asyncio.gather(sending, return_exceptions=True)
+    sending.result()
+    # Each partition reports when it ends, and the last one to end says so
+    unfinished = queue.announcement_progress(job["status_chat_id"], job["status_message_id"])["unfinished"]
+    await report("finished" if not unfinished else "sending")
+
+# Delivery of a digest:
+async def deliver_digest(
+    bot: Bot,
+    job: Dict[str, Any],
+    progress: JobProgress,
+    users: Union[SubscriberRegistry, PartitionView],
+    digest: DigestStore,
+    channel_id: int
+) -> None:
+    """
+    Sends the posts of a digest job to every digest subscriber, merged into
+    as few messages as Telegram's length limit allows. Subscribers who
+    posted in the period get a digest without their own posts.
+    """
+    items = digest.items(job["after_id"], job["up_to_id"])
+    if not items:
+        return
+    partition = job.get("partition", 0)
+    partitions = job.get("partitions", 1)
+    if partitions > 1:
+        users = PartitionView(users, partition, partitions)
+    # Saved with the job, so a resumed digest goes to the same subscribers
+    recipients = progress.recipients(
+        "digest_users", lambda: sorted(user_id for user_id in digest.subscribers() if user_id in users)
+    )
+    try:
+        username = (await bot.get_chat(channel_id)).username
+    except Exception as e:
+        logging.warning(f"Could not get the channel username for digest links: {e}")
+        username = None
+    senders = {item.sender_id for item in items}
+    variants = [(None, RecipientList(ExcludingView(users, senders), recipients))] + [
+        (sender_id, RecipientList(users, [sender_id])) for sender_id in sorted(senders) if sender_id in recipients
+    ]
+    for sender_id, variant_users in variants:
+        messages = build_digest([item for item in items if item.sender_id != sender_id], channel_id, username)
+        for index, (text, entities) in enumerate(messages):
+            step = f"digest_{index}" if sender_id is None else f"digest_{sender_id}_{index}"
+            message_entities = [types.MessageEntity.model_validate(entity) for entity in entities] or None
+            await broadcast_step(progress, step, variant_users, 0, lambda pending, **callbacks: broadcast_message(
+                bot, pending, 0, text, entities=message_entities, priority=job.get("priority", PRIORITY_LOW), **callbacks
+            ))
+
+# Queue worker entry point:
+async def process_job(
+    bot: Bot,
+    registry: SubscriberRegistry,
+    channel_id: int,
+    job_id: int,
+    payload: Dict[str, Any],
+    progress: JobProgress,
+    copies: Optional[CopyIndex] = None,
+    digest: Optional[DigestStore] = None
+) -> None:
+    """
+    Delivers a queued job: a message, an announcement or a digest (which
+    needs `digest`), or an edit or retraction of a message (which need
+    `copies`).
+    """
+    if payload.get("kind") == "edit":
+        if copies is not None:
+            logging.info(f"Processing edit job {job_id} (message {payload['message_id']})")
+            await deliver_edit(bot, payload, copies, channel_id)
+        return
+    if payload.get("kind") == "retract":
+        if copies is not None:
+            logging.info(f"Processing retract job {job_id} (message {payload['message_id']})")
+            await deliver_retract(bot, payload, copies, channel_id, digest)
+        return
+    # The registry may still be loading in the background after a restart
+    await registry.wait_loaded()
+    if payload.get("kind") == "announce":
+        logging.info(f"Processing announcement job {job_id} (message {payload['message_ids']})")
+        try:
+            await deliver_announce(bot, payload, progress, registry, copies)
+        finally:
+            registry.flush()
+        return
+    if payload.get("kind") == "digest":
+        if digest is not None:
+            logging.info(f"Processing digest job {job_id} (posts {payload['after_id'] + 1} to {payload['up_to_id']})")
+            try:
+                await deliver_digest(bot, payload, progress, registry, digest, channel_id)
+            finally:
+                registry.flush()
+        return
+    logging.info(f"Processing delivery job {job_id} (message {payload['message_ids']})")
+    try:
+        await deliver_message(bot, payload, progress, registry, channel_id, copies, digest)
+    finally:
+        registry.flush()
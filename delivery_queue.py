@@ -0,0 +1,770 @@
+from array import array
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Set, Tuple
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    error TEXT,
+    partition_no INTEGER NOT NULL DEFAULT 0,
+    sender_id INTEGER,
+    priority INTEGER NOT NULL DEFAULT 1,
+    control TEXT,
+    sent INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+CREATE INDEX IF NOT EXISTS jobs_partition_status ON jobs (partition_no, status, id);
+CREATE INDEX IF NOT EXISTS jobs_sender_status ON jobs (sender_id, status);
+CREATE TABLE IF NOT EXISTS job_steps (
+    job_id INTEGER NOT NULL,
+    step TEXT NOT NULL,
+    PRIMARY KEY (job_id, step)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS job_cursors (
+    job_id INTEGER NOT NULL,
+    step TEXT NOT NULL,
+    position INTEGER NOT NULL DEFAULT 0,
+    anchor INTEGER,
+    done TEXT NOT NULL DEFAULT '[]',
+    total INTEGER NOT NULL DEFAULT 0,
+    sent INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL,
+    PRIMARY KEY (job_id, step)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS job_recipients (
+    job_id INTEGER NOT NULL,
+    step TEXT NOT NULL,
+    users BLOB NOT NULL,
+    PRIMARY KEY (job_id, step)
+) WITHOUT ROWID;
+"""
+
+
+def partition_of(user_id: int, partitions: int) -> int:
+    """
+    Returns the subscriber partition a user belongs to. Every user belongs to
+    exactly one partition, which is what keeps delivery exactly-once when
+    several processes fan out the same message.
+    """
+    return user_id % partitions
+
+
+# Re-iterable view of the users that belong to one partition:
+class PartitionView:
+    """
+    Wraps a SubscriberRegistry; positions are those of the full registry, so
+    checkpoints work the same with and without partitions.
+    """
+
+    def __init__(self, users: Any, partition: int, partitions: int) -> None:
+        self.users = users
+        self.partition = partition
+        self.partitions = partitions
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self.users and partition_of(user_id, self.partitions) == self.partition
+
+    def __iter__(self) -> Iterator[int]:
+        for _, user_id in self.iter_from(0):
+            yield user_id
+
+    def iter_from(self, position: int = 0) -> Iterator[Tuple[int, int]]:
+        for index, user_id in self.users.iter_from(position):
+            if partition_of(user_id, self.partitions) == self.partition:
+                yield index, user_id
+
+    @property
+    def size(self) -> int:
+        return self.users.size
+
+    def anchor(self, position: int) -> Optional[int]:
+        return self.users.anchor(position)
+
+    def locate(self, position: int, anchor: Optional[int]) -> int:
+        return self.users.locate(position, anchor)
+
+
+# Re-iterable view of the users not in a given set:
+class ExcludingView:
+    """
+    Wraps a SubscriberRegistry or PartitionView, skipping `excluded`;
+    positions are those of the wrapped users.
+    """
+
+    def __init__(self, users: Any, excluded: Set[int]) -> None:
+        self.users = users
+        self.excluded = excluded
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self.users and user_id not in self.excluded
+
+    def __iter__(self) -> Iterator[int]:
+        for _, user_id in self.iter_from(0):
+            yield user_id
+
+    def iter_from(self, position: int = 0) -> Iterator[Tuple[int, int]]:
+        for index, user_id in self.users.iter_from(position):
+            if user_id not in self.excluded:
+                yield index, user_id
+
+    @property
+    def size(self) -> int:
+        return self.users.size
+
+    def anchor(self, position: int) -> Optional[int]:
+        return self.users.anchor(position)
+
+    def locate(self, position: int, anchor: Optional[int]) -> int:
+        return self.users.locate(position, anchor)
+
+
+# Fixed list of recipients, in the interface BroadcastCursor expects:
+class RecipientList:
+    """
+    Iterates `user_ids` in the given order, skipping users that are no
+    longer in `users`. Positions are indices into the list, which must not
+    change while a broadcast over it can be resumed (see JobProgress.recipients).
+    """
+
+    def __init__(self, users: Any, user_ids: List[int]) -> None:
+        self.users = users
+        self.user_ids = user_ids
+
+    def __iter__(self) -> Iterator[int]:
+        for _, user_id in self.iter_from(0):
+            yield user_id
+
+    def iter_from(self, position: int = 0) -> Iterator[Tuple[int, int]]:
+        for index in range(position, len(self.user_ids)):
+            user_id = self.user_ids[index]
+            if user_id in self.users:
+                yield index, user_id
+
+    @property
+    def size(self) -> int:
+        return len(self.user_ids)
+
+    def anchor(self, position: int) -> Optional[int]:
+        if 0 < position <= len(self.user_ids):
+            return self.user_ids[position - 1]
+        return None
+
+    def locate(self, position: int, anchor: Optional[int]) -> int:
+        return position
+
+
+# Persistent FIFO of outbound delivery jobs:
+class DeliveryQueue:
+    """
+    A durable queue of delivery jobs stored in SQLite.
+
+    Jobs move from 'pending' to 'running' to 'done' (or 'failed'), or from
+    'pending' to 'cancelled' when the sender retracts the message.
+    Announcements can also be 'paused' (and later resumed) or 'cancelled'
+    while running: their 'control' column asks the worker to stop them. Jobs that
+    were 'running' when the process died are put back to 'pending' by
+    `recover()`, and their recorded progress lets the worker skip whatever
+    had already been delivered.
+
+    When deliveries are split across worker processes, every message is
+    stored as one job per subscriber partition; each worker process only
+    claims the jobs of its own partition. The database is shared by all
+    processes and serves as the broker between them.
+
+    Parameters:
+      path: Path to the SQLite database file.
+      partitions: Number of subscriber partitions each message is split into.
+    """
+
+    def __init__(self, path: str, partitions: int = 1) -> None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.partitions = max(1, partitions)
+        self.conn = sqlite3.connect(path, isolation_level=None, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self._available = asyncio.Event()
+
+    def enqueue(self, payload: Dict[str, Any]) -> int:
+        """
+        Stores a new job (one per partition) and wakes up an idle worker.
+
+        The payload of each partition's job gets 'partition' and 'partitions'
+        fields telling the worker which share of the subscribers it owns.
+
+        Returns:
+          The ID of the first partition's job.
+        """
+        now = time.time()
+        job_ids = []
+        self.conn.execute("BEGIN")
+        for partition in range(self.partitions):
+            cursor = self.conn.execute(
+                "INSERT INTO jobs (payload, created_at, partition_no, sender_id, priority) VALUES (?, ?, ?, ?, ?)",
+                (
+                    json.dumps(dict(payload, partition=partition, partitions=self.partitions)),
+                    now,
+                    partition,
+                    payload.get("sender_id"),
+                    payload.get("priority", 1)
+                )
+            )
+            job_ids.append(cursor.lastrowid)
+        self.conn.execute("COMMIT")
+        self._available.set()
+        return job_ids[0]
+
+    def claim(self, partition: Optional[int] = None, per_sender: int = 0) -> Optional[Tuple[int, Dict[str, Any]]]:
+        """
+        Marks the next pending job (of `partition`, if given) as running and
+        returns it, or None if there is nothing to do.
+
+        Jobs are taken by priority, then in order. With `per_sender` set, a
+        sender's jobs are skipped while that many of them are running, so
+        one sender's burst of messages leaves workers free for everyone else.
+        """
+        conditions = ["j.status = 'pending'"]
+        params: List[Any] = [time.time()]
+        if partition is not None:
+            conditions.append("j.partition_no = ?")
+            params.append(partition)
+        if per_sender > 0:
+            conditions.append(
+                "(j.sender_id IS NULL OR (SELECT COUNT(*) FROM jobs r WHERE r.sender_id = j.sender_id "
+                "AND r.status = 'running' AND r.partition_no = j.partition_no) < ?)"
+            )
+            params.append(per_sender)
+        row = self.conn.execute(
+            "UPDATE jobs SET status = 'running', started_at = ? "
+            f"WHERE id = (SELECT j.id FROM jobs j WHERE {' AND '.join(conditions)} ORDER BY j.priority, j.id LIMIT 1) "
+            "RETURNING id, payload",
+            params
+        ).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def _drop_progress(self, job_ids: List[Tuple[int]]) -> None:
+        """
+        Keeps the sent and failed totals of finished jobs on the job rows and
+        deletes their progress records. Must be called inside a transaction.
+        """
+        self.conn.executemany(
+            "UPDATE jobs SET "
+            "sent = sent + (SELECT COALESCE(SUM(sent), 0) FROM job_cursors WHERE job_id = jobs.id), "
+            "failed = failed + (SELECT COALESCE(SUM(failed), 0) FROM job_cursors WHERE job_id = jobs.id) "
+            "WHERE id = ?",
+            job_ids
+        )
+        self.conn.executemany("DELETE FROM job_steps WHERE job_id = ?", job_ids)
+        self.conn.executemany("DELETE FROM job_cursors WHERE job_id = ?", job_ids)
+        self.conn.executemany("DELETE FROM job_recipients WHERE job_id = ?", job_ids)
+
+    def finish(self, job_id: int, error: Optional[str] = None) -> None:
+        """
+        Marks a job as done (or failed if `error` is given) and drops its
+        progress records, keeping its sent and failed totals.
+        """
+        self.conn.execute("BEGIN")
+        self.conn.execute(
+            "UPDATE jobs SET status = ?, finished_at = ?, error = ? WHERE id = ?",
+            ("failed" if error else "done", time.time(), error, job_id)
+        )
+        self._drop_progress([(job_id,)])
+        self.conn.execute("COMMIT")
+        # Another job of the same sender may have become claimable
+        self._available.set()
+
+    def cancel(self, sender_id: int, message_id: int) -> int:
+        """
+        Cancels the pending jobs (deliveries and edits, in every partition)
+        of a sender's message; a job covering an album is cancelled if it
+        contains the message. Running jobs are left to finish.
+
+        Returns:
+          The number of cancelled jobs.
+        """
+        cursor = self.conn.execute(
+            "UPDATE jobs SET status = 'cancelled', finished_at = ? "
+            "WHERE status = 'pending' AND sender_id = ? AND ("
+            "json_extract(payload, '$.message_id') = ? OR "
+            "EXISTS (SELECT 1 FROM json_each(payload, '$.message_ids') WHERE value = ?))",
+            (time.time(), sender_id, message_id, message_id)
+        )
+        return cursor.rowcount
+
+    def control_announcements(self, action: str) -> int:
+        """
+        Pauses, resumes or cancels every unfinished announcement. Pending
+        and paused jobs change status right away; running ones get the
+        request in their 'control' column, which the worker polls.
+
+        Parameters:
+          action: 'pause', 'resume' or 'cancel'.
+
+        Returns:
+          The number of jobs affected.
+        """
+        announce = "json_extract(payload, '$.kind') = 'announce'"
+        now = time.time()
+        self.conn.execute("BEGIN")
+        if action == "pause":
+            count = self.conn.execute(f"UPDATE jobs SET status = 'paused' WHERE status = 'pending' AND {announce}").rowcount
+            count += self.conn.execute(f"UPDATE jobs SET control = 'pause' WHERE status = 'running' AND {announce}").rowcount
+        elif action == "resume":
+            count = self.conn.execute(f"UPDATE jobs SET status = 'pending' WHERE status = 'paused' AND {announce}").rowcount
+            # A pause that was not picked up yet is withdrawn
+            count += self.conn.execute(f"UPDATE jobs SET control = NULL WHERE status = 'running' AND {announce}").rowcount
+        elif action == "cancel":
+            cancelled = self.conn.execute(
+                f"UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE status IN ('pending', 'paused') AND {announce} "
+                "RETURNING id",
+                (now,)
+            ).fetchall()
+            self._drop_progress(cancelled)
+            count = len(cancelled)
+            count += self.conn.execute(f"UPDATE jobs SET control = 'cancel' WHERE status = 'running' AND {announce}").rowcount
+        else:
+            self.conn.execute("ROLLBACK")
+            raise ValueError(f"Unknown action: {action}")
+        self.conn.execute("COMMIT")
+        self._available.set()
+        return count
+
+    def control(self, job_id: int) -> Optional[str]:
+        """
+        Returns the pending control request of a running job ('pause' or
+        'cancel'), if any.
+        """
+        row = self.conn.execute("SELECT control FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row[0] if row else None
+
+    def park(self, job_id: int, status: str) -> None:
+        """
+        Takes a running job out of the workers' hands: 'paused' keeps its
+        progress for when it is resumed, 'cancelled' drops it (keeping the
+        totals). The job's progress must be flushed before, and not after.
+        """
+        self.conn.execute("BEGIN")
+        self.conn.execute(
+            "UPDATE jobs SET status = ?, control = NULL, finished_at = ? WHERE id = ?",
+            (status, time.time() if status == "cancelled" else None, job_id)
+        )
+        if status == "cancelled":
+            self._drop_progress([(job_id,)])
+        self.conn.execute("COMMIT")
+        self._available.set()
+
+    def announcement_progress(self, chat_id: int, message_id: int) -> Dict[str, int]:
+        """
+        Returns the progress of the announcement reported in the status
+        message `message_id` of `chat_id`, over all its partitions: the
+        totals kept by finished and cancelled ones, and the last checkpoints
+        of the others.
+
+        Returns:
+          A dict with 'sent', 'failed' and 'unfinished', the number of its
+          jobs not done yet.
+        """
+        announcement = (
+            "json_extract(j.payload, '$.kind') = 'announce' "
+            "AND json_extract(j.payload, '$.status_chat_id') = ? "
+            "AND json_extract(j.payload, '$.status_message_id') = ?"
+        )
+        sent, failed = self.conn.execute(
+            "SELECT COALESCE(SUM(j.sent + (SELECT COALESCE(SUM(c.sent), 0) FROM job_cursors c WHERE c.job_id = j.id)), 0), "
+            "COALESCE(SUM(j.failed + (SELECT COALESCE(SUM(c.failed), 0) FROM job_cursors c WHERE c.job_id = j.id)), 0) "
+            f"FROM jobs j WHERE {announcement}",
+            (chat_id, message_id)
+        ).fetchone()
+        unfinished = self.conn.execute(
+            f"SELECT COUNT(*) FROM jobs j WHERE {announcement} AND j.status IN ('pending', 'running', 'paused') "
+            "AND NOT EXISTS (SELECT 1 FROM job_steps s WHERE s.job_id = j.id AND s.step = 'users')",
+            (chat_id, message_id)
+        ).fetchone()[0]
+        return {"sent": sent, "failed": failed, "unfinished": unfinished}
+
+    def recover(self, partition: Optional[int] = None) -> int:
+        """
+        Requeues jobs (of `partition`, if given) left 'running' by a previous
+        process. Must only be called when no other process is working on
+        those jobs.
+
+        Returns:
+          The number of requeued jobs.
+        """
+        if partition is None:
+            cursor = self.conn.execute("UPDATE jobs SET status = 'pending' WHERE status = 'running'")
+        else:
+            cursor = self.conn.execute(
+                "UPDATE jobs SET status = 'pending' WHERE status = 'running' AND partition_no = ?",
+                (partition,)
+            )
+        if cursor.rowcount:
+            self._available.set()
+        return cursor.rowcount
+
+    def prune(self, max_age: float) -> int:
+        """
+        Deletes finished jobs older than `max_age` seconds, and any progress
+        records left behind by jobs that are no longer unfinished.
+
+        Returns:
+          The number of deleted jobs.
+        """
+        self.conn.execute("BEGIN")
+        deleted = self.conn.execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed', 'cancelled') AND finished_at < ?",
+            (time.time() - max_age,)
+        ).rowcount
+        for table in ("job_steps", "job_cursors", "job_recipients"):
+            self.conn.execute(
+                f"DELETE FROM {table} WHERE job_id NOT IN "
+                "(SELECT id FROM jobs WHERE status IN ('pending', 'running', 'paused'))"
+            )
+        self.conn.execute("COMMIT")
+        return deleted
+
+    async def prune_every(self, max_age: float, interval: float = 3600) -> None:
+        """
+        Prunes finished jobs older than `max_age` seconds every `interval`
+        seconds, forever.
+        """
+        while True:
+            deleted = self.prune(max_age)
+            if deleted:
+                logging.info(f"Pruned {deleted} finished delivery jobs")
+            await asyncio.sleep(interval)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns the queue depth and lag.
+
+        Returns:
+          A dict with the number of 'pending' and 'running' jobs and 'lag',
+          the age in seconds of the oldest pending job (0 if none).
+        """
+        counts = dict(self.conn.execute(
+            "SELECT status, COUNT(*) FROM jobs WHERE status IN ('pending', 'running') GROUP BY status"
+        ).fetchall())
+        oldest = self.conn.execute(
+            "SELECT MIN(created_at) FROM jobs WHERE status = 'pending'"
+        ).fetchone()[0]
+        return {
+            "pending": counts.get("pending", 0),
+            "running": counts.get("running", 0),
+            "lag": time.time() - oldest if oldest else 0.0
+        }
+
+    def broadcasts(self) -> List[Dict[str, Any]]:
+        """
+        Returns the progress of the broadcasts of running jobs: one dict per
+        job and step with 'job_id', 'step', 'position', 'total', 'sent' and
+        'failed'. Jobs that have not checkpointed yet have no entry.
+        """
+        rows = self.conn.execute(
+            "SELECT c.job_id, c.step, c.position, c.total, c.sent, c.failed FROM job_cursors c "
+            "JOIN jobs j ON j.id = c.job_id "
+            "WHERE j.status = 'running' AND NOT EXISTS "
+            "(SELECT 1 FROM job_steps s WHERE s.job_id = c.job_id AND s.step = c.step) "
+            "ORDER BY c.job_id, c.step"
+        ).fetchall()
+        keys = ("job_id", "step", "position", "total", "sent", "failed")
+        return [dict(zip(keys, row)) for row in rows]
+
+    def wake(self) -> None:
+        """
+        Wakes up every worker waiting for a job.
+        """
+        self._available.set()
+
+    async def wait(self, timeout: float) -> None:
+        """
+        Waits until a job might be available or `timeout` seconds pass.
+        """
+        try:
+            await asyncio.wait_for(self._available.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._available.clear()
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+# Checkpointed position of one broadcast in the subscriber order:
+class BroadcastCursor:
+    """
+    Tracks how far a broadcast step got through the subscribers so a resumed
+    job continues where it stopped instead of starting over.
+
+    Recipients are handed out in registration order but finish out of order
+    (several sends are in flight), so the checkpoint stores the position
+    before which every recipient is finished, plus the few positions after it
+    that already finished. It is written every `checkpoint_every` deliveries
+    and when the job is stopped; after a crash at most that many recipients
+    receive the message twice.
+
+    Parameters:
+      queue: The queue the job belongs to.
+      job_id: The job ID.
+      step: The broadcast step of the job (e.g. 'users').
+      users: The SubscriberRegistry or PartitionView being broadcast to.
+      checkpoint_every: Number of deliveries between checkpoints.
+    """
+
+    def __init__(self, queue: DeliveryQueue, job_id: int, step: str, users: Any, checkpoint_every: int = 100) -> None:
+        self.queue = queue
+        self.job_id = job_id
+        self.step = step
+        self.users = users
+        self.checkpoint_every = max(1, checkpoint_every)
+        self.position = 0
+        self.done: Set[int] = set()
+        self.sent = 0
+        self.failed = 0
+        self.total = users.size
+        row = queue.conn.execute(
+            "SELECT position, anchor, done, sent, failed FROM job_cursors WHERE job_id = ? AND step = ?",
+            (job_id, step)
+        ).fetchone()
+        if row is not None:
+            position, anchor, done, self.sent, self.failed = row
+            self.position = users.locate(position, anchor)
+            # Finished positions after the checkpoint are only valid if it did not move
+            if self.position == position:
+                self.done = set(json.loads(done))
+        self._next = self.position
+        self._in_flight: Dict[int, int] = {}
+        self._unsaved = 0
+
+    def pending(self, exclude_user_id: Optional[int] = None) -> Iterator[int]:
+        """
+        Yields the recipients that still have to be delivered to.
+        """
+        for position, user_id in self.users.iter_from(self.position):
+            if position in self.done or user_id == exclude_user_id:
+                continue
+            self._in_flight[user_id] = position
+            self._next = position + 1
+            yield user_id
+
+    def complete(self, user_id: int, ok: bool) -> None:
+        """
+        Records that delivery to `user_id` finished (successfully or not).
+        """
+        position = self._in_flight.pop(user_id, None)
+        if position is None:
+            return
+        self.done.add(position)
+        if ok:
+            self.sent += 1
+        else:
+            self.failed += 1
+        self._unsaved += 1
+        if self._unsaved >= self.checkpoint_every:
+            self.save()
+
+    def save(self) -> None:
+        """
+        Writes the checkpoint.
+        """
+        self.position = min(self._in_flight.values(), default=self._next)
+        self.done = {position for position in self.done if position >= self.position}
+        self.queue.conn.execute(
+            "INSERT INTO job_cursors (job_id, step, position, anchor, done, total, sent, failed, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (job_id, step) DO UPDATE SET position = excluded.position, anchor = excluded.anchor, "
+            "done = excluded.done, total = excluded.total, sent = excluded.sent, failed = excluded.failed, "
+            "updated_at = excluded.updated_at",
+            (
+                self.job_id, self.step, self.position, self.users.anchor(self.position),
+                json.dumps(sorted(self.done)), self.total, self.sent, self.failed, time.time()
+            )
+        )
+        self._unsaved = 0
+
+
+# Per-job record of what has already been delivered:
+class JobProgress:
+    """
+    Tracks completed steps and the broadcast cursors of one job so a resumed
+    job does not repeat them.
+
+    Parameters:
+      queue: The queue the job belongs to.
+      job_id: The job ID.
+      checkpoint_every: Number of deliveries between broadcast checkpoints.
+    """
+
+    def __init__(self, queue: DeliveryQueue, job_id: int, checkpoint_every: int = 100) -> None:
+        self.queue = queue
+        self.job_id = job_id
+        self.checkpoint_every = checkpoint_every
+        self._cursors: List[BroadcastCursor] = []
+
+    def is_done(self, step: str) -> bool:
+        return self.queue.conn.execute(
+            "SELECT 1 FROM job_steps WHERE job_id = ? AND step = ?",
+            (self.job_id, step)
+        ).fetchone() is not None
+
+    def mark_done(self, step: str) -> None:
+        self.flush()
+        self.queue.conn.execute(
+            "INSERT OR IGNORE INTO job_steps (job_id, step) VALUES (?, ?)",
+            (self.job_id, step)
+        )
+
+    def recipients(self, step: str, build: Callable[[], List[int]]) -> List[int]:
+        """
+        Returns the recipient list of a broadcast step: the one saved by a
+        previous attempt, or the one returned by `build`, which is saved
+        (as packed int64s) so a resumed job goes through the same list.
+        """
+        row = self.queue.conn.execute(
+            "SELECT users FROM job_recipients WHERE job_id = ? AND step = ?",
+            (self.job_id, step)
+        ).fetchone()
+        if row is not None:
+            user_ids = array("q")
+            user_ids.frombytes(row[0])
+            return user_ids.tolist()
+        user_ids = build()
+        self.queue.conn.execute(
+            "INSERT INTO job_recipients (job_id, step, users) VALUES (?, ?, ?)",
+            (self.job_id, step, array("q", user_ids).tobytes())
+        )
+        return user_ids
+
+    def cursor(self, step: str, users: Any) -> BroadcastCursor:
+        """
+        Returns the cursor of a broadcast step, resumed from its last
+        checkpoint if there is one.
+        """
+        cursor = BroadcastCursor(self.queue, self.job_id, step, users, self.checkpoint_every)
+        self._cursors.append(cursor)
+        return cursor
+
+    def flush(self) -> None:
+        for cursor in self._cursors:
+            cursor.save()
+
+
+JobProcessor = Callable[[int, Dict[str, Any], JobProgress], Awaitable[None]]
+
+
+class JobParked(Exception):
+    """
+    Raised by a job processor that parked its job (see DeliveryQueue.park);
+    the worker leaves the job's status alone.
+    """
+
+
+# Pool of async workers draining the queue:
+class DeliveryWorkers:
+    """
+    Runs `count` workers that claim jobs from the queue and hand them to
+    `process`.
+
+    Parameters:
+      queue: The queue to drain.
+      process: Coroutine called with the job ID, payload and progress tracker.
+      count: Number of jobs processed concurrently.
+      poll_interval: How often idle workers re-check the queue, in seconds.
+        Jobs enqueued by another process are only noticed by polling.
+      partition: If set, only jobs of this partition are processed.
+      checkpoint_every: Number of deliveries between broadcast checkpoints.
+      per_sender: Maximum number of one sender's jobs processed at once
+        (0 for no limit).
+    """
+
+    def __init__(
+        self,
+        queue: DeliveryQueue,
+        process: JobProcessor,
+        count: int = 4,
+        poll_interval: float = 5.0,
+        partition: Optional[int] = None,
+        checkpoint_every: int = 100,
+        per_sender: int = 1
+    ) -> None:
+        self.queue = queue
+        self.process = process
+        self.count = max(1, count)
+        self.poll_interval = poll_interval
+        self.partition = partition
+        self.checkpoint_every = checkpoint_every
+        self.per_sender = per_sender
+        self._tasks: List[asyncio.Task] = []
+        self._draining = False
+
+    def start(self) -> None:
+        recovered = self.queue.recover(self.partition)
+        if recovered:
+            logging.info(f"Resuming {recovered} unfinished delivery jobs")
+        self._draining = False
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(self.count)]
+
+    async def stop(self, timeout: float = 0.0) -> None:
+        """
+        Stops the workers. No new jobs are claimed; jobs in progress get up
+        to `timeout` seconds to finish, after which they are cancelled with
+        their progress checkpointed, to be resumed on the next start.
+        """
+        self._draining = True
+        self.queue.wake()
+        if timeout > 0 and self._tasks:
+            _, pending = await asyncio.wait(self._tasks, timeout=timeout)
+            if pending:
+                logging.warning(f"{len(pending)} delivery jobs did not finish in {timeout:g}s, checkpointing them")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _run(self) -> None:
+        while not self._draining:
+            job = self.queue.claim(self.partition, self.per_sender)
+            if job is None:
+                await self.queue.wait(self.poll_interval)
+                continue
+
+            job_id, payload = job
+            progress = JobProgress(self.queue, job_id, self.checkpoint_every)
+            try:
+                await self.process(job_id, payload, progress)
+            except asyncio.CancelledError:
+                # Keep what was delivered so far; the job is resumed on restart
+                progress.flush()
+                raise
+            except JobParked:
+                continue
+            except Exception as e:
+                logging.error(f"Delivery job {job_id} failed: {e}")
+                self.queue.finish(job_id, error=str(e))
+            else:
+                self.queue.finish(job_id)
+
+
+def open_queue(partitions: int = 1) -> DeliveryQueue:
+    """
+    Opens the delivery queue in DATA_DIR.
+    """
+    return DeliveryQueue(os.path.join(os.getenv("DATA_DIR", "data"), "queue.db"), partitions=partitions)
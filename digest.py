@@ -0,0 +1,226 @@
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Set, Tuple
+import json
+import logging
+import os
+import sqlite3
+import time
+
+
+# Longest message Telegram accepts, counted in UTF-16 code units like entity offsets
+MESSAGE_LIMIT = 4096
+ITEM_SEPARATOR = "\n\n"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS digest_users (
+    user_id INTEGER PRIMARY KEY,
+    since REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS digest_items (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at REAL NOT NULL,
+    sender_id INTEGER NOT NULL,
+    source_chat_id INTEGER NOT NULL,
+    message_ids TEXT NOT NULL,
+    text TEXT,
+    entities TEXT NOT NULL DEFAULT '[]',
+    channel_message_id INTEGER
+);
+CREATE INDEX IF NOT EXISTS digest_items_created ON digest_items (created_at);
+CREATE TABLE IF NOT EXISTS digest_meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER
+);
+"""
+
+
+def utf16_length(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+def channel_link(channel_id: int, message_id: int, username: Optional[str] = None) -> str:
+    """
+    Returns the t.me link to a channel post: the public one if the channel
+    has a username, otherwise the one that works for channel members.
+    """
+    if username:
+        return f"https://t.me/{username}/{message_id}"
+    return f"https://t.me/c/{str(channel_id).removeprefix('-100')}/{message_id}"
+
+
+# One message waiting for the next digest:
+@dataclass
+class DigestItem:
+    sender_id: int
+    # Text posts keep their text; anything else links to its channel post
+    text: Optional[str]
+    entities: List[Dict[str, Any]]
+    channel_message_id: Optional[int]
+
+
+def build_digest(
+    items: List[DigestItem],
+    channel_id: int,
+    username: Optional[str] = None,
+    limit: int = MESSAGE_LIMIT
+) -> List[Tuple[str, List[Dict[str, Any]]]]:
+    """
+    Merges digest items into as few messages as possible, each at most
+    `limit` UTF-16 code units long. Returns (text, entities) per message,
+    with the entities of every item shifted to its place in the message.
+    An item is never split: a text post fits in one message on its own.
+    """
+    messages: List[Tuple[str, List[Dict[str, Any]]]] = []
+    parts: List[str] = []
+    entities: List[Dict[str, Any]] = []
+    length = 0
+    for item in items:
+        if item.text is not None:
+            text, item_entities = item.text, item.entities
+        elif item.channel_message_id is not None:
+            text, item_entities = "📎 " + channel_link(channel_id, item.channel_message_id, username), []
+        else:
+            continue
+        item_length = utf16_length(text)
+        offset = length + utf16_length(ITEM_SEPARATOR) if parts else 0
+        if parts and offset + item_length > limit:
+            messages.append(("".join(parts), entities))
+            parts, entities, length, offset = [], [], 0, 0
+        if parts:
+            parts.append(ITEM_SEPARATOR)
+        parts.append(text)
+        entities.extend(dict(entity, offset=entity["offset"] + offset) for entity in item_entities)
+        length = offset + item_length
+    if parts:
+        messages.append(("".join(parts), entities))
+    return messages
+
+
+# Digest subscriptions and the messages waiting for the next digest:
+class DigestStore:
+    """
+    Keeps the users who opted into digests instead of a message per post,
+    and the posts since the last digest, in SQLite so every worker process
+    sees them.
+
+    Parameters:
+      path: Path to the SQLite database file.
+      retention: How long posts are kept after they are added, in seconds.
+    """
+
+    def __init__(self, path: str, retention: float = 7 * 24 * 3600) -> None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.retention = retention
+        self.conn = sqlite3.connect(path, isolation_level=None, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def toggle(self, user_id: int) -> bool:
+        """
+        Subscribes a user to digests, or unsubscribes them.
+
+        Returns:
+          True if the user now gets digests.
+        """
+        if self.conn.execute("DELETE FROM digest_users WHERE user_id = ?", (user_id,)).rowcount:
+            return False
+        self.conn.execute("INSERT INTO digest_users (user_id, since) VALUES (?, ?)", (user_id, time.time()))
+        return True
+
+    def subscribers(self) -> Set[int]:
+        return {user_id for (user_id,) in self.conn.execute("SELECT user_id FROM digest_users")}
+
+    def add(
+        self,
+        sender_id: int,
+        source_chat_id: int,
+        message_ids: List[int],
+        text: Optional[str],
+        entities: List[Dict[str, Any]],
+        channel_message_id: Optional[int]
+    ) -> None:
+        now = time.time()
+        self.conn.execute(
+            "INSERT INTO digest_items (created_at, sender_id, source_chat_id, message_ids, text, entities, channel_message_id) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (now, sender_id, source_chat_id, json.dumps(message_ids), text, json.dumps(entities), channel_message_id)
+        )
+
+    def update(self, source_chat_id: int, message_id: int, text: str, entities: List[Dict[str, Any]]) -> bool:
+        """
+        Applies an edit to a text post that is still waiting for a digest.
+
+        Returns:
+          True if such a post was found.
+        """
+        return self.conn.execute(
+            "UPDATE digest_items SET text = ?, entities = ? "
+            "WHERE source_chat_id = ? AND text IS NOT NULL AND id > ? AND "
+            "EXISTS (SELECT 1 FROM json_each(message_ids) WHERE value = ?)",
+            (text, json.dumps(entities), source_chat_id, self._sent_up_to(), message_id)
+        ).rowcount > 0
+
+    def forget(self, source_chat_id: int, message_id: int) -> None:
+        """
+        Drops a retracted post (or the album it belongs to) from digests.
+        """
+        self.conn.execute(
+            "DELETE FROM digest_items WHERE source_chat_id = ? AND "
+            "EXISTS (SELECT 1 FROM json_each(message_ids) WHERE value = ?)",
+            (source_chat_id, message_id)
+        )
+
+    def items(self, after_id: int, up_to_id: int) -> List[DigestItem]:
+        rows = self.conn.execute(
+            "SELECT sender_id, text, entities, channel_message_id FROM digest_items WHERE id > ? AND id <= ? ORDER BY id",
+            (after_id, up_to_id)
+        )
+        return [
+            DigestItem(sender_id, text, json.loads(entities), channel_message_id)
+            for sender_id, text, entities, channel_message_id in rows
+        ]
+
+    def _sent_up_to(self) -> int:
+        row = self.conn.execute("SELECT value FROM digest_meta WHERE key = 'sent_up_to'").fetchone()
+        return row[0] if row else 0
+
+    def take_batch(self) -> Optional[Tuple[int, int]]:
+        """
+        Claims the posts added since the last digest.
+
+        Returns:
+          The (after_id, up_to_id) range of item IDs for the digest job, or
+          None if there is nothing new.
+        """
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            after_id = self._sent_up_to()
+            up_to_id = self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM digest_items").fetchone()[0]
+            if up_to_id <= after_id:
+                return None
+            self.conn.execute(
+                "INSERT INTO digest_meta (key, value) VALUES ('sent_up_to', ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                (up_to_id,)
+            )
+            deleted = self.conn.execute(
+                "DELETE FROM digest_items WHERE created_at < ?", (time.time() - self.retention,)
+            ).rowcount
+            if deleted:
+                logging.info(f"Pruned {deleted} old digest items")
+            return after_id, up_to_id
+        finally:
+            self.conn.execute("COMMIT")
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def open_digest() -> DigestStore:
+    """
+    Opens the digest store in DATA_DIR.
+    """
+    return DigestStore(os.path.join(os.getenv("DATA_DIR", "data"), "digest.db"))
@@ -0,0 +1,358 @@
+from aiogram.exceptions import TelegramRetryAfter
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Hashable, Iterable, List, Optional
+import asyncio
+import logging
+import os
+import time
+
+from metrics import BROADCAST_DURATION, SEND_LATENCY, SENDS, send_outcome
+
+
+# Token bucket used for both the global and the per-chat send limits:
+class TokenBucket:
+    """
+    A token bucket that hands out reservations instead of blocking.
+
+    Tokens may go negative: every caller reserves its token immediately and
+    sleeps for the returned delay, so waiting senders are served in the
+    order they asked without needing a lock.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None) -> None:
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        """
+        Takes one token and returns how many seconds the caller has to wait
+        before using it.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def try_take(self) -> bool:
+        """
+        Takes one token if one is available, without reserving ahead.
+
+        Returns:
+          False if the bucket is empty.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def is_idle(self, now: float) -> bool:
+        """
+        Returns True if the bucket would be full again at `now`, i.e. it holds
+        no state worth keeping.
+        """
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+    async def acquire(self) -> None:
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def _observe_send(started: float, error: Optional[Exception]) -> None:
+    outcome = send_outcome(error)
+    SENDS.inc(outcome=outcome)
+    SEND_LATENCY.observe(time.monotonic() - started, outcome=outcome)
+
+
+# Send priorities, lower goes first
+PRIORITY_HIGH = 0  # channel posts
+PRIORITY_NORMAL = 1  # text, stickers and other small messages
+PRIORITY_LOW = 2  # media and albums
+PRIORITY_IDLE = 3  # subscribers who have not posted for a long time
+
+
+# Hands out send slots fairly across broadcasts:
+class FairScheduler:
+    """
+    A semaphore that, when slots are contended, serves waiters by priority
+    and round-robin between keys (senders) of the same priority instead of
+    first come, first served. A sender whose burst of messages is being
+    broadcast therefore only gets its fair share of the slots while other
+    senders' messages are going out.
+
+    Parameters:
+      slots: Number of slots (requests in flight).
+    """
+
+    def __init__(self, slots: int) -> None:
+        self.free = slots
+        # priority -> key -> waiters of that key, keys in round-robin order
+        self._waiting: Dict[int, "OrderedDict[Hashable, Deque[asyncio.Future]]"] = {}
+
+    def _has_waiters(self) -> bool:
+        return any(self._waiting.values())
+
+    async def acquire(self, key: Hashable = None, priority: int = PRIORITY_NORMAL) -> None:
+        if self.free > 0 and not self._has_waiters():
+            self.free -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(priority, OrderedDict()).setdefault(key, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as the waiter was cancelled
+                self.release()
+            else:
+                waiters = self._waiting.get(priority, {}).get(key)
+                if waiters is not None and future in waiters:
+                    waiters.remove(future)
+                    if not waiters:
+                        del self._waiting[priority][key]
+            raise
+
+    def release(self) -> None:
+        for priority in sorted(self._waiting):
+            keys = self._waiting[priority]
+            while keys:
+                key, waiters = next(iter(keys.items()))
+                future = waiters.popleft()
+                if waiters:
+                    keys.move_to_end(key)
+                else:
+                    del keys[key]
+                if not future.done():
+                    future.set_result(None)
+                    return
+        self.free += 1
+
+    @asynccontextmanager
+    async def slot(self, key: Hashable = None, priority: int = PRIORITY_NORMAL) -> AsyncIterator[None]:
+        await self.acquire(key, priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+# Result of a single broadcast:
+@dataclass
+class BroadcastResult:
+    sent: int = 0
+    failed: int = 0
+    elapsed: float = 0.0
+
+
+# Shared fan-out engine every broadcast goes through:
+class FanOutEngine:
+    """
+    Sends one piece of content to many chats concurrently while staying under
+    Telegram's rate limits.
+
+    Parameters:
+      concurrency: Maximum number of requests in flight across all broadcasts.
+      global_rate: Maximum messages per second for the whole bot.
+      per_chat_rate: Maximum messages per second to a single chat.
+      max_retries: How many times a send is retried after a RetryAfter error.
+    """
+
+    # Prune idle per-chat buckets once the table grows past this size
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(
+        self,
+        concurrency: int = 20,
+        global_rate: float = 25.0,
+        per_chat_rate: float = 1.0,
+        max_retries: int = 3
+    ) -> None:
+        self.concurrency = max(1, concurrency)
+        self.per_chat_rate = per_chat_rate
+        self.max_retries = max_retries
+        self._scheduler = FairScheduler(self.concurrency)
+        self._global_bucket = TokenBucket(global_rate)
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._paused_until = 0.0
+        self._observers: List[Callable[[int, Optional[Exception]], None]] = []
+
+    def set_global_rate(self, rate: float) -> None:
+        """
+        Changes the bot-wide rate limit, e.g. when several processes share
+        one bot token.
+        """
+        self._global_bucket = TokenBucket(rate)
+
+    def add_observer(self, observer: Callable[[int, Optional[Exception]], None]) -> None:
+        """
+        Registers a callback invoked with the chat ID and the error (None on
+        success) after every broadcast delivery attempt.
+        """
+        self._observers.append(observer)
+
+    def _notify(self, chat_id: int, error: Optional[Exception]) -> None:
+        for observer in self._observers:
+            try:
+                observer(chat_id, error)
+            except Exception as e:
+                logging.error(f"Delivery observer failed for {chat_id}: {e}")
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= self.MAX_CHAT_BUCKETS:
+                now = time.monotonic()
+                self._chat_buckets = {
+                    key: value for key, value in self._chat_buckets.items()
+                    if not value.is_idle(now)
+                }
+            bucket = TokenBucket(self.per_chat_rate, capacity=1.0)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def _wait_for_pause(self) -> None:
+        # A RetryAfter from Telegram applies to the whole bot, so every sender waits it out
+        while True:
+            delay = self._paused_until - time.monotonic()
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+    async def send(
+        self,
+        chat_id: int,
+        send: Callable[[int], Awaitable[Any]],
+        key: Hashable = None,
+        priority: int = PRIORITY_NORMAL
+    ) -> Any:
+        """
+        Performs one rate-limited send to `chat_id`, retrying on RetryAfter.
+
+        Parameters:
+          chat_id: The chat the request targets.
+          send: Coroutine factory that performs the actual Bot API call.
+          key: Who the send is for (the sender of the message); slots are
+            shared round-robin between keys.
+          priority: PRIORITY_HIGH, PRIORITY_NORMAL or PRIORITY_LOW.
+
+        Returns:
+          Whatever `send` returned. Any error other than RetryAfter, or a
+          RetryAfter after `max_retries` attempts, is raised to the caller.
+        """
+        attempt = 0
+        async with self._scheduler.slot(key, priority):
+            while True:
+                await self._chat_bucket(chat_id).acquire()
+                await self._global_bucket.acquire()
+                await self._wait_for_pause()
+                started = time.monotonic()
+                try:
+                    sent = await send(chat_id)
+                except TelegramRetryAfter as e:
+                    _observe_send(started, e)
+                    attempt += 1
+                    self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                    # Lazy formatting: most of these records are dropped by sampling
+                    logging.warning(
+                        "Rate limited while sending to %s, retrying in %ss", chat_id, e.retry_after,
+                        extra={"event": "send_retry", "chat_id": chat_id}
+                    )
+                    if attempt > self.max_retries:
+                        raise
+                except Exception as e:
+                    _observe_send(started, e)
+                    raise
+                else:
+                    _observe_send(started, None)
+                    return sent
+
+    async def broadcast(
+        self,
+        recipients: Iterable[int],
+        send: Callable[[int], Awaitable[Any]],
+        label: str = "message",
+        on_sent: Optional[Callable[[int, Any], None]] = None,
+        on_failed: Optional[Callable[[int, Exception], None]] = None,
+        key: Hashable = None,
+        priority: int = PRIORITY_NORMAL
+    ) -> BroadcastResult:
+        """
+        Delivers content to every chat in `recipients`.
+
+        Recipients are consumed lazily by a fixed number of workers, so the
+        iterable may be a generator over a large subscriber list.
+
+        Parameters:
+          recipients: Chat IDs to deliver to.
+          send: Coroutine factory called with each chat ID.
+          label: Name of the content type, used in log lines.
+          on_sent: Optional callback invoked with the chat ID and the API
+            result after each successful send.
+          on_failed: Optional callback invoked with the chat ID and the
+            error after each failed send.
+          key: Fairness key of the broadcast (see `send`).
+          priority: Priority of the broadcast's sends.
+
+        Returns:
+          A BroadcastResult with sent and failed counts and elapsed time.
+        """
+        result = BroadcastResult()
+        started = time.monotonic()
+        iterator = iter(recipients)
+
+        async def worker() -> None:
+            for chat_id in iterator:
+                try:
+                    sent = await self.send(chat_id, send, key, priority)
+                except Exception as e:
+                    result.failed += 1
+                    logging.error(
+                        "Error sending %s to user %s: %s", label, chat_id, e,
+                        extra={"event": "send_failed", "chat_id": chat_id}
+                    )
+                    self._notify(chat_id, e)
+                    if on_failed is not None:
+                        on_failed(chat_id, e)
+                    continue
+                result.sent += 1
+                self._notify(chat_id, None)
+                if on_sent is not None:
+                    on_sent(chat_id, sent)
+
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+        result.elapsed = time.monotonic() - started
+        BROADCAST_DURATION.observe(result.elapsed, label=label)
+        logging.info(
+            f"Broadcast of {label} finished: sent={result.sent}, "
+            f"failed={result.failed}, elapsed={result.elapsed:.2f}s"
+        )
+        return result
+
+
+_engine: Optional[FanOutEngine] = None
+
+
+def get_engine() -> FanOutEngine:
+    """
+    Returns the process-wide fan-out engine, creating it from environment
+    variables on first use.
+    """
+    global _engine
+    if _engine is None:
+        _engine = FanOutEngine(
+            concurrency=int(os.getenv("BROADCAST_CONCURRENCY", "20")),
+            global_rate=float(os.getenv("GLOBAL_RATE_LIMIT", "25")),
+            per_chat_rate=float(os.getenv("PER_CHAT_RATE_LIMIT", "1")),
+            max_retries=int(os.getenv("BROADCAST_MAX_RETRIES", "3"))
+        )
+    return _engine
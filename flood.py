@@ -0,0 +1,100 @@
+from aiogram import BaseMiddleware, types
+from typing import Any, Awaitable, Callable, Dict, Optional
+import logging
+import os
+import time
+
+from cache import TTLCache
+from fanout import TokenBucket
+from metrics import FLOOD_REJECTED
+from utils import is_admin
+
+
+# Per-user state kept by FloodControlMiddleware:
+class _FloodState:
+    __slots__ = ("bucket", "cooldown_until", "media_group_id")
+
+    def __init__(self, bucket: TokenBucket) -> None:
+        self.bucket = bucket
+        self.cooldown_until = 0.0
+        self.media_group_id: Optional[str] = None
+
+
+# Dispatcher middleware that throttles incoming messages per user:
+class FloodControlMiddleware(BaseMiddleware):
+    """
+    Limits how many messages each user can send before they are fanned out.
+
+    Every user has a token bucket allowing `burst` messages at once and
+    `rate` messages per second sustained; an album counts as one message.
+    A user who runs out is put on a cooldown of `cooldown` seconds: they are
+    told once, and their messages are dropped until it ends. Admins and
+    commands (/retract, /digest, ...) are never throttled.
+
+    Per-user state lives in a TTLCache, so at most `max_users` users are
+    tracked and idle entries expire once their bucket would be full again.
+
+    Parameters:
+      rate: Sustained messages per second per user.
+      burst: Messages a user can send at once.
+      cooldown: Seconds a user who hit the limit has to wait.
+      max_users: Maximum number of users tracked at once.
+    """
+
+    def __init__(self, rate: float, burst: int, cooldown: float, max_users: int = 100000) -> None:
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.cooldown = cooldown
+        self._users: TTLCache[_FloodState] = TTLCache(max_users, ttl=self.burst / rate + cooldown)
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: types.Message,
+        data: Dict[str, Any]
+    ) -> Any:
+        # A matched Command filter leaves its CommandObject in `data`
+        if not event.from_user or is_admin(event.from_user.id) or "command" in data:
+            return await handler(event, data)
+
+        user_id = event.from_user.id
+        state = self._users.get(user_id)
+        if state is None:
+            state = _FloodState(TokenBucket(self.rate, capacity=self.burst))
+        # Setting the entry on every message keeps active users from expiring
+        self._users.set(user_id, state)
+
+        now = time.monotonic()
+        if now < state.cooldown_until:
+            FLOOD_REJECTED.inc()
+            return None
+        # The parts of an album count as one message
+        if event.media_group_id and event.media_group_id == state.media_group_id:
+            return await handler(event, data)
+        state.media_group_id = event.media_group_id
+        if not state.bucket.try_take():
+            state.cooldown_until = now + self.cooldown
+            FLOOD_REJECTED.inc()
+            logging.warning(f"User {user_id} is sending too fast, cooldown for {self.cooldown:.0f}s")
+            await event.answer(
+                f"You are sending messages too fast. Please wait {self.cooldown:.0f} seconds; "
+                "messages sent until then will not be delivered."
+            )
+            return None
+        return await handler(event, data)
+
+
+def flood_control_from_env() -> Optional[FloodControlMiddleware]:
+    """
+    Builds the middleware from FLOOD_RATE, FLOOD_BURST, FLOOD_COOLDOWN and
+    FLOOD_MAX_USERS, or returns None if FLOOD_RATE is 0.
+    """
+    rate = float(os.getenv("FLOOD_RATE", "0.2"))
+    if rate <= 0:
+        return None
+    return FloodControlMiddleware(
+        rate=rate,
+        burst=int(os.getenv("FLOOD_BURST", "5")),
+        cooldown=float(os.getenv("FLOOD_COOLDOWN", "60")),
+        max_users=int(os.getenv("FLOOD_MAX_USERS", "100000"))
+    )
@@ -0,0 +1,160 @@
+from aiogram import BaseMiddleware
+from contextlib import contextmanager, suppress
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Set, Tuple
+import asyncio
+import logging
+import signal
+import time
+
+from metrics import STARTUP_PHASE, TIME_TO_FIRST_UPDATE
+
+
+# Timings of the startup phases:
+class StartupTimer:
+    """
+    Measures how long each startup phase takes and how long after process
+    start the first update is handled, and reports both in the log and as
+    metrics.
+
+    Parameters:
+      started: time.perf_counter() value taken when the process started.
+    """
+
+    def __init__(self, started: float) -> None:
+        self.started = started
+        self.phases: List[Tuple[str, float]] = []
+        self._first_update_seen = False
+
+    def record(self, name: str, seconds: float) -> None:
+        self.phases.append((name, seconds))
+        STARTUP_PHASE.set(seconds, phase=name)
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def report(self) -> None:
+        phases = ", ".join(f"{name} {seconds:.3f}s" for name, seconds in self.phases)
+        logging.info(f"Started in {time.perf_counter() - self.started:.3f}s ({phases})")
+
+    def first_update(self) -> None:
+        if self._first_update_seen:
+            return
+        self._first_update_seen = True
+        seconds = time.perf_counter() - self.started
+        TIME_TO_FIRST_UPDATE.set(seconds)
+        logging.info(f"First update handled {seconds:.3f}s after start")
+
+
+# One-off startup calls that must not delay polling:
+class BackgroundTasks:
+    """
+    Runs coroutines in the background, logging their failures and keeping
+    references so they are not garbage-collected mid-flight.
+    """
+
+    def __init__(self) -> None:
+        self._tasks: Set[asyncio.Task] = set()
+
+    def run(self, name: str, coroutine: Awaitable[Any]) -> None:
+        async def wrapper() -> None:
+            started = time.perf_counter()
+            try:
+                await coroutine
+            except Exception as e:
+                logging.error(f"Background task {name} failed: {e}")
+            else:
+                logging.info(f"Background task {name} finished in {time.perf_counter() - started:.3f}s")
+
+        task = asyncio.create_task(wrapper())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def cancel(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+def install_stop_handlers(stop: asyncio.Event) -> None:
+    """
+    Sets `stop` on SIGTERM (e.g. `docker-compose stop`) and SIGINT (Ctrl+C)
+    instead of letting them kill the process, so shutdown can drain the
+    outbound work first.
+    """
+    loop = asyncio.get_running_loop()
+
+    def on_signal(sig: signal.Signals) -> None:
+        if stop.is_set():
+            logging.warning(f"Received {sig.name} again, still shutting down")
+            return
+        logging.info(f"Received {sig.name}, shutting down")
+        stop.set()
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        # Signal handlers are not supported on Windows
+        with suppress(NotImplementedError):
+            loop.add_signal_handler(sig, on_signal, sig)
+
+
+async def wait_for_stop(stop: asyncio.Event, serving: asyncio.Task) -> None:
+    """
+    Waits until `stop` is set or `serving` (the polling loop or webhook
+    server) ends on its own; errors from `serving` are raised.
+    """
+    stopped = asyncio.create_task(stop.wait())
+    try:
+        await asyncio.wait([stopped, serving], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        stopped.cancel()
+    if serving.done():
+        serving.result()
+
+
+# Outer update middleware that tracks updates being handled:
+class InFlightUpdates(BaseMiddleware):
+    """
+    Counts the updates currently being handled so shutdown can wait for
+    them before the queue and storage are closed. `on_update` is called
+    after each update is handled.
+    """
+
+    def __init__(self, on_update: Optional[Callable[[], None]] = None) -> None:
+        self.count = 0
+        self.on_update = on_update
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any]
+    ) -> Any:
+        self.count += 1
+        self._idle.clear()
+        try:
+            return await handler(event, data)
+        finally:
+            self.count -= 1
+            if not self.count:
+                self._idle.set()
+            if self.on_update is not None:
+                self.on_update()
+
+    async def wait_idle(self, timeout: float) -> bool:
+        """
+        Waits up to `timeout` seconds for every update to be handled.
+
+        Returns:
+          False if updates were still being handled at the deadline.
+        """
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
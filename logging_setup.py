@@ -0,0 +1,170 @@
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+from typing import Any, Dict, Optional
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import time
+
+
+# Attributes every LogRecord has; anything else was passed through `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+TEXT_FORMAT = "%(asctime)s - %(processName)s - %(name)s - %(levelname)s - %(message)s"
+
+
+# One JSON object per log line:
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as JSON with the time, level, process, logger and
+    message, plus any fields passed with `extra=` (e.g. event and chat_id).
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "process": record.processName,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+# Hands records to the background writer:
+class LogQueueHandler(QueueHandler):
+    """
+    Like QueueHandler, but keeps a record's traceback in `exc_text` instead
+    of folding it into the message, so the JSON formatter can put it in its
+    own 'exception' field.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+# Keeps a fraction of high-volume events:
+class SamplingFilter(logging.Filter):
+    """
+    Lets through one in every `1 / rate` records of each sampled event and
+    all other records. Events are named with `extra={"event": ...}`; kept
+    records get a 'sampled' field with the sampling factor so counts can be
+    scaled back up.
+
+    Parameters:
+      rate: Fraction of sampled events to keep (1 keeps everything).
+      events: Names of the events that are sampled.
+    """
+
+    def __init__(self, rate: float, events: set) -> None:
+        super().__init__()
+        self.every = max(1, round(1 / rate)) if rate > 0 else 0
+        self.events = events
+        self._seen: Dict[str, int] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        event = getattr(record, "event", None)
+        if event not in self.events:
+            return True
+        if not self.every:
+            return False
+        seen = self._seen.get(event, 0)
+        self._seen[event] = seen + 1
+        if seen % self.every:
+            return False
+        record.sampled = self.every
+        return True
+
+
+# Per-recipient events logged once per delivery attempt (slow requests are
+# mostly broadcast sends when Telegram is slow)
+SAMPLED_EVENTS = {"send_failed", "send_retry", "slow_request"}
+
+_listener: Optional[QueueListener] = None
+
+
+def setup_logging(log_name: str = "bot") -> None:
+    """
+    Configures logging to the console and LOG_DIR/<log_name>.log.
+
+    Records are put on an in-memory queue by the logging calls and written
+    by a background thread, so formatting and disk writes do not block the
+    event loop.
+
+    Settings (environment variables):
+      LOG_LEVEL: Minimum level, INFO by default; DEBUG enables per-message
+        diagnostics.
+      LOG_FORMAT: 'json' (default) or 'text'.
+      LOG_DIR: Directory of the log file, /logs by default.
+      LOG_MAX_BYTES / LOG_BACKUP_COUNT: Size-based rotation (10 MB, 5 files).
+      LOG_ROTATE_WHEN: If set (e.g. 'midnight'), rotate by time instead.
+      LOG_SAMPLE_RATE: Fraction of per-recipient send errors and retries
+        that are logged; 1 (everything) by default, lower it to sample
+        them on large audiences.
+    """
+    global _listener
+    stop_logging()
+
+    log_dir = os.getenv("LOG_DIR", "/logs")
+    os.makedirs(log_dir, exist_ok=True)
+    path = os.path.join(log_dir, f"{log_name}.log")
+    rotate_when = os.getenv("LOG_ROTATE_WHEN")
+    backup_count = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+    if rotate_when:
+        file_handler = TimedRotatingFileHandler(path, when=rotate_when, backupCount=backup_count, encoding="utf-8")
+    else:
+        file_handler = RotatingFileHandler(
+            path,
+            maxBytes=int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024))),
+            backupCount=backup_count,
+            encoding="utf-8"
+        )
+
+    formatter = JsonFormatter() if os.getenv("LOG_FORMAT", "json") == "json" else logging.Formatter(TEXT_FORMAT)
+    handlers = [logging.StreamHandler(), file_handler]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = LogQueueHandler(log_queue)
+    # Dropped records are never formatted or queued
+    queue_handler.addFilter(SamplingFilter(float(os.getenv("LOG_SAMPLE_RATE", "1")), SAMPLED_EVENTS))
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+
+    _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def stop_logging() -> None:
+    """
+    Writes out the queued records and stops the background writer.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+atexit.register(stop_logging)
@@ -0,0 +1,281 @@
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+import asyncio
+import logging
+import os
+import sys
+import sysconfig
+import threading
+import time
+import traceback
+
+from metrics import LOOP_LAG, LOOP_STALLS, SLOW_CALLS
+
+
+# Methods that are slow by design (long polling)
+_IGNORED_METHODS = {"getUpdates"}
+
+
+# Frames from the standard library and installed packages are left out of
+# snapshots (as are the watchdog's own), except the innermost one, so they
+# point at the bot's own code
+_LIBRARY_PATHS = tuple({sysconfig.get_paths()["stdlib"], sysconfig.get_paths()["purelib"], sysconfig.get_paths()["platlib"]})
+
+
+def _format_frames(frames: List[Any], limit: int = 8) -> str:
+    """
+    Formats frames (outermost first) as a traceback.
+    """
+    frames = [
+        frame for index, frame in enumerate(frames)
+        if index == len(frames) - 1
+        or not (frame.f_code.co_filename.startswith(_LIBRARY_PATHS) or frame.f_code.co_filename == __file__)
+    ]
+    return "".join(traceback.StackSummary.extract(
+        ((frame, frame.f_lineno) for frame in frames[-limit:]), lookup_lines=True
+    ).format())
+
+
+def _awaited_frames(task: asyncio.Task) -> List[Any]:
+    # Task.get_stack() stops at the task's own coroutine; follow what it awaits
+    frames = []
+    awaitable: Any = task.get_coro()
+    while awaitable is not None:
+        frame = getattr(awaitable, "cr_frame", None) or getattr(awaitable, "gi_frame", None)
+        if frame is None:
+            break
+        frames.append(frame)
+        awaitable = getattr(awaitable, "cr_await", None) or getattr(awaitable, "gi_yieldfrom", None)
+    return frames
+
+
+# One place in the code that was caught being slow:
+class Offender:
+    __slots__ = ("kind", "name", "count", "worst", "total", "stack")
+
+    def __init__(self, kind: str, name: str) -> None:
+        self.kind = kind
+        self.name = name
+        self.count = 0
+        self.worst = 0.0
+        self.total = 0.0
+        self.stack = ""
+
+    def record(self, seconds: float, stack: str) -> None:
+        self.count += 1
+        self.total += seconds
+        if seconds >= self.worst:
+            self.worst = seconds
+            if stack:
+                self.stack = stack
+
+
+# Detects event-loop stalls and slow handlers and API calls:
+class LoopWatchdog:
+    """
+    Samples event-loop latency every `interval` seconds and keeps a record
+    of what was slow:
+
+    - Loop stalls: a thread watches the loop's heartbeat and, when it has
+      been blocked for longer than `stall_threshold`, takes a snapshot of
+      the loop thread's stack, which points at the blocking call.
+    - Slow calls: handlers (by content type) and Bot API requests (by
+      method) taking longer than `slow_threshold`, with the stack of the
+      coroutine where it was waiting when the threshold passed.
+
+    Offenders are grouped by the code location or name, and at most
+    `max_offenders` are kept. Counts are also exported as metrics.
+
+    Parameters:
+      stall_threshold: Loop lag in seconds that counts as a stall.
+      slow_threshold: Duration in seconds that makes a call slow.
+      interval: How often the loop is sampled, in seconds.
+      max_offenders: Maximum number of offenders remembered.
+    """
+
+    def __init__(
+        self,
+        stall_threshold: float = 0.25,
+        slow_threshold: float = 1.0,
+        interval: float = 0.1,
+        max_offenders: int = 50
+    ) -> None:
+        self.stall_threshold = stall_threshold
+        self.slow_threshold = slow_threshold
+        self.interval = interval
+        self.max_offenders = max_offenders
+        self.stalls = 0
+        self.worst_lag = 0.0
+        self.offenders: Dict[Tuple[str, str], Offender] = {}
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+        # Stack of the stall in progress, taken by the watcher thread
+        # (location, stack) of the innermost frame seen while the loop was blocked
+        self._stall_stack: Optional[Tuple[str, str]] = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._task = asyncio.create_task(self._sample())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    async def stop(self) -> None:
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _sample(self) -> None:
+        while True:
+            started = time.monotonic()
+            self._heartbeat = started
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - started - self.interval)
+            LOOP_LAG.observe(lag)
+            with self._lock:
+                stall, self._stall_stack = self._stall_stack, None
+            if lag >= self.stall_threshold:
+                location, stack = stall or (None, None)
+                self._record_stall(lag, location, stack)
+
+    def _watch(self) -> None:
+        # Runs in its own thread, so it sees the loop while it is blocked
+        while not self._stopped.wait(self.interval / 2):
+            if time.monotonic() - self._heartbeat < self.stall_threshold:
+                continue
+            with self._lock:
+                if self._stall_stack is not None:
+                    continue
+                frame = sys._current_frames().get(self._loop_thread_id)
+                if frame is None:
+                    continue
+                top = traceback.extract_stack(frame, limit=1)[-1]
+                location = f"{top.filename}:{top.lineno} in {top.name}"
+                frames = []
+                while frame is not None:
+                    frames.append(frame)
+                    frame = frame.f_back
+                self._stall_stack = location, _format_frames(frames[::-1])
+
+    def _offender(self, kind: str, name: str) -> Offender:
+        key = (kind, name)
+        offender = self.offenders.get(key)
+        if offender is None:
+            if len(self.offenders) >= self.max_offenders:
+                # Forget the offender seen least often
+                del self.offenders[min(self.offenders, key=lambda k: self.offenders[k].count)]
+            offender = self.offenders[key] = Offender(kind, name)
+        return offender
+
+    def _record_stall(self, lag: float, location: Optional[str], stack: Optional[str]) -> None:
+        self.stalls += 1
+        self.worst_lag = max(self.worst_lag, lag)
+        LOOP_STALLS.inc()
+        # The innermost frame of the snapshot names the blocking call
+        self._offender("stall", location or "unknown").record(lag, stack or "")
+        logging.warning(
+            f"Event loop blocked for {lag:.3f}s\n{stack or '(no stack captured)'}",
+            extra={"event": "loop_stall"}
+        )
+
+    def record_slow(self, kind: str, name: str, seconds: float, stack: str) -> None:
+        SLOW_CALLS.inc(kind=kind, name=name)
+        self._offender(kind, name).record(seconds, stack)
+        logging.warning(
+            f"Slow {kind} {name}: {seconds:.3f}s\n{stack}",
+            extra={"event": f"slow_{kind}"}
+        )
+
+    async def timed(self, kind: str, name: str, call: Awaitable[Any]) -> Any:
+        """
+        Awaits `call` and records it if it takes longer than slow_threshold,
+        with the stack where the calling task was waiting at that point.
+        """
+        task = asyncio.current_task()
+        stack: List[str] = []
+
+        def snapshot() -> None:
+            if task is not None:
+                stack.append(_format_frames(_awaited_frames(task)))
+
+        handle = asyncio.get_running_loop().call_later(self.slow_threshold, snapshot)
+        started = time.monotonic()
+        try:
+            return await call
+        finally:
+            handle.cancel()
+            seconds = time.monotonic() - started
+            if seconds >= self.slow_threshold:
+                self.record_slow(kind, name, seconds, stack[0] if stack else "")
+
+    def report(self, top: int = 5) -> str:
+        """
+        Summarises stalls and the worst offenders for the admin command.
+        """
+        lines = [
+            f"Loop stalls over {self.stall_threshold:g}s: {self.stalls} (worst {self.worst_lag:.3f}s)",
+        ]
+        offenders = sorted(self.offenders.values(), key=lambda offender: offender.count * offender.worst, reverse=True)
+        if not offenders:
+            lines.append(f"No calls over {self.slow_threshold:g}s.")
+        for offender in offenders[:top]:
+            lines.append(
+                f"{offender.kind} {offender.name}: {offender.count}x, "
+                f"worst {offender.worst:.3f}s, avg {offender.total / offender.count:.3f}s"
+            )
+        return "\n".join(lines)
+
+
+# Dispatcher middleware that times handlers:
+class SlowHandlerMiddleware(BaseMiddleware):
+    def __init__(self, watchdog: LoopWatchdog) -> None:
+        self.watchdog = watchdog
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any]
+    ) -> Any:
+        content_type = getattr(event, "content_type", "unknown")
+        content_type = getattr(content_type, "value", content_type)
+        return await self.watchdog.timed("handler", content_type, handler(event, data))
+
+
+# Bot session middleware that times API requests:
+class SlowRequestMiddleware(BaseRequestMiddleware):
+    def __init__(self, watchdog: LoopWatchdog) -> None:
+        self.watchdog = watchdog
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType]
+    ) -> Response[TelegramType]:
+        name = method.__api_method__
+        if name in _IGNORED_METHODS:
+            return await make_request(bot, method)
+        return await self.watchdog.timed("request", name, make_request(bot, method))
+
+
+def watchdog_from_env() -> Optional[LoopWatchdog]:
+    """
+    Builds the watchdog from WATCHDOG_STALL_THRESHOLD and
+    WATCHDOG_SLOW_THRESHOLD, or returns None if WATCHDOG_STALL_THRESHOLD is 0.
+    """
+    stall_threshold = float(os.getenv("WATCHDOG_STALL_THRESHOLD", "0.25"))
+    if stall_threshold <= 0:
+        return None
+    return LoopWatchdog(
+        stall_threshold=stall_threshold,
+        slow_threshold=float(os.getenv("WATCHDOG_SLOW_THRESHOLD", "1.0"))
+    )
@@ -0,0 +1,261 @@
+from aiogram import BaseMiddleware
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from aiohttp import web
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+import bisect
+import logging
+import os
+import time
+
+from delivery_queue import DeliveryQueue
+
+
+# Latency buckets in seconds, from a fast API call to a long broadcast
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DURATION_BUCKETS = (1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+# Base class of the metric types below:
+class Metric:
+    """
+    A named metric in the Prometheus text exposition format.
+
+    Parameters:
+      name: Metric name.
+      documentation: The HELP text.
+      labels: Names of the labels every sample is keyed by.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self) -> Iterator[str]:
+        for key, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labels, key)} {value}"
+
+
+class Gauge(Metric):
+    """
+    A value that can go up and down. Instead of being set, it can read its
+    value from a callback at scrape time (see `set_function`).
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float, **labels: Any) -> None:
+        self._values[self._key(labels)] = value
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        self._function = function
+
+    def samples(self) -> Iterator[str]:
+        if self._function is not None:
+            try:
+                yield f"{self.name} {float(self._function())}"
+            except Exception as e:
+                logging.error(f"Error reading metric {self.name}: {e}")
+            return
+        for key, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labels, key)} {value}"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS
+    ) -> None:
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # Label values -> [per-bucket counts (last one is +Inf), sum]
+        self._values: Dict[Tuple[str, ...], List[Any]] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self) -> Iterator[str]:
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                yield f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labels, key)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}"
+
+
+# Metrics registry of this process:
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+UPDATES_RECEIVED = REGISTRY.register(Counter(
+    "bot_updates_received_total", "Messages received, by content type", ["content_type"]
+))
+HANDLER_LATENCY = REGISTRY.register(Histogram(
+    "bot_handler_latency_seconds", "Time spent handling an incoming message", ["content_type"]
+))
+CHANNEL_SEND_LATENCY = REGISTRY.register(Histogram(
+    "bot_channel_send_latency_seconds", "Latency of posting to the channel, by delivery step", ["step"]
+))
+SENDS = REGISTRY.register(Counter(
+    "bot_sends_total", "Per-recipient send attempts, by outcome", ["outcome"]
+))
+SEND_LATENCY = REGISTRY.register(Histogram(
+    "bot_send_latency_seconds", "Latency of per-recipient send attempts, by outcome", ["outcome"]
+))
+BROADCAST_DURATION = REGISTRY.register(Histogram(
+    "bot_broadcast_duration_seconds", "Duration of a broadcast to all recipients", ["label"],
+    buckets=DURATION_BUCKETS
+))
+FLOOD_REJECTED = REGISTRY.register(Counter(
+    "bot_flood_rejected_total", "Messages dropped by per-user flood control"
+))
+STARTUP_PHASE = REGISTRY.register(Gauge(
+    "bot_startup_phase_seconds", "Duration of each startup phase", ["phase"]
+))
+TIME_TO_FIRST_UPDATE = REGISTRY.register(Gauge(
+    "bot_time_to_first_update_seconds", "Time from process start until the first update was handled"
+))
+LOOP_LAG = REGISTRY.register(Histogram(
+    "bot_event_loop_lag_seconds", "How late the event loop ran a periodic timer"
+))
+LOOP_STALLS = REGISTRY.register(Counter(
+    "bot_event_loop_stalls_total", "Times the event loop was blocked longer than the stall threshold"
+))
+SLOW_CALLS = REGISTRY.register(Counter(
+    "bot_slow_calls_total", "Handlers (by content type) and API requests (by method) over the slow threshold",
+    ["kind", "name"]
+))
+QUEUE_PENDING = REGISTRY.register(Gauge("bot_queue_pending_jobs", "Delivery jobs waiting to be processed"))
+QUEUE_RUNNING = REGISTRY.register(Gauge("bot_queue_running_jobs", "Delivery jobs being processed"))
+QUEUE_LAG = REGISTRY.register(Gauge("bot_queue_lag_seconds", "Age of the oldest pending delivery job"))
+
+
+def send_outcome(error: Optional[Exception]) -> str:
+    """
+    Maps the result of a send attempt to the 'outcome' label.
+    """
+    if error is None:
+        return "ok"
+    if isinstance(error, TelegramRetryAfter):
+        return "retry_after"
+    if isinstance(error, TelegramForbiddenError):
+        return "forbidden"
+    return "other"
+
+
+def watch_queue(queue: DeliveryQueue) -> None:
+    """
+    Reports the depth and lag of `queue` at scrape time.
+    """
+    QUEUE_PENDING.set_function(lambda: queue.stats()["pending"])
+    QUEUE_RUNNING.set_function(lambda: queue.stats()["running"])
+    QUEUE_LAG.set_function(lambda: queue.stats()["lag"])
+
+
+# Dispatcher middleware that counts and times incoming messages:
+class MetricsMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any]
+    ) -> Any:
+        content_type = getattr(event, "content_type", "unknown")
+        # ContentType members would otherwise render as 'ContentType.TEXT'
+        content_type = getattr(content_type, "value", content_type)
+        UPDATES_RECEIVED.inc(content_type=content_type)
+        started = time.monotonic()
+        try:
+            return await handler(event, data)
+        finally:
+            HANDLER_LATENCY.observe(time.monotonic() - started, content_type=content_type)
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=REGISTRY.render(), content_type="text/plain", charset="utf-8")
+
+
+def add_metrics_route(app: web.Application) -> None:
+    app.router.add_get("/metrics", metrics_handler)
+
+
+async def start_metrics_server(port: int, host: Optional[str] = None) -> web.AppRunner:
+    """
+    Serves /metrics on a separate local HTTP server (used when there is no
+    webhook server to attach the route to).
+
+    Returns:
+      The AppRunner; call its cleanup() to stop the server.
+    """
+    app = web.Application()
+    add_metrics_route(app)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    host = host or os.getenv("METRICS_HOST", "127.0.0.1")
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Metrics available at http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,148 @@
+from aiogram import BaseMiddleware, types
+from typing import Any, Awaitable, Callable, Dict, Iterator, Optional, Tuple
+import gzip
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+
+RECORDING_VERSION = 1
+
+# Personal fields dropped from users and chats
+_PERSONAL_FIELDS = {"last_name", "username", "title", "phone_number", "bio", "photo"}
+# Fields dropped wherever they appear
+_DROPPED_FIELDS = {"contact", "user_shared", "users_shared", "sender_user_name", "author_signature"}
+
+
+def _pseudonym(value: int, salt: bytes) -> int:
+    # Keeps the sign, so group and channel chats stay negative
+    digest = hashlib.blake2b(str(abs(value)).encode(), key=salt, digest_size=6).digest()
+    pseudonym = int.from_bytes(digest, "big") or 1
+    return -pseudonym if value < 0 else pseudonym
+
+
+def anonymize(data: Any, salt: bytes) -> Any:
+    """
+    Returns a copy of update JSON in which every user and chat ID is replaced
+    by a keyed hash (the same ID always maps to the same pseudonym for a
+    given salt) and names, usernames and phone numbers are removed. Message
+    text and media are kept, since they drive the handlers.
+    """
+    if isinstance(data, list):
+        return [anonymize(item, salt) for item in data]
+    if not isinstance(data, dict):
+        return data
+    # Users have is_bot; chats have a type
+    is_user_or_chat = "id" in data and ("is_bot" in data or data.get("type") in ("private", "group", "supergroup", "channel"))
+    result = {}
+    for key, value in data.items():
+        if is_user_or_chat and key == "id":
+            result[key] = _pseudonym(value, salt)
+        elif is_user_or_chat and key == "first_name":
+            result[key] = "User"
+        elif is_user_or_chat and key in _PERSONAL_FIELDS:
+            continue
+        elif key in _DROPPED_FIELDS:
+            continue
+        else:
+            result[key] = anonymize(value, salt)
+    return result
+
+
+# Outer update middleware that writes updates to a file for offline replay:
+class UpdateRecorder(BaseMiddleware):
+    """
+    Appends every incoming update, anonymised, to a gzip-compressed JSON
+    lines file together with its arrival time relative to the first one,
+    so `benchmarks/replay.py` can play the traffic back at its real pace.
+
+    The middleware only timestamps each update and puts it on an in-memory
+    queue; a background thread anonymises, compresses and writes it, so the
+    recording adds no disk I/O to the handling of the update.
+
+    Parameters:
+      path: File to write; an existing file is replaced.
+      salt: Key for the ID pseudonyms; random if not given, so recordings
+        cannot be linked to each other.
+    """
+
+    def __init__(self, path: str, salt: Optional[bytes] = None) -> None:
+        self.path = path
+        self.salt = salt or os.urandom(16)
+        self.count = 0
+        self._started: Optional[float] = None
+        self._file = gzip.open(path, "wt", encoding="utf-8")
+        self._write({"version": RECORDING_VERSION, "recorded_at": int(time.time())})
+        # (arrival time, update JSON) pairs; None stops the writer
+        self._queue: "queue.SimpleQueue[Optional[Tuple[float, Dict[str, Any]]]]" = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name="update-recorder", daemon=True)
+        self._thread.start()
+
+    def _write(self, entry: Dict[str, Any]) -> None:
+        self._file.write(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            t, update = item
+            try:
+                self._write({"t": t, "update": anonymize(update, self.salt)})
+            except Exception as e:
+                logging.error(f"Error recording an update to {self.path}: {e}")
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: types.Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        now = time.monotonic()
+        if self._started is None:
+            self._started = now
+        self._queue.put((round(now - self._started, 3), event.model_dump(mode="json", by_alias=True, exclude_none=True)))
+        self.count += 1
+        return await handler(event, data)
+
+    def close(self) -> None:
+        """
+        Writes out the queued updates and closes the file.
+        """
+        if not self._file.closed:
+            self._queue.put(None)
+            self._thread.join()
+            self._file.close()
+            logging.info(f"Recorded {self.count} updates to {self.path}")
+
+
+def read_recording(path: str) -> Iterator[Tuple[float, Dict[str, Any]]]:
+    """
+    Yields (seconds since the first update, update JSON) from a recording.
+    """
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        header = json.loads(next(file))
+        if header.get("version") != RECORDING_VERSION:
+            raise ValueError(f"Unsupported recording version: {header.get('version')}")
+        try:
+            for line in file:
+                entry = json.loads(line)
+                yield entry["t"], entry["update"]
+        except (EOFError, json.JSONDecodeError):
+            # The end of a recording cut short by a crash
+            logging.warning(f"Recording {path} is truncated")
+
+
+def recorder_from_env() -> Optional[UpdateRecorder]:
+    """
+    Builds the recorder if RECORD_UPDATES names a file to write.
+    """
+    path = os.getenv("RECORD_UPDATES")
+    if not path:
+        return None
+    logging.warning(f"Recording incoming updates to {path}")
+    return UpdateRecorder(path)
@@ -0,0 +1,338 @@
+from array import array
+from collections import OrderedDict
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+import asyncio
+import logging
+import os
+import time
+
+from storage import ACTIVE, StorageWriter, UserStorage, classify_error, open_storage
+
+
+# In-memory subscriber registry on top of a storage backend:
+class SubscriberRegistry:
+    """
+    Keeps the set of subscribers in memory so handlers never touch the disk
+    to check or list users. Changes are written to storage in batches by a
+    StorageWriter.
+
+    Registration order is kept in a compact int64 array (8 bytes per user)
+    and active membership in a set. Users that blocked the bot or were
+    deactivated stay in the array but are skipped when iterating.
+
+    The users who posted within the last `hot_window` seconds are kept in
+    an OrderedDict from least to most recently active: moving a user to the
+    end when they post and dropping expired users from the front are both
+    O(1), so the activity order costs nothing to maintain. Broadcasts serve
+    these users first (see delivery.tiered_step).
+
+    Parameters:
+      storage: The backend that persists users and their state.
+      flush_every: Number of buffered delivery results that triggers a write.
+      commit_interval: Group commit window of the writer, in seconds.
+      hot_window: How long after their last post users count as active, in
+        seconds; 0 disables activity tracking.
+    """
+
+    def __init__(
+        self,
+        storage: UserStorage,
+        flush_every: int = 500,
+        commit_interval: float = 0.05,
+        hot_window: float = 0.0
+    ) -> None:
+        self.storage = storage
+        self.writer = StorageWriter(storage, interval=commit_interval)
+        self.flush_every = flush_every
+        self.hot_window = hot_window
+        self._activity: "OrderedDict[int, float]" = OrderedDict()
+        self._activity_synced_at = 0.0
+        self._order = array("q")
+        self._members = set()
+        self._inactive = set()
+        self._results: List[Tuple[int, str]] = []
+        self._synced_at = 0.0
+        self._loaded = asyncio.Event()
+        # Users who wrote while a background load was running, in arrival order
+        self._loading = False
+        self._pending: Dict[int, None] = {}
+
+    def _add_loaded(self, rows: Iterable[Tuple[int, str]]) -> None:
+        for user_id, status in rows:
+            self._order.append(user_id)
+            if status == ACTIVE:
+                self._members.add(user_id)
+            elif user_id in self._pending:
+                # Wrote while the load was running, after blocking the bot
+                self._members.add(user_id)
+                self.writer.add(user_id)
+                logging.info(f"User reactivated: {user_id}")
+            else:
+                self._inactive.add(user_id)
+            self._pending.pop(user_id, None)
+
+    def _add_pending(self) -> None:
+        # Users who wrote during the load and are not in storage are new;
+        # they go after the loaded ones so the order matches storage
+        for user_id in self._pending:
+            self._order.append(user_id)
+            self._members.add(user_id)
+            self.writer.add(user_id)
+            logging.info(f"New user registered: {user_id}")
+        self._pending.clear()
+
+    def _add_activity(self, rows: Iterable[Tuple[int, float]]) -> None:
+        # Rows come least recent first, as the OrderedDict keeps them
+        for user_id, active_at in rows:
+            self._activity_synced_at = max(self._activity_synced_at, active_at)
+            if active_at > self._activity.get(user_id, 0.0):
+                self._activity[user_id] = active_at
+                self._activity.move_to_end(user_id)
+
+    def _load_activity(self) -> None:
+        if self.hot_window > 0:
+            self._add_activity(self.storage.activity_since(time.time() - self.hot_window))
+
+    def load(self) -> None:
+        """
+        Reads every known user from storage.
+        """
+        self._synced_at = time.time()
+        self._add_loaded(self.storage.load())
+        self._load_activity()
+        self._loaded.set()
+        logging.info(f"Loaded {len(self._members)} active users ({len(self._inactive)} inactive)")
+
+    async def load_async(self, chunk_size: int = 50000) -> None:
+        """
+        Reads every known user from storage in chunks, yielding to the event
+        loop in between, so updates are handled while a large registry is
+        still loading. Users who write meanwhile are held back until the
+        load ends, then added in their stored position or, if they are new,
+        after everyone else; broadcasts must wait for `wait_loaded()`.
+        """
+        started = time.monotonic()
+        self._synced_at = time.time()
+        self._loading = True
+        rows = self.storage.load()
+        try:
+            while True:
+                chunk = list(islice(rows, chunk_size))
+                if not chunk:
+                    break
+                self._add_loaded(chunk)
+                await asyncio.sleep(0)
+        finally:
+            self._loading = False
+            self._add_pending()
+        self._load_activity()
+        self._loaded.set()
+        logging.info(
+            f"Loaded {len(self._members)} active users ({len(self._inactive)} inactive) "
+            f"in {time.monotonic() - started:.2f}s"
+        )
+
+    async def wait_loaded(self) -> None:
+        await self._loaded.wait()
+
+    def refresh(self) -> None:
+        """
+        Applies registrations, status changes and activity recorded by other
+        processes sharing the same storage since the last load or refresh.
+        """
+        # Look back a little so changes committed slightly out of timestamp
+        # order by another process are not missed; applying them is idempotent
+        for user_id, status, updated_at in self.storage.changes_since(self._synced_at - 5.0):
+            self._synced_at = max(self._synced_at, updated_at)
+            if status == ACTIVE:
+                if user_id in self._inactive:
+                    self._inactive.discard(user_id)
+                elif user_id not in self._members:
+                    self._order.append(user_id)
+                self._members.add(user_id)
+            else:
+                if user_id not in self._members and user_id not in self._inactive:
+                    self._order.append(user_id)
+                self._members.discard(user_id)
+                self._inactive.add(user_id)
+        if self.hot_window > 0:
+            self._add_activity(self.storage.activity_since(self._activity_synced_at - 5.0))
+
+    async def refresh_every(self, interval: float) -> None:
+        """
+        Refreshes the registry every `interval` seconds, forever, so a
+        process that does not deliver itself still sees the users the
+        delivery processes deactivated (and registers them again when they
+        come back).
+        """
+        await self.wait_loaded()
+        while True:
+            await asyncio.sleep(interval)
+            self.refresh()
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._members
+
+    def __len__(self) -> int:
+        return len(self._members)
+
+    def __iter__(self) -> Iterator[int]:
+        # Iterating the array keeps registration order and is safe while
+        # new users are appended during a broadcast
+        for _, user_id in self.iter_from(0):
+            yield user_id
+
+    def iter_from(self, position: int = 0) -> Iterator[Tuple[int, int]]:
+        """
+        Yields (position, user_id) for active users in registration order,
+        starting at `position`. Positions are what broadcast checkpoints
+        store (see BroadcastCursor).
+        """
+        for index in range(position, len(self._order)):
+            user_id = self._order[index]
+            if user_id in self._members:
+                yield index, user_id
+
+    @property
+    def size(self) -> int:
+        """
+        Number of positions in the registration order, inactive users included.
+        """
+        return len(self._order)
+
+    def anchor(self, position: int) -> Optional[int]:
+        """
+        Returns the user just before `position`, which is stored with a
+        checkpoint so it can be found again after a restart.
+        """
+        if 0 < position <= len(self._order):
+            return self._order[position - 1]
+        return None
+
+    def locate(self, position: int, anchor: Optional[int]) -> int:
+        """
+        Finds a checkpointed position again after a restart. Positions stay
+        valid with the SQLite backend; the JSON backend drops inactive users
+        when compacting, which shifts them, so the position is looked up
+        from the anchor user.
+        """
+        if anchor is None or self.anchor(position) == anchor:
+            return position
+        try:
+            return self._order.index(anchor) + 1
+        except ValueError:
+            return min(position, len(self._order))
+
+    def register(self, user_id: int) -> bool:
+        """
+        Adds a user to the registry, or reactivates one that had blocked the
+        bot, if not already active.
+
+        Parameters:
+          user_id: The chat ID of the user to register.
+
+        Returns:
+          True if the user was not active before.
+        """
+        if user_id in self._members:
+            return False
+        if user_id in self._inactive:
+            self._inactive.discard(user_id)
+            logging.info(f"User reactivated: {user_id}")
+        elif self._loading:
+            # Whether the user is new is only known once loading is done
+            if user_id in self._pending:
+                return False
+            self._pending[user_id] = None
+            return True
+        else:
+            self._order.append(user_id)
+            logging.info(f"New user registered: {user_id}")
+        self._members.add(user_id)
+        self.writer.add(user_id)
+        return True
+
+    def touch(self, user_id: int) -> None:
+        """
+        Records that a user just posted, making them the most recently
+        active user.
+        """
+        if self.hot_window <= 0:
+            return
+        now = time.time()
+        self._activity[user_id] = now
+        self._activity.move_to_end(user_id)
+        self.writer.touch(user_id, now)
+        self._expire_activity(now)
+
+    def _expire_activity(self, now: float) -> None:
+        cutoff = now - self.hot_window
+        while self._activity:
+            user_id, active_at = next(iter(self._activity.items()))
+            if active_at >= cutoff:
+                break
+            del self._activity[user_id]
+
+    def recent(self) -> List[int]:
+        """
+        Returns the active users who posted within the hot window, most
+        recently active first.
+        """
+        self._expire_activity(time.time())
+        return [user_id for user_id in reversed(self._activity) if user_id in self._members]
+
+    def mark_inactive(self, user_id: int, status: str) -> None:
+        """
+        Stops delivering to a user until they register again.
+        """
+        if user_id not in self._members:
+            return
+        self._members.discard(user_id)
+        self._inactive.add(user_id)
+        self.writer.set_status(user_id, status)
+        logging.info(f"User {user_id} marked as {status}")
+
+    def record_delivery(self, user_id: int, error: Optional[Exception]) -> None:
+        """
+        Fan-out observer: buffers the delivery result and deactivates users
+        for errors that can never succeed later.
+        """
+        if error is None:
+            self._results.append((user_id, "ok"))
+        else:
+            self._results.append((user_id, str(error)[:200]))
+            status = classify_error(error)
+            if status is not None:
+                self.mark_inactive(user_id, status)
+        if len(self._results) >= self.flush_every:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Hands buffered delivery results to the writer.
+        """
+        if not self._results:
+            return
+        results, self._results = self._results, []
+        self.writer.record_results(results)
+
+    def close(self) -> None:
+        self.flush()
+        self.writer.close()
+        self.storage.close()
+
+
+def open_registry(load: bool = True) -> SubscriberRegistry:
+    """
+    Creates the registry on the configured storage backend and, unless
+    `load` is False (the caller then runs `load_async()`), loads it.
+    """
+    registry = SubscriberRegistry(
+        open_storage(),
+        commit_interval=float(os.getenv("STORAGE_COMMIT_INTERVAL", "0.05")),
+        hot_window=float(os.getenv("HOT_TIER_HOURS", "72")) * 3600
+    )
+    if load:
+        registry.load()
+    return registry
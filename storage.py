@@ -0,0 +1,466 @@
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+
+
+# User statuses
+ACTIVE = "active"
+BLOCKED = "blocked"
+DEACTIVATED = "deactivated"
+
+
+def classify_error(error: Exception) -> Optional[str]:
+    """
+    Maps a delivery error to the status the user should get, or None if the
+    error is transient and the user should stay active.
+    """
+    description = str(error).lower()
+    if isinstance(error, TelegramForbiddenError):
+        return DEACTIVATED if "deactivated" in description else BLOCKED
+    if isinstance(error, TelegramBadRequest) and "chat not found" in description:
+        return DEACTIVATED
+    return None
+
+
+# Interface every user storage backend implements:
+class UserStorage:
+    """
+    Persists the subscriber list and per-user state for SubscriberRegistry.
+    """
+
+    def load(self) -> Iterator[Tuple[int, str]]:
+        """
+        Yields (user_id, status) for every known user in registration order.
+        """
+        raise NotImplementedError
+
+    def add(self, user_id: int) -> None:
+        """
+        Stores a new user, or reactivates an existing one.
+        """
+        raise NotImplementedError
+
+    def set_status(self, user_id: int, status: str) -> None:
+        raise NotImplementedError
+
+    def record_results(self, results: List[Tuple[int, str]]) -> None:
+        """
+        Stores the last delivery result for a batch of users.
+        """
+
+    def activity_since(self, timestamp: float) -> List[Tuple[int, float]]:
+        """
+        Returns (user_id, last_active_at) for users active after
+        `timestamp`, least recent first. Backends that do not store
+        activity return nothing.
+        """
+        return []
+
+    def write_batch(
+        self,
+        statuses: List[Tuple[int, str]],
+        results: List[Tuple[int, str]],
+        activity: Sequence[Tuple[int, float]] = ()
+    ) -> None:
+        """
+        Applies a batch of status changes, in order (ACTIVE meaning
+        registered or reactivated), delivery results and last activity
+        times. Backends override this to write the batch at once. Called
+        from StorageWriter's thread.
+        """
+        for user_id, status in statuses:
+            if status == ACTIVE:
+                self.add(user_id)
+            else:
+                self.set_status(user_id, status)
+        if results:
+            self.record_results(results)
+
+    def changes_since(self, timestamp: float) -> List[Tuple[int, str, float]]:
+        """
+        Returns (user_id, status, updated_at) for users added or changed by
+        any process after `timestamp`. Needed when several processes share
+        the storage.
+        """
+        raise NotImplementedError(f"{type(self).__name__} cannot be shared between processes")
+
+    def close(self) -> None:
+        pass
+
+
+# Storage in a JSON snapshot plus an append-only log:
+class JsonUserStorage(UserStorage):
+    """
+    Keeps active user IDs in a JSON list (the historical users.json format)
+    and appends changes to a write-ahead log. Every `compact_every` records
+    the log is folded into the snapshot, which is replaced atomically.
+
+    Log lines are either `<user_id>` (registered) or `<user_id> <status>`.
+    Only active users are kept in the snapshot, and delivery results and
+    activity are not stored.
+    """
+
+    def __init__(self, snapshot_path: str, wal_path: str, compact_every: int = 1000) -> None:
+        self.snapshot_path = snapshot_path
+        self.wal_path = wal_path
+        self.compact_every = compact_every
+        self._statuses: Dict[int, str] = {}
+        self._wal = None
+        self._wal_records = 0
+
+    def load(self) -> Iterator[Tuple[int, str]]:
+        try:
+            if os.path.exists(self.snapshot_path):
+                with open(self.snapshot_path, "r") as file:
+                    for user_id in json.load(file):
+                        self._statuses[int(user_id)] = ACTIVE
+        except Exception as e:
+            logging.error(f"Error loading users: {e}")
+
+        if os.path.exists(self.wal_path):
+            with open(self.wal_path, "r") as file:
+                for line in file:
+                    parts = line.split()
+                    # A torn last line from a crash is skipped
+                    if not parts or not parts[0].lstrip("-").isdigit():
+                        continue
+                    self._statuses[int(parts[0])] = parts[1] if len(parts) > 1 else ACTIVE
+                    self._wal_records += 1
+
+        directory = os.path.dirname(self.wal_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._wal = open(self.wal_path, "a")
+        return iter(list(self._statuses.items()))
+
+    def add(self, user_id: int) -> None:
+        self.write_batch([(user_id, ACTIVE)], [])
+
+    def set_status(self, user_id: int, status: str) -> None:
+        self.write_batch([(user_id, status)], [])
+
+    def write_batch(
+        self,
+        statuses: List[Tuple[int, str]],
+        results: List[Tuple[int, str]],
+        activity: Sequence[Tuple[int, float]] = ()
+    ) -> None:
+        if not statuses:
+            return
+        lines = []
+        for user_id, status in statuses:
+            self._statuses[user_id] = status
+            lines.append(str(user_id) if status == ACTIVE else f"{user_id} {status}")
+        # One write for the whole batch
+        self._wal.write("\n".join(lines) + "\n")
+        self._wal.flush()
+        self._wal_records += len(lines)
+        if self._wal_records >= self.compact_every:
+            self.compact()
+
+    def compact(self) -> None:
+        """
+        Writes the active users to the snapshot and truncates the log.
+        """
+        users = array("q", (user_id for user_id, status in self._statuses.items() if status == ACTIVE))
+        temp_path = self.snapshot_path + ".tmp"
+        try:
+            with open(temp_path, "w") as file:
+                json.dump(users.tolist(), file)
+                file.flush()
+                os.fsync(file.fileno())
+            try:
+                os.replace(temp_path, self.snapshot_path)
+            except OSError:
+                # The snapshot may be a bind-mounted file (see docker-compose.yml),
+                # which cannot be replaced; rewrite it in place instead
+                with open(self.snapshot_path, "w") as file:
+                    json.dump(users.tolist(), file)
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.remove(temp_path)
+        except Exception as e:
+            logging.error(f"Error saving users: {e}")
+            return
+
+        self._statuses = {user_id: ACTIVE for user_id in users}
+        if self._wal is not None:
+            self._wal.truncate(0)
+        self._wal_records = 0
+
+    def close(self) -> None:
+        if self._wal is None:
+            return
+        if self._wal_records:
+            self.compact()
+        self._wal.close()
+        self._wal = None
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    status TEXT NOT NULL DEFAULT 'active',
+    joined_at REAL NOT NULL,
+    last_result TEXT,
+    last_delivery_at REAL,
+    updated_at REAL,
+    last_active_at REAL
+);
+CREATE INDEX IF NOT EXISTS users_updated ON users (updated_at);
+CREATE INDEX IF NOT EXISTS users_active ON users (last_active_at);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+# Storage in a SQLite database:
+class SQLiteUserStorage(UserStorage):
+    """
+    Stores each user's status, join time and last delivery result in SQLite.
+
+    Parameters:
+      path: Path to the database file.
+      legacy_json_path: A users.json file to import once if the database has
+        not been migrated yet.
+    """
+
+    def __init__(self, path: str, legacy_json_path: Optional[str] = None) -> None:
+        self.path = path
+        self._write_conn: Optional[sqlite3.Connection] = None
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path, isolation_level=None, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SQLITE_SCHEMA)
+        # Lets load() stream users in order without sorting the whole table first
+        self.conn.execute("CREATE INDEX IF NOT EXISTS users_joined ON users (joined_at)")
+        if legacy_json_path:
+            self._migrate_json(legacy_json_path)
+
+    def _migrate_json(self, json_path: str) -> None:
+        # One-shot import of the legacy users.json list
+        if self.conn.execute("SELECT 1 FROM meta WHERE key = 'migrated_json'").fetchone():
+            return
+        if os.path.exists(json_path):
+            try:
+                with open(json_path, "r") as file:
+                    users = [int(user_id) for user_id in json.load(file)]
+            except Exception as e:
+                logging.error(f"Error migrating users from {json_path}: {e}")
+                return
+            # The file lists users in join order; spread the timestamps (1 ms
+            # apart, up to now) so load() keeps that order rather than user IDs
+            now = time.time()
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO users (user_id, joined_at) VALUES (?, ?)",
+                [(user_id, now - (len(users) - index) * 0.001) for index, user_id in enumerate(users)]
+            )
+            self.conn.execute("INSERT INTO meta (key, value) VALUES ('migrated_json', ?)", (json_path,))
+            self.conn.execute("COMMIT")
+            logging.info(f"Migrated {len(users)} users from {json_path}")
+        else:
+            self.conn.execute("INSERT INTO meta (key, value) VALUES ('migrated_json', '')")
+
+    def load(self) -> Iterator[Tuple[int, str]]:
+        return self.conn.execute("SELECT user_id, status FROM users ORDER BY joined_at, rowid")
+
+    def add(self, user_id: int) -> None:
+        self.write_batch([(user_id, ACTIVE)], [])
+
+    def set_status(self, user_id: int, status: str) -> None:
+        self.write_batch([(user_id, status)], [])
+
+    def changes_since(self, timestamp: float) -> List[Tuple[int, str, float]]:
+        return self.conn.execute(
+            "SELECT user_id, status, updated_at FROM users WHERE updated_at > ? ORDER BY updated_at",
+            (timestamp,)
+        ).fetchall()
+
+    def record_results(self, results: List[Tuple[int, str]]) -> None:
+        self.write_batch([], results)
+
+    def activity_since(self, timestamp: float) -> List[Tuple[int, float]]:
+        return self.conn.execute(
+            "SELECT user_id, last_active_at FROM users WHERE last_active_at > ? ORDER BY last_active_at",
+            (timestamp,)
+        ).fetchall()
+
+    def _writer(self) -> sqlite3.Connection:
+        # Writes use their own connection, so they can run in StorageWriter's
+        # thread while the event loop reads through `conn` (WAL allows both)
+        if self._write_conn is None:
+            self._write_conn = sqlite3.connect(self.path, isolation_level=None, timeout=30, check_same_thread=False)
+            self._write_conn.execute("PRAGMA synchronous=NORMAL")
+        return self._write_conn
+
+    def write_batch(
+        self,
+        statuses: List[Tuple[int, str]],
+        results: List[Tuple[int, str]],
+        activity: Sequence[Tuple[int, float]] = ()
+    ) -> None:
+        if not statuses and not results and not activity:
+            return
+        conn = self._writer()
+        now = time.time()
+        # One transaction, and so one commit, for the whole batch
+        conn.execute("BEGIN")
+        try:
+            for user_id, status in statuses:
+                if status == ACTIVE:
+                    conn.execute(
+                        "INSERT INTO users (user_id, joined_at, updated_at) VALUES (?, ?, ?) "
+                        "ON CONFLICT (user_id) DO UPDATE SET status = 'active', updated_at = excluded.updated_at",
+                        (user_id, now, now)
+                    )
+                else:
+                    conn.execute(
+                        "UPDATE users SET status = ?, updated_at = ? WHERE user_id = ?",
+                        (status, now, user_id)
+                    )
+            if results:
+                conn.executemany(
+                    "UPDATE users SET last_result = ?, last_delivery_at = ? WHERE user_id = ?",
+                    [(result, now, user_id) for user_id, result in results]
+                )
+            if activity:
+                conn.executemany(
+                    "UPDATE users SET last_active_at = ? WHERE user_id = ?",
+                    [(active_at, user_id) for user_id, active_at in activity]
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def close(self) -> None:
+        if self._write_conn is not None:
+            self._write_conn.close()
+            self._write_conn = None
+        self.conn.close()
+
+
+# Group commit of storage writes off the event loop:
+class StorageWriter:
+    """
+    Collects registrations, status changes, delivery results and user
+    activity from the handlers and writes them in batches on a single background thread, so
+    the event loop never waits for the disk and a burst of registrations
+    costs one write per batch rather than one per user.
+
+    A batch is written `interval` seconds after the first change in it;
+    batches are written one at a time, in order. Outside a running event
+    loop (scripts), changes are written immediately.
+
+    Parameters:
+      storage: The backend to write to.
+      interval: Group commit window in seconds.
+    """
+
+    def __init__(self, storage: UserStorage, interval: float = 0.05) -> None:
+        self.storage = storage
+        self.interval = interval
+        self._statuses: List[Tuple[int, str]] = []
+        self._results: List[Tuple[int, str]] = []
+        # Only the latest activity of each user in a batch is written
+        self._activity: Dict[int, float] = {}
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage-writer")
+        self._task: Optional[asyncio.Task] = None
+
+    def add(self, user_id: int) -> None:
+        self._statuses.append((user_id, ACTIVE))
+        self._schedule()
+
+    def set_status(self, user_id: int, status: str) -> None:
+        self._statuses.append((user_id, status))
+        self._schedule()
+
+    def record_results(self, results: List[Tuple[int, str]]) -> None:
+        self._results.extend(results)
+        self._schedule()
+
+    def touch(self, user_id: int, active_at: float) -> None:
+        self._activity[user_id] = active_at
+        self._schedule()
+
+    def _schedule(self) -> None:
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self._write_now()
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._commit_later())
+
+    def _take(self) -> Tuple[List[Tuple[int, str]], List[Tuple[int, str]], List[Tuple[int, float]]]:
+        batch = (self._statuses, self._results, list(self._activity.items()))
+        self._statuses, self._results, self._activity = [], [], {}
+        return batch
+
+    def _write(
+        self,
+        statuses: List[Tuple[int, str]],
+        results: List[Tuple[int, str]],
+        activity: List[Tuple[int, float]]
+    ) -> None:
+        try:
+            self.storage.write_batch(statuses, results, activity)
+        except Exception as e:
+            logging.error(f"Error saving {len(statuses)} user changes and {len(results)} delivery results: {e}")
+
+    def _write_now(self) -> None:
+        self._write(*self._take())
+
+    async def _commit_later(self) -> None:
+        # Changes made while a batch is being written go into the next one
+        while self._statuses or self._results or self._activity:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self) -> None:
+        """
+        Writes everything collected so far and waits until it is on disk.
+        """
+        statuses, results, activity = self._take()
+        if statuses or results or activity:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._write, statuses, results, activity)
+
+    def close(self) -> None:
+        """
+        Waits for the batch being written, then writes what is left.
+        """
+        if self._task is not None:
+            self._task.cancel()
+        self._executor.shutdown(wait=True)
+        self._write_now()
+
+
+def open_storage() -> UserStorage:
+    """
+    Opens the storage backend selected by USER_STORAGE ('sqlite' or 'json').
+    """
+    data_dir = os.getenv("DATA_DIR", "data")
+    users_file = os.getenv("USERS_FILE", "users.json")
+    backend = os.getenv("USER_STORAGE", "sqlite")
+    if backend == "json":
+        return JsonUserStorage(
+            users_file,
+            os.path.join(data_dir, "users.wal"),
+            compact_every=int(os.getenv("REGISTRY_COMPACT_EVERY", "1000"))
+        )
+    if backend != "sqlite":
+        raise ValueError(f"Unknown USER_STORAGE backend: {backend}")
+    return SQLiteUserStorage(os.path.join(data_dir, "users.db"), legacy_json_path=users_file)
@@ -1,303 +1,285 @@
 from aiogram import Bot
-from typing import Set, List, Optional, Union
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import ContentType, Message
+from typing import Any, Callable, Iterable, Iterator, List, Optional
+from fanout import PRIORITY_NORMAL, BroadcastResult, FanOutEngine, get_engine
 import os
-import json
 import logging
 from io import BytesIO
-import traceback
 
 
+# Types copy_message can deliver; everything else (service messages,
+# invoices, giveaways, paid media, ...) is rejected at ingest
+COPYABLE_CONTENT_TYPES = {
+    ContentType.TEXT,
+    ContentType.ANIMATION,
+    ContentType.AUDIO,
+    ContentType.DOCUMENT,
+    ContentType.PHOTO,
+    ContentType.STICKER,
+    ContentType.VIDEO,
+    ContentType.VIDEO_NOTE,
+    ContentType.VOICE,
+    ContentType.CONTACT,
+    ContentType.DICE,
+    ContentType.POLL,
+    ContentType.VENUE,
+    ContentType.LOCATION,
+}
+
+# Function to normalise the configured channel ID:
+def resolve_channel_id(channel_id: str) -> int:
+    """
+    Converts the CHANNEL_ID setting to the numeric chat ID used by the Bot API.
+    IDs given in the short '-123' form get the '-100' prefix used by
+    supergroups and channels. Meant to be called once at startup.
+    
+    Raises:
+      ValueError: If the value is not a number.
+    """
+    channel_id_str = str(channel_id).strip()
+    # If it doesn't start with '-100', add it (for supergroups and channels)
+    if not channel_id_str.startswith('-100') and channel_id_str.startswith('-'):
+        # Strip the leading minus and add -100
+        channel_id_str = '-100' + channel_id_str[1:]
+    return int(channel_id_str)
+
+# Function to copy one message or an album to a chat:
+async def copy_content(bot: Bot, chat_id: int, from_chat_id: int, message_ids: List[int]) -> List[int]:
+    """
+    Copies messages of any content type to `chat_id` with a single API call.
+    
+    Parameters:
+      bot: The Telegram Bot instance.
+      chat_id: The target chat.
+      from_chat_id: The chat that contains the original messages.
+      message_ids: IDs of the messages to copy, in order.
+    
+    Returns:
+      The IDs of the copies in the target chat.
+    """
+    if len(message_ids) == 1:
+        copied = await bot.copy_message(chat_id=chat_id, from_chat_id=from_chat_id, message_id=message_ids[0])
+        return [copied.message_id]
+    copied = await bot.copy_messages(chat_id=chat_id, from_chat_id=from_chat_id, message_ids=message_ids)
+    return [item.message_id for item in copied]
+
+# Function to forward one message or an album to a chat:
+async def forward_content(bot: Bot, chat_id: int, from_chat_id: int, message_ids: List[int]) -> List[int]:
+    """
+    Forwards messages to `chat_id` with a single API call, keeping the
+    original attribution.
+    
+    Returns:
+      The IDs of the forwarded messages in the target chat.
+    """
+    if len(message_ids) == 1:
+        forwarded = await bot.forward_message(chat_id=chat_id, from_chat_id=from_chat_id, message_id=message_ids[0])
+        return [forwarded.message_id]
+    forwarded = await bot.forward_messages(chat_id=chat_id, from_chat_id=from_chat_id, message_ids=message_ids)
+    return [item.message_id for item in forwarded]
+
+# Function to copy a message to the channel:
+async def copy_to_channel(bot: Bot, channel_id: int, from_chat_id: int, message_ids: List[int]) -> List[int]:
+    """
+    Copies messages anonymously to the designated Telegram channel.
+    
+    Parameters:
+      bot: The Telegram Bot instance.
+      channel_id: The target channel's numeric ID (see resolve_channel_id).
+      from_chat_id: The chat that contains the original messages.
+      message_ids: IDs of the messages to copy.
+    
+    Returns:
+      The IDs of the channel posts.
+
+    Raises:
+      Whatever the API call raised, so the fan-out engine can retry a
+      RetryAfter and the step is not recorded as done.
+    """
+    try:
+        logging.info(f"Attempting to copy {len(message_ids)} message(s) to channel: {channel_id}")
+        copied = await copy_content(bot, channel_id, from_chat_id, message_ids)
+        logging.info("Message copied to channel successfully")
+        return copied
+    except TelegramRetryAfter:
+        raise
+    except Exception as e:
+        logging.exception(f"Error copying message to channel {channel_id}: {e}", extra={"event": "channel_send_failed"})
+        raise
+
 # Function to forward a message to a specific channel:
-async def send_to_channel(bot: Bot, channel_id: int, message_text: str, entities=None) -> None:
+async def send_to_channel(bot: Bot, channel_id: int, message_text: str, entities=None) -> Message:
     """
     Sends the message text to the designated Telegram channel using the provided bot.
     
     Parameters:
       bot: The Telegram Bot instance.
-      channel_id: The target channel's numeric ID.
+      channel_id: The target channel's numeric ID (see resolve_channel_id).
       message_text: The text of the message to send.
       entities: Optional message entities to preserve formatting.
+    
+    Returns:
+      The channel post.
+
+    Raises:
+      Whatever the API call raised (see copy_to_channel).
     """
     try:
-        # Ensure channel_id is properly formatted
-        channel_id_str = str(channel_id)
-        # If it doesn't start with '-100', add it (for supergroups and channels)
-        if not channel_id_str.startswith('-100') and channel_id_str.startswith('-'):
-            # Strip the leading minus and add -100
-            channel_id_str = '-100' + channel_id_str[1:]
-            channel_id = int(channel_id_str)
-            
         logging.info(f"Attempting to send message to channel: {channel_id}")
-        await bot.send_message(
+        sent = await bot.send_message(
             chat_id=channel_id, 
             text=message_text,
             entities=entities  # Pass entities to preserve formatting
         )
         logging.info("Message sent to channel successfully")
+        return sent
+    except TelegramRetryAfter:
+        raise
     except Exception as e:
-        logging.error(f"Error sending message to channel {channel_id}: {e}")
-        # Print detailed error for debugging
-        traceback.print_exc()
+        logging.exception(f"Error sending message to channel {channel_id}: {e}", extra={"event": "channel_send_failed"})
+        raise
 
-# Function to send image to the channel
-async def send_photo_to_channel(bot: Bot, channel_id: int, photo_file_id: str, caption: Optional[str] = None, caption_entities=None) -> None:
+# Generator over broadcast recipients (excluding the sender):
+def recipients(active_users: Iterable[int], exclude_user_id: int) -> Iterator[int]:
     """
-    Sends a photo to the designated Telegram channel using the provided bot.
-    
-    Parameters:
-      bot: The Telegram Bot instance.
-      channel_id: The target channel's numeric ID.
-      photo_file_id: The file_id of the photo to send.
-      caption: Optional caption for the photo.
-      caption_entities: Optional caption entities to preserve formatting.
+    Yields every user ID from `active_users` except `exclude_user_id`.
     """
-    try:
-        # Ensure channel_id is properly formatted
-        channel_id_str = str(channel_id)
-        if not channel_id_str.startswith('-100') and channel_id_str.startswith('-'):
-            channel_id_str = '-100' + channel_id_str[1:]
-            channel_id = int(channel_id_str)
-            
-        logging.info(f"Attempting to send photo to channel: {channel_id}")
-        await bot.send_photo(
-            chat_id=channel_id, 
-            photo=photo_file_id, 
-            caption=caption,
-            caption_entities=caption_entities
-        )
-        logging.info("Photo sent to channel successfully")
-    except Exception as e:
-        logging.error(f"Error sending photo to channel {channel_id}: {e}")
-        traceback.print_exc()
+    for user_id in active_users:
+        if user_id != exclude_user_id:
+            yield user_id
 
 # Function to broadcast a message to active users (excluding the sender):
 async def broadcast_message(
     bot: Bot,
-    active_users: List[int],
+    active_users: Iterable[int],
     exclude_user_id: int,
     message_text: str,
-    entities=None
-) -> None:
+    entities=None,
+    engine: Optional[FanOutEngine] = None,
+    on_sent: Optional[Callable[[int, Any], None]] = None,
+    on_failed: Optional[Callable[[int, Exception], None]] = None,
+    priority: int = PRIORITY_NORMAL
+) -> BroadcastResult:
     """
     Broadcasts the message to all active users except the sender.
     
     Parameters:
       bot: The Telegram Bot instance.
-      active_users: A list of user chat IDs to send the message to.
+      active_users: The user chat IDs to send the message to.
       exclude_user_id: The sender's ID to be excluded from broadcasting.
       message_text: The text of the message to broadcast.
       entities: Optional message entities to preserve formatting.
+      engine: Optional fan-out engine; the shared one is used by default.
+      on_sent: Optional callback invoked for every successful delivery.
+      on_failed: Optional callback invoked for every failed delivery.
+      priority: Priority of the sends (see fanout); the sender is the
+        fairness key, so one sender's burst cannot starve the others.
+
+    Returns:
+      A BroadcastResult with delivery counts and elapsed time.
     """
-    for user_id in active_users:
-        if user_id != exclude_user_id:
-            try:
-                await bot.send_message(
-                    chat_id=user_id, 
-                    text=message_text,
-                    entities=entities  # Pass entities to preserve formatting
-                )
-            except Exception as e:
-                logging.error(f"Error sending message to user {user_id}: {e}")
+    return await (engine or get_engine()).broadcast(
+        recipients(active_users, exclude_user_id),
+        lambda user_id: bot.send_message(
+            chat_id=user_id,
+            text=message_text,
+            entities=entities  # Pass entities to preserve formatting
+        ),
+        label="message",
+        on_sent=on_sent,
+        on_failed=on_failed,
+        key=exclude_user_id,
+        priority=priority
+    )
 
-# Function to broadcast a photo to active users
-async def broadcast_photo(
+# Function to broadcast a copy of any message to active users
+async def broadcast_copy(
     bot: Bot,
-    active_users: List[int],
+    active_users: Iterable[int],
     exclude_user_id: int,
-    photo_file_id: str,
-    caption: Optional[str] = None,
-    caption_entities=None
-) -> None:
+    from_chat_id: int,
+    message_ids: List[int],
+    engine: Optional[FanOutEngine] = None,
+    on_sent: Optional[Callable[[int, Any], None]] = None,
+    on_failed: Optional[Callable[[int, Exception], None]] = None,
+    priority: int = PRIORITY_NORMAL
+) -> BroadcastResult:
     """
-    Broadcasts a photo to all active users except the sender.
+    Broadcasts anonymous copies of a message (of any content type) to all
+    active users except the sender.
     
     Parameters:
       bot: The Telegram Bot instance.
-      active_users: A list of user chat IDs to send the message to.
+      active_users: The user chat IDs to send the message to.
       exclude_user_id: The sender's ID to be excluded from broadcasting.
-      photo_file_id: The file_id of the photo to send.
-      caption: Optional caption for the photo.
-      caption_entities: Optional caption entities to preserve formatting.
+      from_chat_id: The chat that contains the original messages.
+      message_ids: IDs of the messages to copy.
+      engine: Optional fan-out engine; the shared one is used by default.
+      on_sent: Optional callback invoked for every successful delivery.
+      on_failed: Optional callback invoked for every failed delivery.
+      priority: Priority of the sends (see fanout); the sender is the
+        fairness key, so one sender's burst cannot starve the others.
+
+    Returns:
+      A BroadcastResult with delivery counts and elapsed time.
     """
-    for user_id in active_users:
-        if user_id != exclude_user_id:
-            try:
-                await bot.send_photo(
-                    chat_id=user_id, 
-                    photo=photo_file_id, 
-                    caption=caption,
-                    caption_entities=caption_entities
-                )
-            except Exception as e:
-                logging.error(f"Error sending photo to user {user_id}: {e}")
+    return await (engine or get_engine()).broadcast(
+        recipients(active_users, exclude_user_id),
+        lambda user_id: copy_content(bot, user_id, from_chat_id, message_ids),
+        label="copy",
+        on_sent=on_sent,
+        on_failed=on_failed,
+        key=exclude_user_id,
+        priority=priority
+    )
 
 # Function to broadcast a forwarded message to users
 async def broadcast_forwarded_message(
     bot: Bot,
-    active_users: List[int],
+    active_users: Iterable[int],
     exclude_user_id: int,
     from_chat_id: int,
-    message_id: int
-) -> None:
+    message_ids: List[int],
+    engine: Optional[FanOutEngine] = None,
+    on_sent: Optional[Callable[[int, Any], None]] = None,
+    on_failed: Optional[Callable[[int, Exception], None]] = None,
+    priority: int = PRIORITY_NORMAL
+) -> BroadcastResult:
     """
-    Broadcasts a forwarded message to all active users except the sender.
+    Broadcasts a forwarded message (or album) to all active users except the sender.
     
     Parameters:
       bot: The Telegram Bot instance.
-      active_users: A list of user chat IDs to send the message to.
+      active_users: The user chat IDs to send the message to.
       exclude_user_id: The sender's ID to be excluded from broadcasting.
       from_chat_id: The original chat ID containing the message.
-      message_id: The ID of the message to forward.
-    """
-    for user_id in active_users:
-        if user_id != exclude_user_id:
-            try:
-                # Use forward_message to preserve the forwarded status
-                await bot.forward_message(
-                    chat_id=user_id,
-                    from_chat_id=from_chat_id,
-                    message_id=message_id
-                )
-            except Exception as e:
-                logging.error(f"Error forwarding message to user {user_id}: {e}")
+      message_ids: The IDs of the messages to forward.
+      engine: Optional fan-out engine; the shared one is used by default.
+      on_sent: Optional callback invoked for every successful delivery.
+      on_failed: Optional callback invoked for every failed delivery.
+      priority: Priority of the sends (see fanout); the sender is the
+        fairness key, so one sender's burst cannot starve the others.
 
-# Functions to manage users storage:
-def load_users() -> List[int]:
-    """
-    Loads the list of active user IDs from the storage file.
-    
     Returns:
-      A list of user IDs.
-    """
-    try:
-        if os.path.exists("users.json"):
-            with open("users.json", "r") as file:
-                return json.load(file)
-        return []
-    except Exception as e:
-        logging.error(f"Error loading users: {e}")
-        return []
-
-def save_users(users: List[int]) -> None:
+      A BroadcastResult with delivery counts and elapsed time.
     """
-    Saves the list of active users to the storage file.
-    
-    Parameters:
-      users: The list of user IDs to save.
-    """
-    try:
-        with open("users.json", "w") as file:
-            json.dump(users, file)
-    except Exception as e:
-        logging.error(f"Error saving users: {e}")
+    # Use forward_message to preserve the forwarded status
+    return await (engine or get_engine()).broadcast(
+        recipients(active_users, exclude_user_id),
+        lambda user_id: forward_content(bot, user_id, from_chat_id, message_ids),
+        label="forwarded message",
+        on_sent=on_sent,
+        on_failed=on_failed,
+        key=exclude_user_id,
+        priority=priority
+    )
 
-def register_user(users: List[int], user_id: int) -> List[int]:
+# Function to check admin rights:
+def is_admin(user_id: int) -> bool:
     """
-    Adds a user's chat ID to the active users list if not already present.
-    
-    Parameters:
-      users: The list containing active user IDs.
-      user_id: The chat ID of the user to register.
-      
-    Returns:
-      The updated list of users.
-    """
-    if user_id not in users:
-        users.append(user_id)
-        save_users(users)
-        logging.info(f"New user registered: {user_id}")
-    return users
-
-# Function to send a sticker to the channel
-async def send_sticker_to_channel(bot: Bot, channel_id: int, sticker_file_id: str) -> None:
-    """
-    Sends a sticker to the designated Telegram channel using the provided bot.
-    
-    Parameters:
-      bot: The Telegram Bot instance.
-      channel_id: The target channel's numeric ID.
-      sticker_file_id: The file_id of the sticker to send.
-    """
-    try:
-        # Ensure channel_id is properly formatted
-        channel_id_str = str(channel_id)
-        if not channel_id_str.startswith('-100') and channel_id_str.startswith('-'):
-            channel_id_str = '-100' + channel_id_str[1:]
-            channel_id = int(channel_id_str)
-            
-        logging.info(f"Attempting to send sticker to channel: {channel_id}")
-        await bot.send_sticker(chat_id=channel_id, sticker=sticker_file_id)
-        logging.info("Sticker sent to channel successfully")
-    except Exception as e:
-        logging.error(f"Error sending sticker to channel {channel_id}: {e}")
-        traceback.print_exc()
-
-# Function to broadcast a sticker to active users
-async def broadcast_sticker(
-    bot: Bot,
-    active_users: List[int],
-    exclude_user_id: int,
-    sticker_file_id: str
-) -> None:
+    Checks whether the user is listed in the ADMIN_IDS environment variable
+    (a comma-separated list of user IDs).
     """
-    Broadcasts a sticker to all active users except the sender.
-    
-    Parameters:
-      bot: The Telegram Bot instance.
-      active_users: A list of user chat IDs to send the message to.
-      exclude_user_id: The sender's ID to be excluded from broadcasting.
-      sticker_file_id: The file_id of the sticker to send.
-    """
-    for user_id in active_users:
-        if user_id != exclude_user_id:
-            try:
-                await bot.send_sticker(chat_id=user_id, sticker=sticker_file_id)
-            except Exception as e:
-                logging.error(f"Error sending sticker to user {user_id}: {e}")
-
-# Function to send a video note to the channel
-async def send_video_note_to_channel(bot: Bot, channel_id: int, video_note_file_id: str) -> None:
-    """
-    Sends a video note (circle message) to the designated Telegram channel using the provided bot.
-    
-    Parameters:
-      bot: The Telegram Bot instance.
-      channel_id: The target channel's numeric ID.
-      video_note_file_id: The file_id of the video note to send.
-    """
-    try:
-        # Ensure channel_id is properly formatted
-        channel_id_str = str(channel_id)
-        if not channel_id_str.startswith('-100') and channel_id_str.startswith('-'):
-            channel_id_str = '-100' + channel_id_str[1:]
-            channel_id = int(channel_id_str)
-            
-        logging.info(f"Attempting to send video note to channel: {channel_id}")
-        await bot.send_video_note(chat_id=channel_id, video_note=video_note_file_id)
-        logging.info("Video note sent to channel successfully")
-    except Exception as e:
-        logging.error(f"Error sending video note to channel {channel_id}: {e}")
-        traceback.print_exc()
-
-# Function to broadcast a video note to active users
-async def broadcast_video_note(
-    bot: Bot,
-    active_users: List[int],
-    exclude_user_id: int,
-    video_note_file_id: str
-) -> None:
-    """
-    Broadcasts a video note (circle message) to all active users except the sender.
-    
-    Parameters:
-      bot: The Telegram Bot instance.
-      active_users: A list of user chat IDs to send the message to.
-      exclude_user_id: The sender's ID to be excluded from broadcasting.
-      video_note_file_id: The file_id of the video note to send.
-    """
-    for user_id in active_users:
-        if user_id != exclude_user_id:
-            try:
-                await bot.send_video_note(chat_id=user_id, video_note=video_note_file_id)
-            except Exception as e:
-                logging.error(f"Error sending video note to user {user_id}: {e}")
+    admin_ids = os.getenv("ADMIN_IDS", "")
+    return str(user_id) in {item.strip() for item in admin_ids.split(",") if item.strip()}
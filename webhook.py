@@ -0,0 +1,138 @@
+from aiogram import Bot, Dispatcher, types
+from aiohttp import web
+from typing import List, Optional, Set
+import asyncio
+import hmac
+import logging
+import os
+
+from metrics import add_metrics_route
+
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+# aiohttp server that receives updates from Telegram:
+class WebhookServer:
+    """
+    Serves Telegram webhook updates and feeds them to the dispatcher.
+
+    Each update is acknowledged as soon as it has been parsed and is then
+    handled in the background; at most `max_concurrency` updates are handled
+    at once, after which new requests wait for a free slot before being
+    acknowledged.
+
+    Parameters:
+      dp: The Dispatcher that handles updates.
+      bot: The Bot instance passed to handlers.
+      path: URL path updates are POSTed to.
+      secret_token: If set, requests must carry it in the
+        X-Telegram-Bot-Api-Secret-Token header.
+      max_concurrency: Maximum number of updates handled at once.
+
+    The server also exposes GET /healthz and GET /metrics.
+    """
+
+    def __init__(
+        self,
+        dp: Dispatcher,
+        bot: Bot,
+        path: str = "/webhook",
+        secret_token: Optional[str] = None,
+        max_concurrency: int = 100
+    ) -> None:
+        self.dp = dp
+        self.bot = bot
+        self.path = path
+        self.secret_token = secret_token
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._tasks: Set[asyncio.Task] = set()
+
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        app.router.add_get("/healthz", self.health)
+        add_metrics_route(app)
+        return app
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if self.secret_token and not hmac.compare_digest(
+            request.headers.get(SECRET_HEADER, "").encode(), self.secret_token.encode()
+        ):
+            logging.warning("Rejected webhook request with a wrong secret token")
+            return web.Response(status=401)
+
+        try:
+            update = types.Update.model_validate(await request.json(), context={"bot": self.bot})
+        except Exception as e:
+            logging.error(f"Invalid webhook update: {e}")
+            return web.Response(status=400)
+
+        await self._semaphore.acquire()
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def _process(self, update: types.Update) -> None:
+        try:
+            await self.dp.feed_update(self.bot, update)
+        except Exception as e:
+            logging.error(f"Error handling update {update.update_id}: {e}")
+        finally:
+            self._semaphore.release()
+
+    async def health(self, request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok", "in_flight": len(self._tasks)})
+
+    async def wait_idle(self) -> None:
+        """
+        Waits for every update being handled to finish.
+        """
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, allowed_updates: List[str]) -> None:
+    """
+    Runs the bot in webhook mode until cancelled.
+
+    The server listens on WEBHOOK_HOST:WEBHOOK_PORT at WEBHOOK_PATH. If
+    WEBHOOK_URL is set, the webhook is registered with Telegram; without it
+    the server only accepts updates POSTed locally, which is useful for
+    testing with recorded update JSON.
+    """
+    path = os.getenv("WEBHOOK_PATH", "/webhook")
+    secret_token = os.getenv("WEBHOOK_SECRET") or None
+    server = WebhookServer(
+        dp,
+        bot,
+        path=path,
+        secret_token=secret_token,
+        max_concurrency=int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "100"))
+    )
+
+    runner = web.AppRunner(server.build_app())
+    await runner.setup()
+    host = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+    port = int(os.getenv("WEBHOOK_PORT", "8080"))
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Webhook server listening on {host}:{port}{path}")
+
+    webhook_url = os.getenv("WEBHOOK_URL")
+    if webhook_url:
+        await bot.set_webhook(
+            url=webhook_url.rstrip("/") + path,
+            secret_token=secret_token,
+            allowed_updates=allowed_updates
+        )
+        logging.info(f"Webhook registered at {webhook_url}")
+    else:
+        logging.info("WEBHOOK_URL is not set, accepting local updates only")
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await server.wait_idle()